@@ -0,0 +1,191 @@
+"""
+非同期ロギング
+- setup_logging: ルートロガーの出力をキュー経由で別スレッドから書き出す (logging.basicConfig の代わり)
+- AccessLog: 1リクエスト1行の JSON アクセスログ (モデル・音声長・処理段階ごとの所要時間・RTF)
+ログの書き込み (フォーマット・ファイル I/O) はリスナースレッドで行い、リクエストの処理は
+キューへの追加のみでブロックしない。キューが満杯の場合は記録を破棄して件数を数える
+"""
+import os
+import sys
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+from .response_format import dumps
+
+logger = logging.getLogger("access-log")
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# キューに溜められる記録の上限 (書き込みが追いつかない場合はこれを超えた分を破棄する)
+_QUEUE_SIZE = 10000
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯なら待たずに破棄する QueueHandler"""
+
+    def __init__(self, log_queue: "queue.Queue", preformatted: bool = True):
+        super().__init__(log_queue)
+        self.preformatted = preformatted
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if self.preformatted:
+            return super().prepare(record)
+        # アクセスログは辞書のままキューに入れ、JSON へのエンコードはリスナースレッドで行う
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return dumps(record.msg).decode("utf-8")
+
+
+def setup_logging(level: int = logging.INFO):
+    """
+    ルートロガーにキュー経由のハンドラーを設定 (logging.basicConfig と同じく、設定済みなら何もしない)
+    出力形式は従来の basicConfig と同じ
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue: "queue.Queue" = queue.Queue(_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    # 終了時にキューに残ったログを書き出す
+    atexit.register(listener.stop)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+    root.setLevel(level)
+
+
+class AccessLog:
+    """
+    リクエストごとの JSON 記録を path (- は標準出力) に書き出す
+    sample_rate の割合のリクエストのみ記録する (エラーは常に記録)。
+    log_transcripts が有効な場合のみ文字起こし結果 (text) を含める
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0, log_transcripts: bool = False,
+                 max_bytes: int = 100 * 1024 * 1024, backup_count: int = 5):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("sample_rate must be between 0 and 1")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.log_transcripts = log_transcripts
+        if path == "-":
+            target: logging.Handler = logging.StreamHandler(sys.stdout)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            target = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+            )
+        target.setFormatter(_JsonFormatter())
+        self._handler = _DroppingQueueHandler(queue.Queue(_QUEUE_SIZE), preformatted=False)
+        self._listener = logging.handlers.QueueListener(self._handler.queue, target)
+        self._target = target
+        # ルートロガー (サーバーのログ) には流さない
+        self._logger = logging.getLogger("access")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(self._handler)
+        self.written = 0
+        self._running = False
+        logger.info(
+            f"Access log enabled: {path} (sample_rate={sample_rate}, transcripts={log_transcripts})"
+        )
+
+    def start(self):
+        if not self._running:
+            self._listener.start()
+            self._running = True
+
+    def stop(self):
+        """キューに残った記録を書き出してリスナーを止める"""
+        if self._running:
+            self._listener.stop()
+            self._running = False
+        self._target.flush()
+
+    def sample(self, status: int) -> bool:
+        """このリクエストを記録するか"""
+        return status >= 400 or random.random() < self.sample_rate
+
+    def record(self, fields: Dict[str, Any], text: Optional[str] = None):
+        """
+        1リクエスト分の記録をキューに追加 (ブロックしない)
+        fields は追加後に変更しないこと (エンコードはリスナースレッドで行う)
+        """
+        if not self.sample(fields.get("status", 200)):
+            return
+        entry = {"time": datetime.now(timezone.utc).isoformat(timespec="milliseconds")}
+        entry.update(fields)
+        if self.log_transcripts and text is not None:
+            entry["text"] = text
+        self.written += 1
+        self._logger.info(entry)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "sample_rate": self.sample_rate,
+            "written": self.written - self._handler.dropped,
+            "dropped": self._handler.dropped,
+        }
+
+
+def request_record(endpoint: str, deployment_id: Optional[str], model: Optional[str],
+                   tenant: Optional[str], status: int, audio_seconds: Optional[float],
+                   timings: Dict[str, float], **extra: Any) -> Dict[str, Any]:
+    """
+    アクセスログの1件分の項目
+    rtf (Real Time Factor) は推論時間 / 音声長 (推論時間が無ければ全体の処理時間 / 音声長)
+    """
+    elapsed = timings.get("inference", timings.get("total"))
+    rtf = round(elapsed / audio_seconds, 4) if elapsed is not None and audio_seconds else None
+    fields = {
+        "endpoint": endpoint,
+        "deployment_id": deployment_id,
+        "model": model,
+        "tenant": tenant,
+        "status": status,
+        "audio_seconds": round(audio_seconds, 3) if audio_seconds is not None else None,
+        "timings": {k: round(v, 4) for k, v in timings.items()},
+        "rtf": rtf,
+    }
+    fields.update(extra)
+    return fields
+
+
+# グローバルアクセスログ (ACCESS_LOG 未設定時は None = 無効)
+_access_log: Optional[AccessLog] = None
+_access_log_loaded = False
+
+def get_access_log() -> Optional[AccessLog]:
+    global _access_log, _access_log_loaded
+    if not _access_log_loaded:
+        _access_log_loaded = True
+        path = os.getenv("ACCESS_LOG")
+        if path:
+            _access_log = AccessLog(
+                path,
+                sample_rate=float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "1.0")),
+                log_transcripts=os.getenv("ACCESS_LOG_TRANSCRIPTS", "0") == "1",
+                max_bytes=int(float(os.getenv("ACCESS_LOG_MAX_MB", "100")) * 1024 * 1024),
+                backup_count=int(os.getenv("ACCESS_LOG_BACKUPS", "5"))
+            )
+    return _access_log
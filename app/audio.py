@@ -0,0 +1,357 @@
+"""
+音声ファイルのユーティリティ
+前処理 (デコード -> モノラル化 -> 16kHz リサンプリング) は段階ごとの関数に分けている
+(benchmark_preprocess.py で段階ごとに計測する)
+リクエストごとの全長配列の確保を避けるため、デコード先は再利用プールの float32 バッファとし、
+モノラル化・変換はそのバッファ上で行ってエンジンにはビューを渡す
+サーバー上のパスで指定された WAV / raw PCM はデコードせず、ファイルを mmap して PCM 部分を直接参照する
+"""
+import os
+import math
+import mmap
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, BinaryIO, Optional, Tuple, Union, List, Iterator
+
+from .audio_cache import get_audio_cache, content_key
+
+if TYPE_CHECKING:
+    # numpy は実際に使う関数の中で import する (型注釈用)
+    import numpy as np
+
+logger = logging.getLogger("audio")
+
+# ヘッダーから長さを取得できない形式 (m4a 等) の推定用ビットレート (128kbps)
+_FALLBACK_BYTES_PER_SECOND = 128_000 / 8
+
+
+def estimate_duration(size: int) -> float:
+    """ファイルサイズ (バイト) から音声の長さ (秒) を推定"""
+    return size / _FALLBACK_BYTES_PER_SECOND
+
+
+def probe_duration(fileobj: Union[str, BinaryIO]) -> Optional[float]:
+    """
+    音声の長さ (秒) をコンテナのヘッダーから取得 (デコードはしない)
+    取得できない形式はファイルサイズから推定する。ファイル位置は呼び出し前の位置に戻す
+    """
+    if isinstance(fileobj, str):
+        if fileobj.lower().endswith(RAW_PCM_EXTENSIONS):
+            return os.path.getsize(fileobj) / (TARGET_SAMPLE_RATE * 2)
+        with open(fileobj, "rb") as f:
+            return probe_duration(f)
+
+    pos = fileobj.tell()
+    try:
+        import soundfile as sf
+        info = sf.info(fileobj)
+        if info.samplerate and info.frames > 0:
+            return info.frames / info.samplerate
+    except Exception as e:
+        logger.debug(f"Header probe failed, estimating from size: {e}")
+    finally:
+        fileobj.seek(pos)
+
+    try:
+        return estimate_duration(fileobj.seek(0, os.SEEK_END))
+    except Exception:
+        return None
+    finally:
+        fileobj.seek(pos)
+
+
+# ASRエンジンの入力サンプリングレート
+TARGET_SAMPLE_RATE = 16000
+
+# ヘッダーの無い PCM (16kHz モノラル 16bit リトルエンディアン固定)
+RAW_PCM_EXTENSIONS = (".pcm", ".raw")
+
+# mmap で直接参照する WAV のサンプル形式 ((フォーマットコード, ビット数) -> dtype)
+_WAV_FORMAT_PCM = 1
+_WAV_FORMAT_FLOAT = 3
+_WAV_FORMAT_EXTENSIBLE = 0xFFFE
+_WAV_DTYPES = {
+    (_WAV_FORMAT_PCM, 16): "<i2",
+    (_WAV_FORMAT_PCM, 32): "<i4",
+    (_WAV_FORMAT_FLOAT, 32): "<f4",
+}
+
+# プールに保持するバッファの最小サイズ (サンプル数、2の累乗に切り上げて再利用しやすくする)
+_MIN_BUFFER_SAMPLES = 1 << 16
+
+
+class BufferPool:
+    """
+    float32 バッファの再利用プール (スレッドセーフ)
+    要求サイズ以上で最小の空きバッファを返し、無ければ2の累乗に切り上げて確保する
+    返却されたバッファは合計 max_bytes までプールに保持する
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._free: List["np.ndarray"] = []
+        self._pooled_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, size: int) -> "np.ndarray":
+        import numpy as np
+
+        with self._lock:
+            candidates = [i for i, b in enumerate(self._free) if len(b) >= size]
+            if candidates:
+                buf = self._free.pop(min(candidates, key=lambda i: len(self._free[i])))
+                self._pooled_bytes -= buf.nbytes
+                self.hits += 1
+                return buf
+            self.misses += 1
+        capacity = max(_MIN_BUFFER_SAMPLES, 1 << max(size - 1, 0).bit_length())
+        return np.empty(capacity, dtype=np.float32)
+
+    def release(self, buf: "np.ndarray"):
+        with self._lock:
+            if self._pooled_bytes + buf.nbytes > self.max_bytes:
+                # 上限を超える場合は小さいバッファから捨てて、大きい入力にも再利用できるようにする
+                self._free.sort(key=len)
+                while self._free and self._pooled_bytes + buf.nbytes > self.max_bytes:
+                    self._pooled_bytes -= self._free.pop(0).nbytes
+                if buf.nbytes > self.max_bytes:
+                    return
+            self._free.append(buf)
+            self._pooled_bytes += buf.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffers": len(self._free),
+                "pooled_mb": round(self._pooled_bytes / (1024 * 1024), 1),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def read_pcm(source: Union[str, BinaryIO], pool: BufferPool, buffers: List["np.ndarray"],
+             extra: int = 0) -> Tuple["np.ndarray", int]:
+    """
+    音声を float32 (frames, channels) の配列にデコード
+    soundfile (libsndfile) でプールのバッファへ直接読み込み、失敗時は pydub (ffmpeg) でフォールバック
+    モノラルの場合は末尾に extra サンプル分の空きを確保した1次元のビューを返す
+    確保したバッファは buffers に追加する (呼び出し側でプールに返却する)
+    """
+    import numpy as np
+    import soundfile as sf
+
+    start = source.tell() if hasattr(source, "read") else None
+    try:
+        with sf.SoundFile(source) as f:
+            sr, channels, frames = f.samplerate, f.channels, f.frames
+            if frames <= 0:
+                # 長さが不明な形式は通常の読み込み (バッファを確保する)
+                return f.read(dtype="float32"), sr
+            mono_extra = extra if channels == 1 else 0
+            buf = pool.acquire(frames * channels + mono_extra)
+            buffers.append(buf)
+            out = buf[:frames] if channels == 1 else buf[:frames * channels].reshape(frames, channels)
+            data = f.read(frames, dtype="float32", out=out)
+            return data, sr
+    except Exception as sf_err:
+        logger.warning(f"soundfile failed, using pydub fallback: {sf_err}")
+        if start is not None:
+            source.seek(start)
+        from pydub import AudioSegment
+        audio_seg = AudioSegment.from_file(source)
+        audio_seg = audio_seg.set_channels(1).set_frame_rate(TARGET_SAMPLE_RATE).set_sample_width(2)
+        # int16 の生データをコピーせずに参照し、プールのバッファへ変換しながら書き込む
+        samples = np.frombuffer(audio_seg.raw_data, dtype=np.int16)
+        buf = pool.acquire(len(samples) + extra)
+        buffers.append(buf)
+        out = buf[:len(samples)]
+        np.multiply(samples, np.float32(1 / 32768.0), out=out, dtype=np.float32)
+        return out, TARGET_SAMPLE_RATE
+
+
+def _parse_wav(mm: mmap.mmap) -> Optional[Tuple[str, int, int, int, int]]:
+    """
+    WAV ヘッダーを解析して (dtype, サンプリングレート, チャンネル数, PCM の開始位置, バイト数) を返す
+    mmap で参照できない形式 (圧縮・24bit 等) は None
+    """
+    if len(mm) < 12 or mm[0:4] != b"RIFF" or mm[8:12] != b"WAVE":
+        return None
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(mm):
+        chunk_id = mm[pos:pos + 4]
+        size, = struct.unpack_from("<I", mm, pos + 4)
+        body = pos + 8
+        if chunk_id == b"fmt " and size >= 16:
+            code, channels, sr, _, _, bits = struct.unpack_from("<HHIIHH", mm, body)
+            if code == _WAV_FORMAT_EXTENSIBLE and size >= 26:
+                # サブフォーマット GUID の先頭2バイトが実際のフォーマットコード
+                code, = struct.unpack_from("<H", mm, body + 24)
+            fmt = (_WAV_DTYPES.get((code, bits)), sr, channels)
+        elif chunk_id == b"data":
+            if fmt is None or fmt[0] is None or fmt[2] < 1:
+                return None
+            # ストリーミングで書かれた WAV はサイズが 0 / 0xFFFFFFFF のことがあるため、ファイル末尾で打ち切る
+            available = len(mm) - body
+            nbytes = available if size in (0, 0xFFFFFFFF) else min(size, available)
+            return fmt[0], fmt[1], fmt[2], body, nbytes
+        # チャンクは2バイト境界に揃えられる
+        pos = body + size + (size & 1)
+    return None
+
+
+def is_mappable(path: str) -> bool:
+    """mmap で読み込む対象 (WAV / raw PCM) の拡張子か"""
+    return path.lower().endswith(RAW_PCM_EXTENSIONS + (".wav", ".wave"))
+
+
+def map_pcm(path: str) -> Optional[Tuple["np.ndarray", int]]:
+    """
+    WAV / raw PCM ファイルを mmap し、PCM 部分をコピーせずに参照する読み取り専用の配列を返す
+    (frames,) またはチャンネル数が2以上なら (frames, channels)。dtype はファイルのサンプル形式のまま
+    mmap は配列が参照されている間だけ保持される。対応しない形式は None (通常のデコードを行う)
+    """
+    import numpy as np
+
+    if not is_mappable(path):
+        return None
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if path.lower().endswith(RAW_PCM_EXTENSIONS):
+        dtype, sr, channels, offset, nbytes = "<i2", TARGET_SAMPLE_RATE, 1, 0, len(mm)
+    else:
+        parsed = _parse_wav(mm)
+        if parsed is None:
+            mm.close()
+            return None
+        dtype, sr, channels, offset, nbytes = parsed
+
+    frame_bytes = np.dtype(dtype).itemsize * channels
+    frames = nbytes // frame_bytes
+    data = np.frombuffer(mm, dtype=dtype, count=frames * channels, offset=offset)
+    if channels > 1:
+        data = data.reshape(frames, channels)
+    return data, sr
+
+
+def to_float32_mono(data: "np.ndarray", pool: BufferPool, buffers: List["np.ndarray"],
+                    extra: int = 0) -> "np.ndarray":
+    """
+    map_pcm の配列を float32 モノラルに変換 (既に float32 モノラルならそのまま返す)
+    変換先はプールのバッファで、整数形式は [-1, 1) に正規化する
+    """
+    import numpy as np
+
+    if data.dtype == np.float32 and data.ndim == 1:
+        return data
+    buf = pool.acquire(len(data) + extra)
+    buffers.append(buf)
+    out = buf[:len(data)]
+    if data.ndim > 1:
+        np.mean(data, axis=1, dtype=np.float32, out=out)
+    else:
+        np.copyto(out, data, casting="unsafe")
+    if data.dtype.kind == "i":
+        out *= np.float32(1.0 / (1 << (data.dtype.itemsize * 8 - 1)))
+    return out
+
+
+def downmix(audio_data: "np.ndarray", out: Optional["np.ndarray"] = None) -> "np.ndarray":
+    """ステレオ (多チャンネル) ならモノラルに変換 (float32 のまま out に書き込む)"""
+    import numpy as np
+
+    if len(audio_data.shape) > 1:
+        if out is None:
+            out = np.empty(len(audio_data), dtype=np.float32)
+        return np.mean(audio_data, axis=1, dtype=np.float32, out=out[:len(audio_data)])
+    return audio_data
+
+
+def resample(audio_data: "np.ndarray", sr: int, target_sr: int = TARGET_SAMPLE_RATE) -> "np.ndarray":
+    """target_sr にリサンプリング (ポリフェーズフィルタ。FFT と違い全長の複素数バッファを確保しない)"""
+    from scipy import signal
+
+    if sr == target_sr:
+        return audio_data
+    g = math.gcd(sr, target_sr)
+    num_samples = int(len(audio_data) * target_sr / sr)
+    return signal.resample_poly(audio_data, target_sr // g, sr // g)[:num_samples]
+
+
+def _pad(data: "np.ndarray", pad_samples: int, pool: BufferPool, buffers: List["np.ndarray"]) -> "np.ndarray":
+    """末尾に無音を付与 (data がプールのバッファの先頭にあり空きがあれば、その場で書き込む)"""
+    n = len(data)
+    owner = buffers[-1] if buffers else None
+    if owner is not None and data.base is owner and data.ctypes.data == owner.ctypes.data and len(owner) >= n + pad_samples:
+        out = owner[:n + pad_samples]
+    else:
+        buf = pool.acquire(n + pad_samples)
+        buffers.append(buf)
+        out = buf[:n + pad_samples]
+        out[:n] = data
+    out[n:] = 0.0
+    return out
+
+
+@contextmanager
+def decoded_audio(audio_path: Union[str, BinaryIO], pad_samples: int = 0,
+                  pool: Optional[BufferPool] = None) -> Iterator["np.ndarray"]:
+    """
+    音声を 16kHz モノラル float32 にデコードし、プールのバッファ上のビューを返す
+    ビューは with ブロック内でのみ有効 (ブロックを抜けるとバッファはプールに返却される)
+    pad_samples を指定すると末尾に無音を付与する
+    デコード済み音声のキャッシュが有効な場合は、同じ内容の音声のデコードを省略する (読み取り専用の配列を返す)
+    WAV / raw PCM のパスは mmap で参照する (16kHz モノラル float32 の WAV はファイルのページをそのまま返す)
+    """
+    pool = pool or get_buffer_pool()
+    buffers: List["np.ndarray"] = []
+    mapped = map_pcm(audio_path) if isinstance(audio_path, str) else None
+    # mmap で読める入力はデコードが無いためキャッシュしない
+    cache = get_audio_cache() if mapped is None else None
+    key = content_key(audio_path) if cache is not None else None
+    try:
+        if mapped is not None:
+            pcm, sr = mapped
+            data = resample(to_float32_mono(pcm, pool, buffers, extra=pad_samples), sr)
+        else:
+            data = cache.get(key) if cache is not None else None
+            if data is None:
+                data, sr = read_pcm(audio_path, pool, buffers, extra=pad_samples)
+                if data.ndim > 1:
+                    mono = pool.acquire(len(data) + pad_samples)
+                    buffers.append(mono)
+                    data = downmix(data, out=mono)
+                data = resample(data, sr)
+                if cache is not None:
+                    # プールのバッファは返却されるため、キャッシュにはコピーを登録する
+                    cache.put(key, data.copy())
+        if pad_samples:
+            data = _pad(data, pad_samples, pool, buffers)
+        yield data
+    finally:
+        for buf in buffers:
+            pool.release(buf)
+
+
+def decode_audio(audio_path: Union[str, BinaryIO]) -> "np.ndarray":
+    """音声を 16kHz モノラル float32 の numpy配列にデコード (プール外の配列として返す)"""
+    with decoded_audio(audio_path) as data:
+        return data.copy()
+
+
+# グローバルプール
+_buffer_pool: Optional[BufferPool] = None
+
+def get_buffer_pool() -> BufferPool:
+    """環境変数 AUDIO_POOL_MAX_MB (既定: 256MB) を上限とするバッファプール"""
+    global _buffer_pool
+    if _buffer_pool is None:
+        _buffer_pool = BufferPool(int(float(os.getenv("AUDIO_POOL_MAX_MB", "256")) * 1024 * 1024))
+    return _buffer_pool
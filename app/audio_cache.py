@@ -0,0 +1,101 @@
+"""
+デコード済み音声のキャッシュ
+同じ音声を別のモデルへ送る・プロンプトや言語を変えて再送する場合に、デコードとリサンプリングを
+省略する。キーは音声ファイルの内容のハッシュ、値は 16kHz モノラル float32 の配列 (読み取り専用)
+"""
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, BinaryIO, Optional, Union, Dict, Any
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger("audio-cache")
+
+_CHUNK_SIZE = 1 << 20
+
+
+def content_key(audio_path: Union[str, BinaryIO]) -> str:
+    """音声ファイルの内容のハッシュ (ファイルオブジェクトは現在位置から読み、位置を戻す)"""
+    h = hashlib.blake2b(digest_size=16)
+    if hasattr(audio_path, "read"):
+        pos = audio_path.tell()
+        try:
+            for chunk in iter(lambda: audio_path.read(_CHUNK_SIZE), b""):
+                h.update(chunk)
+        finally:
+            audio_path.seek(pos)
+    else:
+        with open(audio_path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class AudioCache:
+    """メモリ使用量 (バイト) を上限とする LRU キャッシュ (スレッドセーフ)"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # 1件で大半を占める巨大な音声はキャッシュしない
+        self.max_entry_bytes = max_bytes // 4
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional["np.ndarray"]:
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return audio
+
+    def put(self, key: str, audio: "np.ndarray"):
+        """配列を登録 (呼び出し後は変更しないこと。読み取り専用にして共有する)"""
+        if audio.nbytes > self.max_entry_bytes:
+            return
+        audio.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = audio
+            self._bytes += audio.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_mb": round(self._bytes / (1024 * 1024), 1),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+            }
+
+
+# グローバルキャッシュ (AUDIO_CACHE_MB が 0 または未設定なら無効)
+_audio_cache: Optional[AudioCache] = None
+_audio_cache_loaded = False
+
+def get_audio_cache() -> Optional[AudioCache]:
+    global _audio_cache, _audio_cache_loaded
+    if not _audio_cache_loaded:
+        _audio_cache_loaded = True
+        max_mb = float(os.getenv("AUDIO_CACHE_MB", "0"))
+        if max_mb > 0:
+            _audio_cache = AudioCache(int(max_mb * 1024 * 1024))
+            logger.info(f"Decoded audio cache enabled: {max_mb:.0f}MB")
+    return _audio_cache
@@ -0,0 +1,212 @@
+"""
+バッチ文字起こし - 複数ファイル / アーカイブ (zip, tar) をまとめて処理
+"""
+import tempfile
+import asyncio
+import logging
+import tarfile
+import posixpath
+import zipfile
+from typing import List, Tuple, BinaryIO, Dict, Any, Optional, Union, Sequence
+
+from .model_registry import Deployment
+from .cancellation import CancellationToken, RequestCancelled
+from .audio import probe_duration
+from .tenants import Tenant
+from .response_format import backend_options, finalize
+
+logger = logging.getLogger("batch-transcriber")
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+# 展開したメンバーをメモリ上に保持する最大サイズ (超えた分は一時ファイル)
+_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+_COPY_CHUNK = 1 << 20
+
+
+def is_archive(filename: Optional[str]) -> bool:
+    return bool(filename) and filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _is_hidden(name: str) -> bool:
+    # macOS の __MACOSX/ や ._xxx などのメタデータファイルを除外 ("./a.wav" の "." は隠しファイルではない)
+    return any(part.startswith((".", "__MACOSX")) for part in posixpath.normpath(name).split("/") if part != ".")
+
+
+class _ArchiveLimits:
+    """
+    アーカイブ展開の上限 (圧縮爆弾対策)。各メンバーを読み込む前に判定する
+    - max_files: 展開する音声ファイル数
+    - max_entries: ディレクトリ・隠しファイルを含むメンバー数
+    - max_bytes: 展開後の合計バイト数 (リクエスト内の全アーカイブの合計)
+    """
+
+    def __init__(self, max_files: int, max_entries: int, max_bytes: int):
+        self.max_files = max_files
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.files = 0
+        self.entries = 0
+        self.bytes = 0
+
+    def check_entry(self):
+        self.entries += 1
+        if self.entries > self.max_entries:
+            raise ValueError(f"Too many entries in archive (max {self.max_entries})")
+
+    def add_file(self):
+        self.files += 1
+        if self.files > self.max_files:
+            raise ValueError(f"Too many files in batch (max {self.max_files})")
+
+    def read(self, name: str, size: int, stream: BinaryIO) -> BinaryIO:
+        """メンバーを上限の範囲で読み込む (size はヘッダー上のサイズ。実際に読んだバイト数でも判定する)"""
+        self.add_file()
+        remaining = self.max_bytes - self.bytes
+        if size > remaining:
+            raise ValueError(f"Archive too large when extracted (max {self.max_bytes // (1024 * 1024)}MB): {name}")
+        # 大きなメンバーはメモリに置かず一時ファイルへ書き出す
+        spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_MEMORY)
+        try:
+            for chunk in iter(lambda: stream.read(_COPY_CHUNK), b""):
+                self.bytes += len(chunk)
+                if self.bytes > self.max_bytes:
+                    raise ValueError(f"Archive too large when extracted (max {self.max_bytes // (1024 * 1024)}MB): {name}")
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+
+def extract_archive(filename: str, fileobj: Union[str, BinaryIO],
+                    limits: _ArchiveLimits) -> List[Tuple[str, BinaryIO]]:
+    """
+    アーカイブ内の音声ファイルを展開 (アーカイブ内の格納順。fileobj はサーバーローカルのパスも可)
+    小さなメンバーはメモリ上、大きなメンバーは一時ファイルに展開する (ブロッキング処理のためワーカースレッドで呼ぶ)
+    """
+    items = []
+    if filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(fileobj) as zf:
+            for info in zf.infolist():
+                limits.check_entry()
+                if info.is_dir() or _is_hidden(info.filename):
+                    continue
+                with zf.open(info) as stream:
+                    items.append((info.filename, limits.read(info.filename, info.file_size, stream)))
+    else:
+        source = {"name": fileobj} if isinstance(fileobj, str) else {"fileobj": fileobj}
+        with tarfile.open(mode="r:*", **source) as tf:
+            for member in tf:
+                limits.check_entry()
+                if not member.isfile() or _is_hidden(member.name):
+                    continue
+                items.append((member.name, limits.read(member.name, member.size, tf.extractfile(member))))
+    return items
+
+
+def expand_inputs(uploads: List[Tuple[str, Union[str, BinaryIO]]], max_files: int,
+                  max_archive_entries: int = 10000,
+                  max_archive_bytes: int = 1024 * 1024 * 1024) -> List[Tuple[str, Union[str, BinaryIO]]]:
+    """
+    アップロードされたファイル (またはサーバーローカルのパス) のうちアーカイブを展開し、入力順のファイル一覧を返す
+    ファイル数・アーカイブのメンバー数・展開後のサイズが上限を超えた時点で ValueError
+    """
+    items = []
+    limits = _ArchiveLimits(max_files, max_archive_entries, max_archive_bytes)
+    for filename, fileobj in uploads:
+        if is_archive(filename):
+            items.extend(extract_archive(filename, fileobj, limits))
+        else:
+            limits.add_file()
+            items.append((filename, fileobj))
+    return items
+
+
+async def probe_durations(items: List[Tuple[str, Union[str, BinaryIO]]]) -> List[Optional[float]]:
+    """各ファイルの音声長をヘッダーから取得 (ワーカースレッドで実行)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: [probe_duration(f) for _, f in items])
+
+
+def _error_entry(e: Exception) -> Dict[str, Any]:
+    return {"code": type(e).__name__, "message": str(e)}
+
+
+async def transcribe_batch(
+    deployment: Deployment,
+    items: List[Tuple[str, Union[str, BinaryIO]]],
+    language: Optional[str],
+    prompt: Optional[str],
+    response_format: str,
+    durations: List[Optional[float]],
+    cancel_token: Optional[CancellationToken] = None,
+    tenant: Optional[Tenant] = None,
+    segment_fields: Optional[Sequence[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    デプロイメントのワーカーに分散して文字起こし
+    transcribe_batch 対応のbackendは max_batch_size 件ずつまとめて推論する
+    1ファイルの失敗はそのファイルの結果にのみ記録し、バッチ全体は失敗させない
+    cancel_token がキャンセルされた場合、未処理のファイルは中断として記録される
+    """
+    batch_size = deployment.max_batch_size
+    # 長さの近いファイル同士をまとめる (バッチ内の最長ファイルに合わせた無駄な計算を減らす)
+    order = sorted(range(len(items)), key=lambda i: durations[i] or 0.0)
+    chunks = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+
+    async def run_single(index: int):
+        try:
+            # finalize (字幕の生成等) も推論と同じワーカースレッドで行う
+            result = await deployment.run(lambda t: finalize(t.transcribe(
+                audio_path=items[index][1],
+                language=language,
+                prompt=prompt,
+                cancel_token=cancel_token,
+                **backend_options(t, response_format, segment_fields)
+            ), response_format, segment_fields), cancel_token=cancel_token, cost=durations[index], tenant=tenant)
+            results[index] = {"status": "succeeded", "result": result}
+        except Exception as e:
+            logger.warning(f"Batch item {index} ({items[index][0]}) failed: {e}")
+            results[index] = {"status": "failed", "error": _error_entry(e)}
+
+    async def run_chunk(indices: List[int]):
+        if len(indices) == 1:
+            return await run_single(indices[0])
+        try:
+            chunk_results = await deployment.run(lambda t: [
+                r if isinstance(r, Exception) else finalize(r, response_format, segment_fields)
+                for r in t.transcribe_batch(
+                    [items[i][1] for i in indices],
+                    language=language,
+                    prompt=prompt,
+                    cancel_token=cancel_token,
+                    **backend_options(t, response_format, segment_fields)
+                )
+            ], cancel_token=cancel_token, cost=sum(durations[i] or 0.0 for i in indices), tenant=tenant)
+        except RequestCancelled as e:
+            for i in indices:
+                results[i] = {"status": "failed", "error": _error_entry(e)}
+            return
+        except Exception as e:
+            # まとめた推論が失敗した場合は1件ずつやり直して、失敗したファイルを特定する
+            logger.warning(f"Batched inference failed, retrying items individually: {e}")
+            for i in indices:
+                if hasattr(items[i][1], "seek"):
+                    items[i][1].seek(0)
+            await asyncio.gather(*[run_single(i) for i in indices])
+            return
+        for i, result in zip(indices, chunk_results):
+            if isinstance(result, Exception):
+                results[i] = {"status": "failed", "error": _error_entry(result)}
+            else:
+                results[i] = {"status": "succeeded", "result": result}
+
+    await asyncio.gather(*[run_chunk(chunk) for chunk in chunks])
+
+    return [
+        {"index": i, "filename": items[i][0], **entry}
+        for i, entry in enumerate(results)
+    ]
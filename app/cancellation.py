@@ -0,0 +1,63 @@
+"""
+リクエストのキャンセル・期限管理
+イベントループ側 (待機中のジョブ) とワーカースレッド側 (実行中の推論) の両方から参照する
+"""
+import asyncio
+import threading
+import time
+from typing import Optional
+
+CLIENT_DISCONNECTED = "client_disconnected"
+DEADLINE_EXCEEDED = "deadline_exceeded"
+
+
+class RequestCancelled(Exception):
+    """クライアント切断または期限切れによりリクエストが中断された"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+
+
+class CancellationToken:
+    """
+    1リクエスト分のキャンセル状態
+    cancel() はイベントループ上で呼び出す。ワーカースレッドからは cancelled / check() で参照する
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.reason: Optional[str] = None
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self._thread_event = threading.Event()
+        self._async_event = asyncio.Event()
+        self._timer = None
+        if timeout is not None:
+            # 期限到達時に自動でキャンセル (実行中の推論も協調的に停止させる)
+            self._timer = asyncio.get_running_loop().call_later(
+                max(timeout, 0.0), self.cancel, DEADLINE_EXCEEDED
+            )
+
+    def cancel(self, reason: str):
+        if self.reason is not None:
+            return
+        self.reason = reason
+        self._thread_event.set()
+        self._async_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._thread_event.is_set()
+
+    def check(self):
+        """キャンセル済みなら RequestCancelled を送出 (推論ループの区切りで呼び出す)"""
+        if self._thread_event.is_set():
+            raise RequestCancelled(self.reason)
+
+    async def wait(self):
+        await self._async_event.wait()
+
+    def close(self):
+        """期限タイマーを解除"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,107 @@
+"""
+トラフィックキャプチャ - 再現用にリクエストをサンプリングして記録する (replay.py で再送)
+音声は内容のハッシュ (SHA-256) をファイル名として重複なく保存し、パラメータ・到着時刻・
+処理段階ごとの所要時間を trace.jsonl に1行ずつ追記する
+"""
+import os
+import json
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import BinaryIO, Dict, Any, Optional, Union
+
+logger = logging.getLogger("traffic-capture")
+
+TRACE_FILE = "trace.jsonl"
+AUDIO_DIR = "audio"
+
+
+class TrafficCapture:
+    """サンプリングしたリクエストを directory に記録 (合計サイズが max_bytes に達したら停止)"""
+
+    def __init__(self, directory: str, sample_rate: float = 1.0, max_bytes: int = 1024 * 1024 * 1024):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("sample_rate must be between 0 and 1")
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, AUDIO_DIR), exist_ok=True)
+        # 既存のキャプチャに追記する場合も上限は合計サイズで判定する
+        self._bytes = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(directory) for name in names
+        )
+        self._full = False
+        logger.info(
+            f"Traffic capture enabled: {directory} (sample_rate={sample_rate}, "
+            f"max={max_bytes // (1024 * 1024)}MB, used={self._bytes // (1024 * 1024)}MB)"
+        )
+
+    @property
+    def full(self) -> bool:
+        return self._full
+
+    def sample(self) -> bool:
+        """このリクエストを記録するか"""
+        return not self._full and random.random() < self.sample_rate
+
+    def _write(self, fileobj: Union[str, BinaryIO], record: Dict[str, Any]):
+        if isinstance(fileobj, str):
+            # サーバーローカルのパスで指定された入力
+            with open(fileobj, "rb") as f:
+                return self._write(f, record)
+        pos = fileobj.tell()
+        try:
+            fileobj.seek(0)
+            data = fileobj.read()
+        finally:
+            fileobj.seek(pos)
+
+        digest = hashlib.sha256(data).hexdigest()
+        ext = os.path.splitext(record.get("filename") or "")[1].lower()
+        audio_name = digest + ext
+        audio_path = os.path.join(self.directory, AUDIO_DIR, audio_name)
+        record = {**record, "audio": audio_name, "audio_bytes": len(data)}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+
+        with self._lock:
+            new_bytes = len(line.encode("utf-8")) + (0 if os.path.exists(audio_path) else len(data))
+            if self._bytes + new_bytes > self.max_bytes:
+                if not self._full:
+                    logger.warning(f"Traffic capture size limit reached ({self.max_bytes // (1024 * 1024)}MB), stopping capture")
+                self._full = True
+                return
+            if not os.path.exists(audio_path):
+                with open(audio_path, "wb") as f:
+                    f.write(data)
+            with open(os.path.join(self.directory, TRACE_FILE), "a", encoding="utf-8") as f:
+                f.write(line)
+            self._bytes += new_bytes
+
+    async def record(self, fileobj: Union[str, BinaryIO], record: Dict[str, Any]):
+        """音声とリクエスト情報を記録 (ハッシュ計算・書き込みはワーカースレッドで行う)"""
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, fileobj, record)
+        except Exception as e:
+            logger.warning(f"Failed to capture request: {e}")
+
+
+# グローバルキャプチャ (CAPTURE_DIR 未設定時は None)
+_capture: Optional[TrafficCapture] = None
+_capture_loaded = False
+
+def get_traffic_capture() -> Optional[TrafficCapture]:
+    global _capture, _capture_loaded
+    if not _capture_loaded:
+        _capture_loaded = True
+        directory = os.getenv("CAPTURE_DIR")
+        if directory:
+            _capture = TrafficCapture(
+                directory,
+                sample_rate=float(os.getenv("CAPTURE_SAMPLE_RATE", "1.0")),
+                max_bytes=int(float(os.getenv("CAPTURE_MAX_MB", "1024")) * 1024 * 1024)
+            )
+    return _capture
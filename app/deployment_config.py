@@ -0,0 +1,240 @@
+"""
+デプロイメント設定 - 設定ファイル (JSON / YAML / TOML) からモデル構成を読み込む
+"""
+import os
+import json
+import math
+import logging
+import importlib
+import inspect
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional
+
+from .tenants import TenantConfig
+
+logger = logging.getLogger("deployment-config")
+
+DEFAULT_WHISPER_MODEL = "RoachLin/kotoba-whisper-v2.2-faster"
+
+# backend名 -> 実装クラス (必要になるまでimportしない)
+BACKENDS = {
+    "faster-whisper": "app.transcriber:WhisperTranscriber",
+    "reazonspeech": "app.reazonspeech_transcriber:ReazonSpeechTranscriber",
+    "onnx": "app.transcriber_onnx:WhisperInference",
+}
+
+
+@dataclass
+class DeploymentConfig:
+    """1デプロイメント分の設定"""
+    name: str
+    backend: str
+    model: Optional[str] = None
+    device: str = "cpu"
+    compute_type: Optional[str] = None
+    cpu_threads: Optional[int] = None
+    replicas: int = 1
+    max_concurrency: Optional[int] = None  # 未指定時は replicas と同じ
+    max_batch_size: int = 1  # バッチAPIで1回の推論にまとめる最大ファイル数 (transcribe_batch 対応backendのみ)
+    decoding: Dict[str, Any] = field(default_factory=dict)
+    scheduling: Dict[str, Any] = field(default_factory=dict)  # JobScheduler の設定 (policy, aging_rate, ...)
+    aliases: List[str] = field(default_factory=list)
+    options: Dict[str, Any] = field(default_factory=dict)  # backend固有の追加引数
+    # max_concurrency を replicas から決めたか (リロードで replicas だけ変えた場合に再計算する)
+    max_concurrency_from_replicas: bool = field(default=False, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.replicas < 1:
+            raise ValueError(f"[{self.name}] replicas must be >= 1")
+        if self.max_concurrency is None:
+            self.max_concurrency = self.replicas
+            self.max_concurrency_from_replicas = True
+        if self.max_concurrency < 1:
+            raise ValueError(f"[{self.name}] max_concurrency must be >= 1")
+        if self.max_batch_size < 1:
+            raise ValueError(f"[{self.name}] max_batch_size must be >= 1")
+        # スケジューラ設定の検証 (不正なキー・値はロード前にエラーにする)
+        from .scheduler import JobScheduler
+        JobScheduler(self.max_concurrency, **self.scheduling)
+
+
+@dataclass
+class ServerConfig:
+    """サーバー全体の設定"""
+    deployments: List[DeploymentConfig]
+    default_deployment: Optional[str] = None
+    tenants: List[TenantConfig] = field(default_factory=list)
+    allow_unknown_keys: bool = True  # tenants に無いAPIキーを default テナントとして受け付けるか
+
+    def __post_init__(self):
+        names = [d.name for d in self.deployments]
+        if len(names) != len(set(names)):
+            raise ValueError(f"Duplicate deployment names: {names}")
+        if self.default_deployment is None and self.deployments:
+            self.default_deployment = self.deployments[0].name
+        if self.default_deployment not in names:
+            raise ValueError(f"default_deployment '{self.default_deployment}' is not defined")
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ServerConfig":
+        deployments = [DeploymentConfig(**d) for d in data.get("deployments", [])]
+        if not deployments:
+            raise ValueError("Config must define at least one deployment")
+        return cls(
+            deployments=deployments,
+            default_deployment=data.get("default_deployment"),
+            tenants=[TenantConfig(**t) for t in data.get("tenants", [])],
+            allow_unknown_keys=data.get("allow_unknown_keys", True)
+        )
+
+
+def _read_config_file(path: str) -> Dict[str, Any]:
+    """拡張子で形式を判定して読み込む"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".json":
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    if ext in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError as e:
+            raise RuntimeError("PyYAML is required for YAML config files (pip install pyyaml)") from e
+        with open(path, encoding="utf-8") as f:
+            return yaml.safe_load(f)
+    if ext == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib  # Python 3.10
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    raise ValueError(f"Unsupported config format: {path} (expected .json, .yaml, .yml or .toml)")
+
+
+def load_config_file(path: str) -> ServerConfig:
+    """設定ファイルを読み込む"""
+    logger.info(f"Loading deployment config: {path}")
+    return ServerConfig.from_dict(_read_config_file(path))
+
+
+def default_config() -> ServerConfig:
+    """設定ファイル未指定時の構成 (環境変数から従来と同じデプロイメントを組み立てる)"""
+    deployments = [
+        DeploymentConfig(
+            name="kotoba-whisper",
+            backend="faster-whisper",
+            model=os.getenv("WHISPER_MODEL", DEFAULT_WHISPER_MODEL),
+            device="cuda" if os.getenv("USE_GPU", "0") == "1" else "cpu",
+            aliases=["whisper-1", "kotoba"],
+        ),
+        DeploymentConfig(
+            name="reazonspeech",
+            backend="reazonspeech",
+            max_batch_size=8,
+            aliases=["reazonspeech-k2", "reazon"],
+        ),
+    ]
+
+    onnx_model = os.getenv("ONNX_WHISPER_MODEL")
+    if onnx_model:
+        deployments.append(DeploymentConfig(
+            name="whisper-onnx",
+            backend="onnx",
+            model=onnx_model,
+            compute_type="float32",
+            aliases=["onnx"],
+        ))
+        if os.getenv("ONNX_WHISPER_INT8", "0") == "1":
+            deployments.append(DeploymentConfig(
+                name="whisper-onnx-int8",
+                backend="onnx",
+                model=onnx_model,
+                compute_type="int8",
+                aliases=["onnx-int8"],
+            ))
+
+    return ServerConfig(deployments=deployments, default_deployment="kotoba-whisper")
+
+
+def load_server_config() -> ServerConfig:
+    """WHISPER_SERVER_CONFIG が指定されていれば設定ファイル、なければ既定構成"""
+    path = os.getenv("WHISPER_SERVER_CONFIG")
+    if path:
+        return load_config_file(path)
+    return default_config()
+
+
+def _import_backend(backend: str):
+    """backend名 または 'module:Class' 形式の指定から実装クラスを取得"""
+    target = BACKENDS.get(backend, backend)
+    if ":" not in target:
+        raise ValueError(f"Unknown backend: {backend} (expected one of {list(BACKENDS)} or 'module:Class')")
+    module_name, class_name = target.split(":", 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _warn_ignored(config: DeploymentConfig, fields: List[str]):
+    """backend が使わない共通設定が指定されていれば警告する"""
+    defaults = {"device": "cpu", "decoding": {}}
+    for name in fields:
+        if getattr(config, name) not in (None, defaults.get(name)):
+            logger.warning(f"[{config.name}] '{name}' is not supported by backend '{config.backend}', ignoring")
+
+
+def _backend_kwargs(config: DeploymentConfig) -> Dict[str, Any]:
+    """共通設定を各backendのコンストラクタ引数に変換"""
+    if config.backend == "faster-whisper":
+        kwargs = {
+            "use_gpu": config.device == "cuda",
+            "compute_type": config.compute_type,
+            "cpu_threads": config.cpu_threads,
+            "decode_options": config.decoding,
+            # レプリカあたりの同時実行数 (CTranslate2 は num_workers 個の推論を並列に実行できる)
+            "num_workers": math.ceil(config.max_concurrency / config.replicas),
+        }
+        if config.model:
+            kwargs["model_size"] = config.model
+    elif config.backend == "reazonspeech":
+        _warn_ignored(config, ["model", "device", "decoding"])
+        kwargs = {
+            "precision": config.compute_type,
+            "num_threads": config.cpu_threads,
+        }
+    elif config.backend == "onnx":
+        _warn_ignored(config, ["decoding"])
+        from .transcriber_onnx import build_session_options
+        # onnx backend の GPU は DirectML (共通設定の cuda も GPU として扱う)
+        devices = {"cpu": "cpu", "gpu": "gpu", "cuda": "gpu"}
+        if config.device not in devices:
+            raise ValueError(
+                f"[{config.name}] Unsupported device for backend 'onnx': {config.device} (expected one of {list(devices)})"
+            )
+        kwargs = {
+            "device": devices[config.device],
+            "compute_type": config.compute_type or "float32",
+            "session_options": build_session_options(intra_op_threads=config.cpu_threads),
+        }
+        if config.model:
+            kwargs["model_size"] = config.model
+    else:
+        # カスタムbackendには model と options のみ渡す
+        _warn_ignored(config, ["device", "compute_type", "cpu_threads", "decoding"])
+        kwargs = {"model_size": config.model} if config.model else {}
+    kwargs.update(config.options)
+    return {k: v for k, v in kwargs.items() if v is not None}
+
+
+def build_transcriber(config: DeploymentConfig):
+    """設定からTranscriberインスタンスを1つ生成"""
+    cls = _import_backend(config.backend)
+    kwargs = _backend_kwargs(config)
+
+    # コンストラクタが受け付けない引数は警告して除外する
+    params = inspect.signature(cls).parameters
+    if not any(p.kind == p.VAR_KEYWORD for p in params.values()):
+        unsupported = [k for k in kwargs if k not in params]
+        for k in unsupported:
+            logger.warning(f"[{config.name}] '{k}' is not supported by {cls.__name__}, ignoring")
+            kwargs.pop(k)
+
+    return cls(**kwargs)
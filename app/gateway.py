@@ -0,0 +1,321 @@
+"""
+ゲートウェイ - 複数の WhisperServer インスタンスへの負荷分散プロキシ
+各バックエンドの /health から提供モデルと待ち行列の状況を取得し、未処理の作業量 (音声秒数) が
+最も少ないバックエンドへリクエストを転送する。アップロードはバッファリングせずにそのまま流す
+"""
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from .audio import estimate_duration
+from .scheduler import DEFAULT_JOB_COST
+from .access_log import setup_logging
+
+setup_logging()
+logger = logging.getLogger("gateway")
+# リクエストごとの httpx のログは出さない
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# 転送しないヘッダー (hop-by-hop)
+_HOP_BY_HOP = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host",
+}
+
+
+class Backend:
+    """転送先の WhisperServer 1台分の状態"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.status: Optional[str] = None
+        self.models: Dict[str, Dict[str, Any]] = {}
+        self.aliases: Dict[str, str] = {}
+        self.default_model: Optional[str] = None
+        # このゲートウェイから転送して応答が完了していない作業量 (モデルごとの推定音声秒数)
+        self.outstanding: Dict[str, float] = {}
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+
+    def resolve(self, deployment_id: str) -> Optional[str]:
+        """デプロイメント名・エイリアスからこのバックエンドのモデル名を取得 (未提供なら None)"""
+        if deployment_id in self.models:
+            return deployment_id
+        model = self.aliases.get(deployment_id.lower())
+        return model if model in self.models else None
+
+    def load(self, model: str) -> float:
+        """同時実行枠あたりの未処理の作業量 (音声秒数)"""
+        info = self.models.get(model, {})
+        queue = info.get("queue", {})
+        reported = queue.get("queued_audio_seconds", 0.0) + queue.get("running_audio_seconds", 0.0)
+        # /health の取得以降に転送した分はまだ反映されていないため、手元の集計と大きい方を使う
+        work = max(reported, self.outstanding.get(model, 0.0))
+        return work / max(info.get("max_concurrency") or 1, 1)
+
+    def update(self, health: Dict[str, Any], ok: bool):
+        self.healthy = ok
+        self.status = health.get("status")
+        self.models = health.get("available_models", {})
+        self.aliases = health.get("model_aliases", {})
+        self.default_model = health.get("default_model")
+        self.failures = 0
+        self.last_error = None
+        self.checked_at = time.time()
+
+    def mark_down(self, error: str):
+        if self.healthy:
+            logger.warning(f"Backend {self.url} is down: {error}")
+        self.healthy = False
+        self.failures += 1
+        self.last_error = error
+        self.checked_at = time.time()
+
+    def add_work(self, model: str, cost: float):
+        self.outstanding[model] = self.outstanding.get(model, 0.0) + cost
+
+    def remove_work(self, model: str, cost: float):
+        self.outstanding[model] = max(self.outstanding.get(model, 0.0) - cost, 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "status": self.status,
+            "models": {m: round(self.load(m), 1) for m in self.models},
+            "outstanding_audio_seconds": {m: round(v, 1) for m, v in self.outstanding.items() if v},
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "checked_at": self.checked_at,
+        }
+
+
+class Gateway:
+    """バックエンドのヘルスチェックとリクエストの転送"""
+
+    def __init__(self, urls: List[str], health_interval: float = 2.0, connect_timeout: float = 5.0):
+        if not urls:
+            raise ValueError("Gateway requires at least one backend URL")
+        self.backends = [Backend(url) for url in urls]
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._poller: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # 文字起こしは長時間かかるため、接続以外のタイムアウトは設けない
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=self.connect_timeout))
+        await self.check_all()
+        self._poller = asyncio.create_task(self._poll_loop())
+        logger.info(f"Gateway backends: {[(b.url, b.healthy) for b in self.backends]}")
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def check(self, backend: Backend):
+        """/health を取得して状態を更新 (シャットダウン中の 503 は受付不可として扱う)"""
+        try:
+            response = await self._client.get(f"{backend.url}/health", timeout=self.connect_timeout)
+            if response.status_code not in (200, 503):
+                raise RuntimeError(f"/health returned {response.status_code}")
+            was_healthy = backend.healthy
+            backend.update(response.json(), ok=response.status_code == 200)
+            if backend.healthy and not was_healthy:
+                logger.info(f"Backend {backend.url} is up: models={list(backend.models)}")
+        except Exception as e:
+            backend.mark_down(str(e) or type(e).__name__)
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(b) for b in self.backends))
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_all()
+
+    def candidates(self, deployment_id: str) -> List[Tuple[Backend, str]]:
+        """転送先の候補を作業量の少ない順に返す"""
+        healthy = [b for b in self.backends if b.healthy]
+        candidates = [(b, b.resolve(deployment_id)) for b in healthy]
+        candidates = [(b, m) for b, m in candidates if m is not None]
+        if not candidates:
+            # どのバックエンドも提供していない名前は、各バックエンドの既定モデルで処理される
+            candidates = [(b, b.default_model) for b in healthy if b.default_model in b.models]
+        return sorted(candidates, key=lambda c: c[0].load(c[1]))
+
+    async def proxy(self, request: Request, deployment_id: str):
+        """リクエストを作業量の最も少ないバックエンドへ転送"""
+        candidates = self.candidates(deployment_id)
+        if not candidates:
+            return _error(503, "ServiceUnavailable", f"No backend available for '{deployment_id}'.")
+
+        # 転送前に音声長は分からないため、サイズから作業量を見積もる
+        size = request.headers.get("content-length")
+        cost = estimate_duration(int(size)) if size and size.isdigit() else DEFAULT_JOB_COST
+
+        headers = [(k, v) for k, v in request.headers.items() if k.lower() not in _HOP_BY_HOP]
+        if request.client is not None:
+            headers.append(("x-forwarded-for", request.client.host))
+        path = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+
+        body_started = False
+        body_done = asyncio.Event()
+
+        async def body():
+            nonlocal body_started
+            async for chunk in request.stream():
+                body_started = True
+                yield chunk
+            body_done.set()
+
+        last_error = None
+        for backend, model in candidates:
+            upstream = self._client.build_request(
+                request.method, backend.url + path, headers=headers, content=body()
+            )
+            backend.add_work(model, cost)
+            try:
+                response = await self._send(request, upstream, body_done)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                backend.remove_work(model, cost)
+                backend.mark_down(str(e) or type(e).__name__)
+                last_error = e
+                if body_started:
+                    break
+                # 本文の送信前に接続できなかった場合は次のバックエンドへ
+                logger.warning(f"Failing over from {backend.url}: {e}")
+                continue
+            except httpx.HTTPError as e:
+                backend.remove_work(model, cost)
+                backend.mark_down(str(e) or type(e).__name__)
+                last_error = e
+                break
+            except BaseException:
+                backend.remove_work(model, cost)
+                raise
+
+            if response is None:
+                # 応答待ちの間にクライアントが切断した (転送先への接続を閉じて推論を中断させる)
+                backend.remove_work(model, cost)
+                return _error(499, "ClientDisconnected", "Client disconnected.")
+
+            if response.status_code == 503:
+                # シャットダウン中などの受付不可 (次回のヘルスチェックを待たずに状態を更新する)
+                asyncio.create_task(self.check(backend))
+
+            async def finish(response=response, backend=backend, model=model):
+                await response.aclose()
+                backend.remove_work(model, cost)
+
+            response_headers = {k: v for k, v in response.headers.items() if k.lower() not in _HOP_BY_HOP}
+            response_headers["x-whisper-backend"] = backend.url
+            return StreamingResponse(
+                response.aiter_raw(),
+                status_code=response.status_code,
+                headers=response_headers,
+                background=BackgroundTask(finish)
+            )
+
+        logger.error(f"Proxy to backends failed for '{deployment_id}': {last_error}")
+        return _error(502, "BadGateway", f"Backend request failed: {last_error}")
+
+    async def _send(self, request: Request, upstream: httpx.Request, body_done: asyncio.Event):
+        """転送して応答ヘッダーを待つ (本文の送信完了後にクライアントが切断した場合は None)"""
+        send = asyncio.ensure_future(self._client.send(upstream, stream=True))
+        watcher = asyncio.ensure_future(_wait_disconnect(request, body_done))
+        try:
+            await asyncio.wait({send, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+        if send.done():
+            return send.result()
+        send.cancel()
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "status": "ok" if any(b.healthy for b in self.backends) else "unavailable",
+            "backends": [b.stats() for b in self.backends],
+        }
+
+
+async def _wait_disconnect(request: Request, body_done: asyncio.Event):
+    """クライアントの切断を待つ (本文の読み取りと競合しないよう、送信完了後から監視する)"""
+    await body_done.wait()
+    while not await request.is_disconnected():
+        await asyncio.sleep(0.5)
+
+
+def _error(status_code: int, code: str, message: str) -> JSONResponse:
+    return JSONResponse(status_code=status_code, content={"error": {"code": code, "message": message}})
+
+
+# グローバルゲートウェイ
+_gateway: Optional[Gateway] = None
+
+def get_gateway() -> Gateway:
+    """環境変数 WHISPER_GATEWAY_BACKENDS (カンマ区切りのURL) からゲートウェイを生成"""
+    global _gateway
+    if _gateway is None:
+        urls = [u.strip() for u in os.getenv("WHISPER_GATEWAY_BACKENDS", "").split(",") if u.strip()]
+        _gateway = Gateway(urls, health_interval=float(os.getenv("GATEWAY_HEALTH_INTERVAL", "2")))
+    return _gateway
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    gateway = get_gateway()
+    await gateway.start()
+    yield
+    await gateway.close()
+
+
+app = FastAPI(
+    title="WhisperServer Gateway",
+    description="Load-balancing gateway for WhisperServer instances",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+
+@app.post("/openai/deployments/{deployment_id}/audio/{operation:path}")
+async def proxy_audio(deployment_id: str, operation: str, request: Request):
+    """文字起こし API (単体・バッチ) をバックエンドへ転送"""
+    return await get_gateway().proxy(request, deployment_id)
+
+
+@app.get("/health")
+async def health_check():
+    """ゲートウェイとバックエンドの状態 (利用可能なバックエンドが無ければ 503)"""
+    gateway = get_gateway()
+    content = gateway.stats()
+    models = sorted({m for b in gateway.backends if b.healthy for m in b.models})
+    content["available_models"] = models
+    if content["status"] != "ok":
+        return JSONResponse(status_code=503, content=content)
+    return content
+
+
+@app.get("/")
+async def root():
+    return {
+        "service": "WhisperServer Gateway",
+        "backends": [b.url for b in get_gateway().backends],
+        "endpoints": {
+            "transcription": "/openai/deployments/{model}/audio/transcriptions",
+            "health": "/health",
+        },
+    }
@@ -0,0 +1,65 @@
+"""
+サーバーローカルのファイル入力
+ASR サーバーとファイルシステムを共有するクライアントが、音声をアップロードせずにパスで指定できるようにする
+指定できるのは環境変数 LOCAL_INPUT_DIRS (os.pathsep 区切り) に列挙したディレクトリ配下のファイルのみ
+"""
+import os
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger("local-input")
+
+
+class LocalInputError(Exception):
+    """パス指定の入力を受け付けられない (status_code は API が返す HTTP ステータス)"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LocalInputResolver:
+    """許可ディレクトリ配下のパスのみを実体パスに解決する"""
+
+    def __init__(self, allowed_dirs: List[str]):
+        # シンボリックリンクを解決した実体パスで比較する (リンクで許可ディレクトリの外を指すのを防ぐ)
+        self.allowed_dirs = [os.path.realpath(d) for d in allowed_dirs]
+        logger.info(f"Local file input enabled: {self.allowed_dirs}")
+
+    def resolve(self, file_path: str) -> str:
+        """
+        クライアントが指定したパスを検証し、実体パスを返す
+        相対パスは最初の許可ディレクトリからの相対パスとして扱う
+        """
+        if not file_path or "\0" in file_path:
+            raise LocalInputError("file_path is empty or invalid.")
+        path = os.path.realpath(os.path.join(self.allowed_dirs[0], file_path))
+        if not any(_is_within(path, d) for d in self.allowed_dirs):
+            raise LocalInputError(f"file_path is outside the allowed directories: {file_path}", 403)
+        if not os.path.isfile(path):
+            raise LocalInputError(f"File not found: {file_path}", 404)
+        if not os.access(path, os.R_OK):
+            raise LocalInputError(f"File is not readable: {file_path}", 403)
+        return path
+
+
+def _is_within(path: str, directory: str) -> bool:
+    try:
+        return os.path.commonpath([os.path.normcase(path), os.path.normcase(directory)]) == os.path.normcase(directory)
+    except ValueError:
+        # Windows で異なるドライブのパス
+        return False
+
+
+# グローバルリゾルバー (LOCAL_INPUT_DIRS 未設定時は None = パス指定は無効)
+_resolver: Optional[LocalInputResolver] = None
+_resolver_loaded = False
+
+def get_local_input_resolver() -> Optional[LocalInputResolver]:
+    global _resolver, _resolver_loaded
+    if not _resolver_loaded:
+        _resolver_loaded = True
+        dirs = [d for d in os.getenv("LOCAL_INPUT_DIRS", "").split(os.pathsep) if d.strip()]
+        if dirs:
+            _resolver = LocalInputResolver(dirs)
+    return _resolver
@@ -3,22 +3,36 @@ Azure OpenAI Whisper API 互換サーバー
 マルチモデル対応版 (Kotoba-Whisper + ReazonSpeech)
 """
 import os
+import time
+import asyncio
 import logging
+import functools
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import Optional, Dict, Any, List, Tuple, Union, BinaryIO, Sequence
 
-from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, Depends, Body, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.exceptions import RequestValidationError
+from starlette.background import BackgroundTask
+from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from .model_registry import get_registry, MODEL_ALIASES
-from .transcriber import WhisperTranscriber
-from .reazonspeech_transcriber import ReazonSpeechTranscriber
-
-# ロギング設定
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+from .model_registry import get_registry
+from .cancellation import CancellationToken, RequestCancelled, CLIENT_DISCONNECTED, DEADLINE_EXCEEDED
+from .deployment_config import load_server_config
+from .batch import expand_inputs, probe_durations, transcribe_batch
+from .tenants import get_tenant_registry, Tenant, QuotaExceeded
+from .audio import probe_duration
+from .capture import get_traffic_capture
+from .audio_cache import get_audio_cache
+from .local_input import get_local_input_resolver, LocalInputError
+from .access_log import setup_logging, get_access_log, request_record
+from .response_format import (
+    TEXT_FORMATS, validate_response_format, parse_segment_fields, backend_options, finalize, dumps, iter_json
 )
+
+# ロギング設定 (書き込みは別スレッドで行い、リクエストの処理をブロックしない)
+setup_logging()
 logger = logging.getLogger("whisper-api")
 
 
@@ -31,24 +45,19 @@ async def lifespan(app: FastAPI):
     
     registry = get_registry()
     
-    # Kotoba-Whisper をロード
-    try:
-        logger.info("Loading Kotoba-Whisper (faster-whisper)...")
-        kotoba = WhisperTranscriber(
-            model_size=os.getenv("WHISPER_MODEL", "RoachLin/kotoba-whisper-v2.2-faster"),
-            use_gpu=os.getenv("USE_GPU", "0") == "1"
-        )
-        registry.register("kotoba-whisper", kotoba)
-    except Exception as e:
-        logger.error(f"Failed to load Kotoba-Whisper: {e}")
-    
-    # ReazonSpeech をロード
+    # 設定ファイル (WHISPER_SERVER_CONFIG) または環境変数からデプロイメントをロード
     try:
-        logger.info("Loading ReazonSpeech (k2-asr)...")
-        reazon = ReazonSpeechTranscriber()
-        registry.register("reazonspeech", reazon)
+        config = load_server_config()
     except Exception as e:
-        logger.warning(f"ReazonSpeech not available: {e}")
+        logger.error(f"Invalid deployment config: {e}")
+        raise
+    get_tenant_registry().load(config.tenants, allow_unknown_keys=config.allow_unknown_keys)
+    registry.load_config(config)
+    if os.getenv("STARTUP_WARM_UP", "0") == "1":
+        await registry.warm_up()
+    access_log = get_access_log()
+    if access_log is not None:
+        access_log.start()
     
     logger.info("=" * 50)
     logger.info(f"Available models: {registry.available_models}")
@@ -57,6 +66,10 @@ async def lifespan(app: FastAPI):
     yield
     
     logger.info("Shutting down ASR Server...")
+    await registry.shutdown(timeout=float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30")))
+    if access_log is not None:
+        access_log.stop()
+    logger.info("Shutdown complete")
 
 
 app = FastAPI(
@@ -67,6 +80,9 @@ app = FastAPI(
 ### 利用可能なモデル
 - **whisper-1** / **kotoba-whisper**: Kotoba-Whisper v2.2 (高精度、日本語特化)
 - **reazonspeech** / **reazonspeech-k2**: ReazonSpeech K2 (超高速、159Mパラメータ)
+- **whisper-onnx**: Whisper (ONNX Runtime CPU、`ONNX_WHISPER_MODEL` 指定時のみ)
+- **whisper-onnx-int8**: Whisper (ONNX Runtime CPU INT8、`ONNX_WHISPER_INT8=1` 指定時のみ)
+- 設定ファイル (`WHISPER_SERVER_CONFIG`) を指定した場合は、そこに定義したデプロイメントとエイリアス
 
 ### 使用例
 ```
@@ -79,76 +95,428 @@ POST /openai/deployments/reazonspeech/audio/transcriptions   # ReazonSpeech
 )
 
 
-async def verify_api_key(api_key: Optional[str] = Header(None, alias="api-key")):
-    """Azure OpenAI互換のAPIキー認証 (ローカル用: 空でなければOK)"""
+async def verify_api_key(request: Request, api_key: Optional[str] = Header(None, alias="api-key")) -> Tenant:
+    """
+    Azure OpenAI互換のAPIキー認証
+    キーに対応するテナントを返す (テナント未設定時・未登録キー許可時は default テナント)
+    """
     if not api_key:
         raise HTTPException(
             status_code=401,
             detail={"error": {"code": "401", "message": "Missing api-key header."}}
         )
+    tenant = get_tenant_registry().resolve(api_key)
+    if tenant is None:
+        raise HTTPException(
+            status_code=401,
+            detail={"error": {"code": "401", "message": "Invalid api-key."}}
+        )
+    # 受付前に拒否された場合のアクセスログ用
+    request.state.tenant = tenant
+    return tenant
+
+
+def _record_rejection(request: Request, status_code: int):
+    """文字起こしAPIで推論の前に拒否したリクエスト (401 / 400 / 429 / 503 等) をアクセスログに記録"""
+    access_log = get_access_log()
+    if access_log is None or "/audio/transcriptions" not in request.url.path:
+        return
+    tenant = getattr(request.state, "tenant", None)
+    access_log.record(request_record(
+        request.url.path.rsplit("/audio/", 1)[-1], request.path_params.get("deployment_id"), None,
+        tenant.name if tenant is not None else None, status_code, None, {}
+    ))
+
+
+@app.exception_handler(StarletteHTTPException)
+async def _http_exception_handler(request: Request, exc: StarletteHTTPException):
+    _record_rejection(request, exc.status_code)
+    return await http_exception_handler(request, exc)
+
+
+@app.exception_handler(RequestValidationError)
+async def _validation_exception_handler(request: Request, exc: RequestValidationError):
+    _record_rejection(request, 422)
+    return await request_validation_exception_handler(request, exc)
+
+
+def _admit(tenant: Tenant, requests: int, audio_seconds: float):
+    """テナントのレート制限を確認 (超過時は 429)"""
+    try:
+        tenant.admit(requests=requests, audio_seconds=audio_seconds)
+    except QuotaExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"error": {"code": "429", "message": str(e)}},
+            headers={"Retry-After": str(max(1, int(e.retry_after + 0.999)))}
+        )
+
+
+def _get_deployment(deployment_id: str):
+    """受付可否を確認してデプロイメントを取得 (シャットダウン中・モデル未ロード時は 503)"""
+    registry = get_registry()
+    if not registry.accepting:
+        raise HTTPException(
+            status_code=503,
+            detail={"error": {"code": "ServiceUnavailable", "message": "Server is shutting down."}},
+            headers={"Retry-After": "1"}
+        )
+    try:
+        return registry.get(deployment_id)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+async def _watch_disconnect(request: Request, token: CancellationToken):
+    """クライアント切断を監視し、切断されたらトークンをキャンセル"""
+    while not token.cancelled:
+        if await request.is_disconnected():
+            token.cancel(CLIENT_DISCONNECTED)
+            return
+        await asyncio.sleep(0.5)
+
+
+@asynccontextmanager
+async def _cancellation_scope(request: Request, timeout_ms: Optional[float]):
+    """リクエスト単位のキャンセルトークン (期限ヘッダー + クライアント切断)"""
+    token = CancellationToken(timeout=timeout_ms / 1000 if timeout_ms is not None else None)
+    watcher = asyncio.create_task(_watch_disconnect(request, token))
+    try:
+        yield token
+    finally:
+        watcher.cancel()
+        token.close()
+
+
+def _cancelled_response(e: RequestCancelled) -> JSONResponse:
+    if e.reason == DEADLINE_EXCEEDED:
+        return JSONResponse(
+            status_code=504,
+            content={"error": {"code": "DeadlineExceeded", "message": "Request deadline exceeded."}}
+        )
+    # クライアントは切断済みのため、ステータスはログ用 (499: Client Closed Request)
+    return JSONResponse(
+        status_code=499,
+        content={"error": {"code": "ClientClosedRequest", "message": "Client disconnected."}}
+    )
+
+
+async def verify_admin_key(api_key: Optional[str] = Header(None, alias="api-key")):
+    """管理API用の認証 (ADMIN_API_KEY と一致する場合のみ許可、未設定時は無効)"""
+    admin_key = os.getenv("ADMIN_API_KEY")
+    if not admin_key:
+        raise HTTPException(
+            status_code=403,
+            detail={"error": {"code": "403", "message": "Admin API is disabled. Set ADMIN_API_KEY to enable it."}}
+        )
+    if api_key != admin_key:
+        raise HTTPException(
+            status_code=401,
+            detail={"error": {"code": "401", "message": "Invalid admin api-key."}}
+        )
     return api_key
 
 
+def _resolve_local_path(file_path: str) -> str:
+    """file_path (サーバーローカルのパス) を許可ディレクトリ内の実体パスに解決"""
+    resolver = get_local_input_resolver()
+    if resolver is None:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": {"code": "400", "message": "Local file input is disabled. Set LOCAL_INPUT_DIRS to enable it."}}
+        )
+    try:
+        return resolver.resolve(file_path)
+    except LocalInputError as e:
+        raise HTTPException(status_code=e.status_code, detail={"error": {"code": str(e.status_code), "message": str(e)}})
+
+
+def _resolve_input(file: Optional[UploadFile], file_path: Optional[str]) -> Tuple[Union[str, BinaryIO], str]:
+    """アップロードされたファイル または file_path のどちらか一方を (入力, ファイル名) として返す"""
+    if (file is None) == (file_path is None):
+        raise HTTPException(
+            status_code=400,
+            detail={"error": {"code": "400", "message": "Specify exactly one of file or file_path."}}
+        )
+    if file is not None:
+        return file.file, file.filename
+    return _resolve_local_path(file_path), file_path
+
+
+def _parse_format(response_format: Optional[str], segment_fields: Optional[str]) -> Tuple[str, Optional[Sequence[str]]]:
+    """response_format と segment_fields を検証 (不正な値は 400)"""
+    try:
+        return validate_response_format(response_format), parse_segment_fields(segment_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": {"code": "400", "message": str(e)}})
+
+
+async def _encode_response(content: Any, response_format: Optional[str] = None) -> Response:
+    """
+    結果をレスポンスに変換 (JSON のエンコードはイベントループの外で行う)
+    セグメント数が RESPONSE_STREAM_SEGMENTS (既定: 1000) を超える verbose_json は分割して送信する
+    """
+    if response_format in TEXT_FORMATS:
+        return Response(content=content, media_type=TEXT_FORMATS[response_format])
+    segments = content.get("segments") if isinstance(content, dict) else None
+    if segments and len(segments) > int(os.getenv("RESPONSE_STREAM_SEGMENTS", "1000")):
+        # 同期イテレータは Starlette がスレッドプールで実行する
+        return StreamingResponse(iter_json(content), media_type="application/json")
+    body = await asyncio.get_running_loop().run_in_executor(None, dumps, content)
+    return Response(content=body, media_type="application/json")
+
+
 @app.post("/openai/deployments/{deployment_id}/audio/transcriptions")
 async def create_transcription(
     deployment_id: str,
-    file: UploadFile = File(...),
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    file_path: Optional[str] = Form(None),
     language: Optional[str] = Form(None),
     prompt: Optional[str] = Form(None),
     response_format: Optional[str] = Form("json"),
-    api_key: str = Depends(verify_api_key)
+    segment_fields: Optional[str] = Form(None),
+    request_timeout_ms: Optional[float] = Header(None, alias="x-request-timeout-ms"),
+    tenant: Tenant = Depends(verify_api_key)
 ):
     """
     音声ファイルを文字起こし (Azure OpenAI Whisper API 互換)
     
     - **deployment_id**: モデル選択 (`whisper-1`, `kotoba-whisper`, `reazonspeech`, `reazonspeech-k2`)
     - **file**: 音声ファイル (mp3, wav, m4a, etc.)
+    - **file_path**: `file` の代わりにサーバー上の音声ファイルのパスを指定 (LOCAL_INPUT_DIRS 配下のみ。WAV / raw PCM は mmap で読み込む)
     - **language**: 言語コード (ja, en, etc.) - Kotoba-Whisperのみ有効
-    - **response_format**: `json` または `verbose_json`
+    - **response_format**: `json`, `verbose_json`, `text`, `srt`, `vtt`
+    - **segment_fields**: verbose_json のセグメントに含める項目 (カンマ区切り。`-tokens` のように `-` を付けると除外)
+    - **x-request-timeout-ms** (ヘッダー): 受付からの処理期限。超過すると待機中なら破棄、実行中なら中断して 504 を返す
     """
-    registry = get_registry()
+    deployment = _get_deployment(deployment_id)
+    # リロードで旧デプロイメントが閉じられた後も参照できるよう、モデル名は推論前に取得しておく
+    model = deployment.model_size
+    source, filename = _resolve_input(file, file_path)
+    response_format, fields = _parse_format(response_format, segment_fields)
+    arrival = time.time()
+    start = time.perf_counter()
+    timings: Dict[str, float] = {}
     
-    try:
-        transcriber = registry.get(deployment_id)
-    except RuntimeError as e:
-        raise HTTPException(status_code=503, detail=str(e))
+    # 音声長をヘッダーから取得し、レート制限と短いジョブを優先するスケジューリングに使う
+    if file is not None:
+        await file.seek(0)
+    duration = await asyncio.get_running_loop().run_in_executor(None, probe_duration, source)
+    timings["probe"] = time.perf_counter() - start
+    _admit(tenant, 1, duration or 0.0)
+    
+    capture = get_traffic_capture()
+    captured = capture is not None and capture.sample()
+    response: Optional[Response] = None
+    text: Optional[str] = None
+    
+    def transcribe(transcriber):
+        # 待ち行列での待機時間と推論時間を分けて計測
+        begin = time.perf_counter()
+        timings["queue"] = begin - start - timings["probe"]
+        try:
+            result = transcriber.transcribe(
+                audio_path=source,
+                language=language or "ja",
+                prompt=prompt,
+                cancel_token=token,
+                **backend_options(transcriber, response_format, fields)
+            )
+            return finalize(result, response_format, fields)
+        finally:
+            timings["inference"] = time.perf_counter() - begin
     
     try:
-        await file.seek(0)
+        # 推論はデプロイメントのワーカースレッドで実行 (イベントループをブロックしない)
+        async with _cancellation_scope(request, request_timeout_ms) as token:
+            result = await deployment.run(transcribe, cancel_token=token, cost=duration, tenant=tenant)
         
-        logger.info(
-            f"Request: model={deployment_id} -> {transcriber.model_size}, "
-            f"file={file.filename}, language={language}"
-        )
-        
-        result = transcriber.transcribe(
-            audio_path=file.file,
-            language=language or "ja",
-            prompt=prompt,
-            response_format=response_format
-        )
-        
-        logger.info(f"Result: {result.get('text', '')[:80]}...")
-        return JSONResponse(content=result)
+        text = result if isinstance(result, str) else result.get("text", "")
+        response = await _encode_response(result, response_format)
         
+    except RequestCancelled as e:
+        response = _cancelled_response(e)
     except Exception as e:
         logger.error(f"Transcription error: {e}", exc_info=True)
-        return JSONResponse(
+        response = JSONResponse(
             status_code=500,
             content={"error": {"code": "InternalServerError", "message": str(e)}}
         )
+    finally:
+        status_code = response.status_code if response is not None else 500
+        timings["total"] = time.perf_counter() - start
+        access_log = get_access_log()
+        if access_log is not None:
+            access_log.record(request_record(
+                "transcriptions", deployment_id, model, tenant.name, status_code,
+                duration, timings, language=language, response_format=response_format
+            ), text=text)
+    
+    if captured:
+        # 音声の読み直し・ハッシュ計算・書き込みはレスポンスの送信後に行う (記録対象のリクエストを遅らせない)
+        response.background = BackgroundTask(capture.record, source, {
+            "arrival": arrival,
+            "deployment_id": deployment_id,
+            "filename": os.path.basename(filename),
+            "audio_seconds": duration,
+            "language": language,
+            "prompt": prompt,
+            "response_format": response_format,
+            "segment_fields": segment_fields,
+            "request_timeout_ms": request_timeout_ms,
+            "tenant": tenant.name,
+            "status": status_code,
+            "timings": {k: round(v, 4) for k, v in timings.items()},
+        })
+    return response
+
+
+@app.post("/openai/deployments/{deployment_id}/audio/transcriptions/batch")
+async def create_batch_transcription(
+    deployment_id: str,
+    request: Request,
+    file: Optional[List[UploadFile]] = File(None),
+    file_path: Optional[List[str]] = Form(None),
+    language: Optional[str] = Form(None),
+    prompt: Optional[str] = Form(None),
+    response_format: Optional[str] = Form("json"),
+    segment_fields: Optional[str] = Form(None),
+    request_timeout_ms: Optional[float] = Header(None, alias="x-request-timeout-ms"),
+    tenant: Tenant = Depends(verify_api_key)
+):
+    """
+    複数の音声ファイルをまとめて文字起こし
+    
+    - **file**: 音声ファイル (複数指定可)、または音声ファイルをまとめた zip / tar アーカイブ
+    - **file_path**: サーバー上のファイルのパス (複数指定可、LOCAL_INPUT_DIRS 配下のみ)。`file` の後に続けて処理する
+    - 結果は入力順 (アーカイブは格納順) に返す。1ファイルの失敗はそのファイルの `error` にのみ記録される
+    - text / srt / vtt を指定した場合、各ファイルの `result` は本文の文字列になる
+    """
+    deployment = _get_deployment(deployment_id)
+    model, batch_size = deployment.model_size, deployment.max_batch_size
+    response_format, fields = _parse_format(response_format, segment_fields)
+    if not file and not file_path:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": {"code": "400", "message": "Specify file or file_path."}}
+        )
+    local = [(path, _resolve_local_path(path)) for path in file_path or []]
+    
+    try:
+        # アーカイブの展開 (解凍・書き出し) はイベントループをブロックしないようワーカースレッドで行う
+        items = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            expand_inputs,
+            [(f.filename, f.file) for f in file or []] + local,
+            max_files=int(os.getenv("BATCH_MAX_FILES", "1000")),
+            max_archive_entries=int(os.getenv("BATCH_MAX_ARCHIVE_ENTRIES", "10000")),
+            max_archive_bytes=int(float(os.getenv("BATCH_MAX_ARCHIVE_MB", "1024")) * 1024 * 1024)
+        ))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch input: {e}")
+    
+    start = time.perf_counter()
+    durations = await probe_durations(items)
+    timings = {"probe": time.perf_counter() - start}
+    _admit(tenant, len(items), sum(d or 0.0 for d in durations))
+    
+    async with _cancellation_scope(request, request_timeout_ms) as token:
+        results = await transcribe_batch(
+            deployment,
+            items,
+            language=language or "ja",
+            prompt=prompt,
+            response_format=response_format,
+            durations=durations,
+            cancel_token=token,
+            tenant=tenant,
+            segment_fields=fields
+        )
+    succeeded = sum(1 for r in results if r["status"] == "succeeded")
+    timings["total"] = time.perf_counter() - start
+    access_log = get_access_log()
+    if access_log is not None:
+        access_log.record(request_record(
+            "transcriptions/batch", deployment_id, model, tenant.name, 200,
+            sum(d or 0.0 for d in durations), timings, language=language, response_format=response_format,
+            files=len(results), failed=len(results) - succeeded, batch_size=batch_size
+        ))
+    return await _encode_response({
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    })
+
+
+@app.post("/admin/deployments/{deployment_name}/reload", status_code=202)
+async def reload_deployment(
+    deployment_name: str,
+    overrides: Dict[str, Any] = Body(default_factory=dict),
+    warm_up: bool = True,
+    drain_timeout: Optional[float] = None,
+    api_key: str = Depends(verify_admin_key)
+):
+    """
+    デプロイメントを無停止で再ロード (モデル・compute_type・スレッド数等の変更)
+    
+    - **overrides**: 現在の設定に上書きする項目 (例: `{"model": "...", "cpu_threads": 8}`)。新規デプロイメントの場合は `backend` も必須
+    - **warm_up**: 差し替え前にウォームアップ推論を行うか
+    - **drain_timeout**: 旧インスタンスの処理中リクエストを待つ最大秒数 (省略時は無制限)
+    """
+    registry = get_registry()
+    
+    overrides.pop("name", None)
+    try:
+        config = registry.resolve_config(deployment_name, overrides)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid deployment config: {e}")
+    
+    try:
+        task = registry.start_reload(deployment_name, config, warm_up=warm_up, drain_timeout=drain_timeout)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    # 失敗はステータスに記録されるため、未取得の例外として警告させない
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    
+    logger.info(f"Reload requested: {deployment_name} {overrides}")
+    return registry.reload_status(deployment_name)
+
+
+@app.get("/admin/deployments/{deployment_name}/reload")
+async def get_reload_status(deployment_name: str, api_key: str = Depends(verify_admin_key)):
+    """再ロードの進行状況 (loading / warming_up / draining / completed / failed)"""
+    status = get_registry().reload_status(deployment_name)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"No reload for '{deployment_name}'")
+    return status
+
+
+@app.get("/admin/tenants")
+async def get_tenant_usage(api_key: str = Depends(verify_admin_key)):
+    """テナントごとの設定・実行中リクエスト数・処理済み音声秒数"""
+    return get_tenant_registry().stats()
 
 
 @app.get("/health")
 async def health_check():
-    """ヘルスチェック & モデル一覧"""
+    """ヘルスチェック & モデル一覧 (シャットダウン中は 503 を返す)"""
     registry = get_registry()
-    return {
-        "status": "ok",
+    content = {
+        "status": "ok" if registry.accepting else "shutting_down",
         "available_models": registry.list_models(),
         "default_model": registry.default_model,
-        "model_aliases": MODEL_ALIASES
+        "model_aliases": registry.aliases
     }
+    cache = get_audio_cache()
+    if cache is not None:
+        content["audio_cache"] = cache.stats()
+    access_log = get_access_log()
+    if access_log is not None:
+        content["access_log"] = access_log.stats()
+    if not registry.accepting:
+        return JSONResponse(status_code=503, content=content)
+    return content
 
 
 @app.get("/")
@@ -162,5 +530,5 @@ async def root():
             "health": "/health",
             "docs": "/docs"
         },
-        "models": ["whisper-1", "reazonspeech"]
+        "models": get_registry().available_models
     }
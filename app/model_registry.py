@@ -1,11 +1,28 @@
 """
 ModelRegistry - 複数モデルの管理
 """
+import asyncio
+import dataclasses
+import gc
+import io
 import logging
-from typing import Dict, Any, Optional, Protocol, Union, BinaryIO
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, Any, Optional, Protocol, Union, BinaryIO, List, Callable, TypeVar, Set
+
+from .deployment_config import DeploymentConfig, ServerConfig, build_transcriber
+from .cancellation import CancellationToken, RequestCancelled, CLIENT_DISCONNECTED, DEADLINE_EXCEEDED
+from .scheduler import JobScheduler, TicketEvicted
+from .tenants import Tenant, measure_audio_seconds
+from .startup_profile import get_startup_profile
 
 logger = logging.getLogger("model-registry")
 
+T = TypeVar("T")
+
+
 class Transcriber(Protocol):
     """Transcriber共通インターフェース"""
     def transcribe(
@@ -13,9 +30,10 @@ class Transcriber(Protocol):
         audio_path: Union[str, BinaryIO],
         language: Optional[str] = None,
         prompt: Optional[str] = None,
-        response_format: str = "json"
+        response_format: str = "json",
+        cancel_token: Optional[CancellationToken] = None
     ) -> Dict[str, Any]: ...
-    
+
     @property
     def model_size(self) -> str: ...
     @property
@@ -26,66 +44,399 @@ class Transcriber(Protocol):
     def is_gpu_enabled(self) -> bool: ...
 
 
-# デプロイメント名とモデルタイプのマッピング
-MODEL_ALIASES = {
-    # Kotoba-Whisper aliases
-    "whisper-1": "kotoba-whisper",
-    "kotoba-whisper": "kotoba-whisper",
-    "kotoba": "kotoba-whisper",
-    
-    # ReazonSpeech aliases
-    "reazonspeech": "reazonspeech",
-    "reazonspeech-k2": "reazonspeech",
-    "reazon": "reazonspeech",
-}
+def _silence_wav(seconds: float = 1.0, sample_rate: int = 16000) -> bytes:
+    """ウォームアップ用の無音WAV (16bit mono)"""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(b"\x00\x00" * int(seconds * sample_rate))
+    return buf.getvalue()
+
+
+class Deployment:
+    """
+    1デプロイメント = 同一設定のTranscriberレプリカ群
+    同時実行数を max_concurrency に制限し、推論は専用スレッドプールで実行する
+    """
+
+    def __init__(self, name: str, replicas: List[Transcriber], config: Optional[DeploymentConfig] = None):
+        if not replicas:
+            raise ValueError(f"Deployment '{name}' has no replicas")
+        self.name = name
+        self.config = config
+        self._replicas = replicas
+        self._replica_load = [0] * len(replicas)
+        self.max_concurrency = config.max_concurrency if config else len(replicas)
+        self.scheduler = JobScheduler(self.max_concurrency, **(config.scheduling if config else {}))
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency,
+            thread_name_prefix=f"asr-{name}"
+        )
+        # 待機中 + 実行中のリクエスト数 (ドレイン判定用)
+        self._inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # 差し替え後の新デプロイメント (退役後に到着したリクエストを転送する)
+        self._successor: Optional["Deployment"] = None
+        # 中断されたリクエスト数 (queued: 待機中に破棄 / running: 推論中に停止)
+        self.stats = {
+            CLIENT_DISCONNECTED: {"queued": 0, "running": 0},
+            DEADLINE_EXCEEDED: {"queued": 0, "running": 0},
+        }
+
+    @classmethod
+    def from_config(cls, config: DeploymentConfig) -> "Deployment":
+        """設定に従ってレプリカをロード"""
+        replicas = []
+        for i in range(config.replicas):
+            logger.info(f"Loading {config.name} replica {i + 1}/{config.replicas} ({config.backend})...")
+            replicas.append(build_transcriber(config))
+        return cls(config.name, replicas, config)
+
+    def _acquire_replica(self) -> int:
+        """実行中リクエストが最も少ないレプリカを選択"""
+        index = min(range(len(self._replicas)), key=lambda i: self._replica_load[i])
+        self._replica_load[index] += 1
+        return index
+
+    async def run(
+        self,
+        fn: Callable[[Transcriber], T],
+        cancel_token: Optional[CancellationToken] = None,
+        cost: Optional[float] = None,
+        tenant: Optional[Tenant] = None
+    ) -> T:
+        """
+        同時実行数の枠を確保し、レプリカ上で fn をワーカースレッドで実行
+        枠の割り当て順はスケジューラが tenant (公平配分) と cost (音声長の秒数) をもとに決める
+        cancel_token がキャンセルされると待機中のジョブは破棄され、実行中のジョブは
+        Transcriber 側が cancel_token を確認した時点で停止する
+        """
+        if self._successor is not None:
+            return await self._successor.run(fn, cancel_token, cost, tenant)
+        
+        self._inflight += 1
+        self._idle.clear()
+        stage = "queued"
+        try:
+            try:
+                ticket = await self.scheduler.acquire(cost, cancel_token, tenant)
+            except TicketEvicted:
+                # 待機中に差し替えられた: finally の後で後継デプロイメントへ転送する
+                ticket = None
+            if ticket is not None:
+                try:
+                    if cancel_token is not None:
+                        cancel_token.check()
+                    stage = "running"
+                    index = self._acquire_replica()
+                    try:
+                        loop = asyncio.get_running_loop()
+                        result, audio_seconds = await loop.run_in_executor(
+                            self._executor, measure_audio_seconds, fn, self._replicas[index]
+                        )
+                    finally:
+                        self._replica_load[index] -= 1
+                    if tenant is not None:
+                        # 利用量は実際の音声の長さで集計 (報告しない backend はスケジューリング用の推定値)
+                        tenant.record(self.name, audio_seconds if audio_seconds is not None else ticket.cost)
+                    return result
+                finally:
+                    self.scheduler.release(ticket)
+        except RequestCancelled as e:
+            self.stats[e.reason][stage] += 1
+            logger.info(f"[{self.name}] Request cancelled while {stage}: {e.reason}")
+            raise
+        finally:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._idle.set()
+        return await self._successor.run(fn, cancel_token, cost, tenant)
+
+    async def warm_up(self):
+        """全レプリカで短い無音を推論し、初回リクエストの遅延 (遅延初期化・メモリ確保) を解消"""
+        loop = asyncio.get_running_loop()
+        audio = _silence_wav()
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            loop.run_in_executor(self._executor, lambda t=t: t.transcribe(io.BytesIO(audio)))
+            for t in self._replicas
+        ])
+        logger.info(f"Warmed up {self.name} in {time.perf_counter() - start:.2f}s")
+
+    def retire(self, successor: "Deployment"):
+        """以降のリクエストと、待機中のリクエストを後継デプロイメントへ転送する"""
+        self._successor = successor
+        forwarded = self.scheduler.evict_waiting()
+        if forwarded:
+            logger.info(f"[{self.name}] Forwarding {forwarded} queued requests to the new deployment")
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """処理中のリクエストが全て終わるまで待機 (タイムアウト時は False)"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close_when_idle(self):
+        """実行中のリクエストが全て終わってからモデルを解放 (ドレインがタイムアウトした場合)"""
+        await self._idle.wait()
+        self.close()
 
-DEFAULT_MODEL = "kotoba-whisper"
+    def close(self):
+        """ワーカースレッドを停止し、モデルを解放"""
+        self._executor.shutdown(wait=False)
+        self._replicas = []
+        gc.collect()
+        logger.info(f"Released deployment: {self.name}")
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    @property
+    def primary(self) -> Transcriber:
+        return self._replicas[0]
+
+    @property
+    def model_size(self) -> str:
+        return self.primary.model_size
+
+    @property
+    def device(self) -> str:
+        return self.primary.device
+
+    @property
+    def compute_type(self) -> str:
+        return self.primary.compute_type
+
+    @property
+    def replica_count(self) -> int:
+        return len(self._replicas)
+
+    @property
+    def max_batch_size(self) -> int:
+        """1回の推論にまとめられるファイル数 (transcribe_batch 非対応なら 1)"""
+        if not hasattr(self.primary, "transcribe_batch"):
+            return 1
+        return self.config.max_batch_size if self.config else 1
 
 
 class ModelRegistry:
     """複数モデルを管理するレジストリ"""
-    
+
     def __init__(self):
-        self._models: Dict[str, Transcriber] = {}
-        self._default_model = DEFAULT_MODEL
-    
-    def register(self, model_type: str, transcriber: Transcriber):
-        """モデルを登録"""
+        self._models: Dict[str, Deployment] = {}
+        self._aliases: Dict[str, str] = {}
+        self._default_model: Optional[str] = None
+        self._reload_status: Dict[str, Dict[str, Any]] = {}
+        # ドレインがタイムアウトし、実行中のリクエストの完了後に解放する旧デプロイメント
+        self._retired: Set["asyncio.Task"] = set()
+        self._accepting = True
+
+    def load_config(self, config: ServerConfig):
+        """設定ファイルの全デプロイメントをロード (失敗したものはスキップ)"""
+        self._default_model = config.default_deployment
+        profile = get_startup_profile()
+        for deployment_config in config.deployments:
+            try:
+                with profile.stage(f"load {deployment_config.name}") if profile else nullcontext():
+                    deployment = Deployment.from_config(deployment_config)
+            except Exception as e:
+                logger.error(f"Failed to load deployment '{deployment_config.name}': {e}")
+                continue
+            self.register(deployment_config.name, deployment, aliases=deployment_config.aliases)
+
+    async def warm_up(self):
+        """起動時に全デプロイメントを順にウォームアップ (失敗しても起動は続ける)"""
+        profile = get_startup_profile()
+        for name, deployment in list(self._models.items()):
+            try:
+                with profile.stage(f"warm_up {name}") if profile else nullcontext():
+                    await deployment.warm_up()
+            except Exception as e:
+                logger.warning(f"Warm-up failed for {name}: {e}")
+
+    def register(
+        self,
+        model_type: str,
+        transcriber: Union[Deployment, Transcriber],
+        aliases: Optional[List[str]] = None
+    ):
+        """モデルを登録 (単体のTranscriberは1レプリカのデプロイメントとして扱う)"""
+        if not isinstance(transcriber, Deployment):
+            transcriber = Deployment(model_type, [transcriber])
         self._models[model_type] = transcriber
-        logger.info(f"Registered model: {model_type} ({transcriber.model_size})")
-    
-    def get(self, deployment_id: str) -> Transcriber:
+        if aliases is not None:
+            # 再登録時は古いエイリアスを置き換える
+            self._aliases = {k: v for k, v in self._aliases.items() if v != model_type}
+        self._aliases[model_type.lower()] = model_type
+        for alias in aliases or []:
+            self._aliases[alias.lower()] = model_type
+        if self._default_model is None:
+            self._default_model = model_type
+        logger.info(
+            f"Registered model: {model_type} ({transcriber.model_size}, "
+            f"replicas={transcriber.replica_count}, max_concurrency={transcriber.max_concurrency})"
+        )
+
+    def begin_shutdown(self):
+        """新規リクエストの受付を停止 (ヘルスチェックは not-ready を返す)"""
+        if self._accepting:
+            logger.info("Stopped accepting new requests")
+        self._accepting = False
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """全デプロイメントの待機中・実行中リクエストの完了を待つ (タイムアウト時は False)"""
+        deployments = list(self._models.values())
+        results = await asyncio.gather(*[d.drain(timeout) for d in deployments])
+        return all(results)
+
+    async def shutdown(self, timeout: Optional[float] = None):
+        """受付停止 -> 処理中リクエストのドレイン (最大 timeout 秒) -> モデル解放"""
+        self.begin_shutdown()
+        inflight = sum(d.inflight for d in self._models.values())
+        if inflight:
+            logger.info(f"Draining {inflight} in-flight requests (timeout={timeout}s)...")
+        if not await self.drain(timeout):
+            remaining = sum(d.inflight for d in self._models.values())
+            logger.warning(f"Shutdown deadline exceeded, abandoning {remaining} requests")
+        for deployment in self._models.values():
+            deployment.close()
+        self._models.clear()
+
+    @property
+    def accepting(self) -> bool:
+        return self._accepting
+
+    def is_reloading(self, model_type: str) -> bool:
+        status = self._reload_status.get(model_type)
+        return status is not None and status["state"] not in ("completed", "failed")
+
+    def reload_status(self, model_type: str) -> Optional[Dict[str, Any]]:
+        return self._reload_status.get(model_type)
+
+    def resolve_config(self, model_type: str, overrides: Dict[str, Any]) -> DeploymentConfig:
+        """現在の設定に上書き項目を適用した新しい設定を作成"""
+        current = self._models.get(model_type)
+        if current is not None and current.config is not None:
+            if current.config.max_concurrency_from_replicas and "max_concurrency" not in overrides:
+                # 未指定の max_concurrency は新しい replicas から決め直す
+                overrides = {**overrides, "max_concurrency": None}
+            return dataclasses.replace(current.config, **overrides)
+        # 未登録または設定なしで登録されたデプロイメントは全項目の指定が必要
+        return DeploymentConfig(**{"name": model_type, **overrides})
+
+    def start_reload(
+        self,
+        model_type: str,
+        config: DeploymentConfig,
+        warm_up: bool = True,
+        drain_timeout: Optional[float] = None
+    ) -> "asyncio.Task":
+        """
+        新しい設定でデプロイメントをバックグラウンドでロードし、無停止で差し替える
+        1. 新レプリカをロード (別スレッド) -> 2. ウォームアップ -> 3. レジストリを差し替え
+        4. 旧デプロイメントの処理中リクエストの完了を待って解放
+        """
+        if self.is_reloading(model_type):
+            raise RuntimeError(f"Deployment '{model_type}' is already reloading")
+
+        status = {"state": "loading", "config": dataclasses.asdict(config), "started_at": time.time()}
+        self._reload_status[model_type] = status
+        return asyncio.create_task(self._reload(model_type, config, status, warm_up, drain_timeout))
+
+    async def _reload(
+        self,
+        model_type: str,
+        config: DeploymentConfig,
+        status: Dict[str, Any],
+        warm_up: bool,
+        drain_timeout: Optional[float]
+    ):
+        try:
+            loop = asyncio.get_running_loop()
+            new = await loop.run_in_executor(None, Deployment.from_config, config)
+
+            if warm_up:
+                status["state"] = "warming_up"
+                await new.warm_up()
+
+            # 差し替え (イベントループ上で実行されるため、リクエストから見てアトミック)
+            old = self._models.get(model_type)
+            self.register(model_type, new, aliases=config.aliases)
+            logger.info(f"Swapped deployment: {model_type} -> {new.model_size}")
+
+            if old is not None:
+                status["state"] = "draining"
+                old.retire(new)
+                if await old.drain(drain_timeout):
+                    old.close()
+                else:
+                    # 実行中の推論が使っているレプリカ・スレッドプールは、終わるまで解放しない
+                    logger.warning(
+                        f"Drain timeout for old '{model_type}' ({old.scheduler.running} running, "
+                        f"{old.scheduler.queued} queued); releasing it after the running requests finish"
+                    )
+                    task = asyncio.create_task(old.close_when_idle())
+                    self._retired.add(task)
+                    task.add_done_callback(self._retired.discard)
+
+            status["state"] = "completed"
+        except Exception as e:
+            logger.error(f"Reload of '{model_type}' failed: {e}", exc_info=True)
+            status["state"] = "failed"
+            status["error"] = str(e)
+            raise
+        finally:
+            status["finished_at"] = time.time()
+
+    def get(self, deployment_id: str) -> Deployment:
         """デプロイメント名からモデルを取得"""
         # エイリアス解決
-        model_type = MODEL_ALIASES.get(deployment_id.lower(), self._default_model)
-        
+        model_type = self._aliases.get(deployment_id.lower(), self._default_model)
+
         if model_type not in self._models:
             logger.warning(f"Model '{model_type}' not loaded, falling back to default")
             model_type = self._default_model
-        
+
         if model_type not in self._models:
             raise RuntimeError(f"No models available. Requested: {deployment_id}")
-        
+
         return self._models[model_type]
-    
+
     def list_models(self) -> Dict[str, Dict[str, Any]]:
         """利用可能なモデル一覧"""
         result = {}
-        for model_type, transcriber in self._models.items():
+        for model_type, deployment in self._models.items():
             result[model_type] = {
-                "model": transcriber.model_size,
-                "device": transcriber.device,
-                "compute_type": transcriber.compute_type,
-                "aliases": [k for k, v in MODEL_ALIASES.items() if v == model_type]
+                "model": deployment.model_size,
+                "device": deployment.device,
+                "compute_type": deployment.compute_type,
+                "replicas": deployment.replica_count,
+                "max_concurrency": deployment.max_concurrency,
+                "inflight": deployment.inflight,
+                "queue": deployment.scheduler.stats(),
+                "cancelled": deployment.stats[CLIENT_DISCONNECTED],
+                "expired": deployment.stats[DEADLINE_EXCEEDED],
+                "decoding": deployment.config.decoding if deployment.config else {},
+                "aliases": [k for k, v in self._aliases.items() if v == model_type]
             }
         return result
-    
+
+    @property
+    def aliases(self) -> Dict[str, str]:
+        return dict(self._aliases)
+
     @property
     def available_models(self) -> list:
         return list(self._models.keys())
-    
+
     @property
-    def default_model(self) -> str:
+    def default_model(self) -> Optional[str]:
         return self._default_model
 
 
@@ -4,16 +4,34 @@ Sherpa-ONNX バックエンドで高速日本語音声認識
 """
 import logging
 import time
-from typing import Optional, Dict, Any, Union, BinaryIO
+from contextlib import ExitStack
+from typing import Optional, Dict, Any, Union, BinaryIO, List
+
+from .cancellation import CancellationToken
+from .audio import decoded_audio, TARGET_SAMPLE_RATE
+from .tenants import report_audio_seconds
 
 logger = logging.getLogger("reazonspeech-transcriber")
 
+# バッチ推論時に末尾へ付与する無音 (秒)
+_PAD_SECONDS = 0.9
+
 class ReazonSpeechTranscriber:
     """ReazonSpeech K2 (Sherpa-ONNX) バックエンド"""
     
-    def __init__(self):
-        """モデルをロード"""
+    def __init__(self, precision: Optional[str] = None, num_threads: Optional[int] = None):
+        """
+        モデルをロード
+
+        Args:
+            precision: モデル精度 ("fp32", "int8", "int8-fp32")。省略時はライブラリ既定値
+            num_threads: 推論スレッド数。省略時はライブラリ既定値
+        """
         logger.info("Initializing ReazonSpeech-k2-v2...")
+        self._precision = precision or "fp32"
+        
+        # load_model が受け付ける引数のみ渡す (reazonspeech のバージョン差異を吸収)
+        load_kwargs = {"precision": precision, "num_threads": num_threads}
         
         try:
             from reazonspeech.k2.asr import load_model
@@ -24,96 +42,131 @@ class ReazonSpeechTranscriber:
             self.audio_from_path = audio_from_path
             self.audio_from_numpy = audio_from_numpy
             
+            import inspect
+            supported = inspect.signature(load_model).parameters
+            for key in [k for k, v in load_kwargs.items() if v is None or k not in supported]:
+                if load_kwargs[key] is not None:
+                    logger.warning(f"reazonspeech load_model() does not accept '{key}', ignoring")
+                load_kwargs.pop(key)
+            
             load_start = time.time()
-            self.model = self.load_model()
+            self.model = self.load_model(**load_kwargs)
             logger.info(f"✓ ReazonSpeech loaded in {time.time() - load_start:.2f}s")
         except ImportError as e:
             logger.error(f"ReazonSpeech not installed: {e}")
             raise
     
+    def _build_response(self, text: str, num_samples: int, response_format: str) -> Dict[str, Any]:
+        if response_format == "verbose_json":
+            return {
+                "task": "transcribe",
+                "language": "ja",
+                "duration": num_samples / 16000,
+                "text": text.strip(),
+                "segments": []
+            }
+        else:
+            return {"text": text.strip()}
+    
     def transcribe(
         self,
         audio_path: Union[str, BinaryIO],
         language: Optional[str] = "ja",
         prompt: Optional[str] = None,
-        response_format: str = "json"
+        response_format: str = "json",
+        cancel_token: Optional[CancellationToken] = None
     ) -> Dict[str, Any]:
         """
         音声ファイルを文字起こし
         soundfileで高速デコード + 16kHzリサンプリング
+        推論は1回の呼び出しで完了するため、キャンセルはデコード後・推論前に確認する
         """
-        import tempfile
-        import os
-        import numpy as np
-        import soundfile as sf
-        from scipy import signal
-        
         start_total = time.perf_counter()
         
-        # BinaryIOの場合は一時ファイルに書き出す
-        if hasattr(audio_path, 'read'):
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-                tmp.write(audio_path.read())
-                audio_source = tmp.name
-            cleanup_needed = True
-        else:
-            audio_source = audio_path
-            cleanup_needed = False
-        
-        try:
-            # soundfileで高速デコード (libsndfile経由)
-            decode_start = time.perf_counter()
-            try:
-                audio_data, sr = sf.read(audio_source, dtype='float32')
-            except Exception as sf_err:
-                # soundfile失敗時はpydubでフォールバック
-                logger.warning(f"soundfile failed, using pydub fallback: {sf_err}")
-                from pydub import AudioSegment
-                audio_seg = AudioSegment.from_file(audio_source)
-                audio_seg = audio_seg.set_channels(1).set_frame_rate(16000)
-                audio_data = np.array(audio_seg.get_array_of_samples(), dtype=np.float32) / 32768.0
-                sr = 16000
-            
-            # ステレオならモノラルに変換
-            if len(audio_data.shape) > 1:
-                audio_data = audio_data.mean(axis=1)
-            
-            # 16kHzにリサンプリング (ReazonSpeech要求)
-            if sr != 16000:
-                num_samples = int(len(audio_data) * 16000 / sr)
-                audio_data = signal.resample(audio_data, num_samples).astype(np.float32)
-                sr = 16000
-            
+        # デコード結果はプールのバッファ上のビュー (推論が終わるまで with ブロック内で使う)
+        decode_start = time.perf_counter()
+        with decoded_audio(audio_path) as audio_data:
             decode_time = (time.perf_counter() - decode_start) * 1000
+            num_samples = len(audio_data)
             
             # audio_from_numpyでAudioオブジェクト作成
-            audio_obj_start = time.perf_counter()
-            audio = self.audio_from_numpy(audio_data, sr)
-            audio_obj_time = (time.perf_counter() - audio_obj_start) * 1000
+            audio = self.audio_from_numpy(audio_data, TARGET_SAMPLE_RATE)
+            
+            if cancel_token is not None:
+                cancel_token.check()
             
             # 推論
             infer_start = time.perf_counter()
             result = self.rs_transcribe(self.model, audio)
             infer_time = (time.perf_counter() - infer_start) * 1000
+        
+        total_time = (time.perf_counter() - start_total) * 1000
+        logger.debug(f"ReazonSpeech: decode={decode_time:.0f}ms, infer={infer_time:.0f}ms, total={total_time:.0f}ms")
+        
+        text = result.text if hasattr(result, 'text') else str(result)
+        report_audio_seconds(num_samples / TARGET_SAMPLE_RATE)
+        return self._build_response(text, num_samples, response_format)
+    
+    def transcribe_batch(
+        self,
+        audio_paths: List[Union[str, BinaryIO]],
+        language: Optional[str] = "ja",
+        prompt: Optional[str] = None,
+        response_format: str = "json",
+        cancel_token: Optional[CancellationToken] = None
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """
+        複数の音声をまとめて文字起こし
+        Sherpa-ONNX の decode_streams で1回の推論呼び出しにまとめる
+        
+        Returns:
+            入力と同じ順序の結果リスト (デコードに失敗した要素は例外オブジェクト)
+        """
+        start_total = time.perf_counter()
+        results: List[Union[Dict[str, Any], Exception]] = []
+        use_streams = hasattr(self.model, "decode_streams")
+        # 単体推論 (reazonspeech.transcribe) と同様に末尾へ無音を付与して最終トークンを確定させる
+        pad_samples = int(_PAD_SECONDS * TARGET_SAMPLE_RATE) if use_streams else 0
+        
+        with ExitStack() as stack:
+            decoded = []
+            for audio_path in audio_paths:
+                try:
+                    audio_data = stack.enter_context(decoded_audio(audio_path, pad_samples=pad_samples))
+                    decoded.append((len(results), audio_data))
+                    results.append(None)
+                except Exception as e:
+                    logger.warning(f"Failed to decode batch item {len(results)}: {e}")
+                    results.append(e)
             
-            total_time = (time.perf_counter() - start_total) * 1000
-            logger.info(f"ReazonSpeech: decode={decode_time:.0f}ms, infer={infer_time:.0f}ms, total={total_time:.0f}ms")
-            
-            text = result.text if hasattr(result, 'text') else str(result)
+            if not decoded:
+                return results
+            if cancel_token is not None:
+                cancel_token.check()
             
-            if response_format == "verbose_json":
-                return {
-                    "task": "transcribe",
-                    "language": "ja",
-                    "duration": len(audio_data) / 16000,
-                    "text": text.strip(),
-                    "segments": []
-                }
+            infer_start = time.perf_counter()
+            if use_streams:
+                streams = []
+                for _, audio_data in decoded:
+                    stream = self.model.create_stream()
+                    stream.accept_waveform(TARGET_SAMPLE_RATE, audio_data)
+                    streams.append(stream)
+                self.model.decode_streams(streams)
+                texts = [stream.result.text for stream in streams]
             else:
-                return {"text": text.strip()}
-        finally:
-            if cleanup_needed and os.path.exists(audio_source):
-                os.remove(audio_source)
+                texts = []
+                for _, audio_data in decoded:
+                    result = self.rs_transcribe(self.model, self.audio_from_numpy(audio_data, TARGET_SAMPLE_RATE))
+                    texts.append(result.text if hasattr(result, 'text') else str(result))
+            infer_time = (time.perf_counter() - infer_start) * 1000
+            
+            for (index, audio_data), text in zip(decoded, texts):
+                report_audio_seconds((len(audio_data) - pad_samples) / TARGET_SAMPLE_RATE)
+                results[index] = self._build_response(text, len(audio_data) - pad_samples, response_format)
+        
+        total_time = (time.perf_counter() - start_total) * 1000
+        logger.debug(f"ReazonSpeech batch: items={len(audio_paths)}, infer={infer_time:.0f}ms, total={total_time:.0f}ms")
+        return results
     
     @property
     def model_size(self) -> str:
@@ -125,7 +178,7 @@ class ReazonSpeechTranscriber:
     
     @property
     def compute_type(self) -> str:
-        return "float32"
+        return "float32" if self._precision == "fp32" else self._precision
     
     @property
     def is_gpu_enabled(self) -> bool:
@@ -0,0 +1,77 @@
+"""
+繰り返し (ハルシネーションループ) の検出
+音楽・雑音区間で Whisper が同じフレーズを繰り返し出力し続ける状態を、セグメント単位で検出する
+"""
+import re
+import zlib
+from dataclasses import dataclass
+from typing import List, Optional
+
+REPEATED_TEXT = "repeated_text"
+COMPRESSION_RATIO = "compression_ratio"
+
+# 比較時に無視する空白・句読点
+_IGNORED = re.compile(r"[\s、。，．,.!?！？…・「」『』()（）\"']+")
+
+
+def compression_ratio(text: str) -> float:
+    """zlib 圧縮率 (Whisper と同じ指標。繰り返しが多いほど大きい)"""
+    data = text.encode("utf-8")
+    return len(data) / len(zlib.compress(data))
+
+
+@dataclass
+class LoopDetectorConfig:
+    enabled: bool = False  # デプロイメントごとに有効化する (options.loop_detection)
+    max_repeats: int = 3  # 同じテキストのセグメントがこの回数連続したらループとみなす
+    min_repeat_chars: int = 6  # 繰り返しを判定する最小文字数 (「はい。」などの短い相槌の連続はループとみなさない)
+    compression_ratio_threshold: float = 2.4  # 1セグメントの圧縮率がこれを超えたらループとみなす
+    min_chars: int = 20  # 圧縮率を判定する最小文字数 (短いテキストは誤検出しやすいため)
+    max_skips: int = 5  # ループ区間を読み飛ばして再開する最大回数 (超えたら以降のデコードを打ち切る)
+
+    def __post_init__(self):
+        if self.max_repeats < 2:
+            raise ValueError("loop_detection.max_repeats must be >= 2")
+
+
+class RepetitionDetector:
+    """
+    セグメントのテキストを順に受け取り、ループを検出したら理由を返す
+    run には現在の繰り返しに数えたセグメントの index (check に渡された値) を順に保持する
+    (空のセグメントは繰り返しを途切れさせないが、run には含めない)
+    """
+
+    def __init__(self, config: LoopDetectorConfig):
+        self.config = config
+        self._last: Optional[str] = None
+        self.repeats = 0
+        self.run: List[int] = []
+
+    def reset(self):
+        self._last = None
+        self.repeats = 0
+        self.run = []
+
+    def check(self, text: str, index: int = -1) -> Optional[str]:
+        normalized = _IGNORED.sub("", text)
+        if not normalized:
+            return None
+        if len(normalized) < self.config.min_repeat_chars:
+            # 短いセグメントは繰り返しの回数に数えない (連続の判定もやり直す)
+            self.reset()
+            return None
+
+        if normalized == self._last:
+            self.repeats += 1
+            self.run.append(index)
+        else:
+            self._last = normalized
+            self.repeats = 1
+            self.run = [index]
+        if self.repeats >= self.config.max_repeats:
+            return REPEATED_TEXT
+
+        if len(normalized) >= self.config.min_chars and \
+                compression_ratio(normalized) > self.config.compression_ratio_threshold:
+            return COMPRESSION_RATIO
+        return None
@@ -0,0 +1,163 @@
+"""
+レスポンスの整形とシリアライズ
+- response_format: json / verbose_json / text / srt / vtt
+- verbose_json のセグメント項目の選択 (segment_fields、例: tokens を含めない)
+- JSON のエンコード (orjson がインストールされていれば使用) と、セグメント数が多い場合のストリーミング出力
+字幕形式 (srt / vtt) と text は、verbose_json の辞書を作らずにセグメントから直接生成する
+"""
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # 任意の依存 (pip install orjson)
+    orjson = None
+
+JSON_FORMATS = ("json", "verbose_json")
+# text / srt / vtt は JSON ではなく本文をそのまま返す
+TEXT_FORMATS = {
+    "text": "text/plain; charset=utf-8",
+    "srt": "application/x-subrip; charset=utf-8",
+    "vtt": "text/vtt; charset=utf-8",
+}
+RESPONSE_FORMATS = JSON_FORMATS + tuple(TEXT_FORMATS)
+
+# verbose_json のセグメントの項目 (OpenAI 互換)
+SEGMENT_FIELDS = (
+    "id", "seek", "start", "end", "text", "tokens",
+    "temperature", "avg_logprob", "compression_ratio", "no_speech_prob",
+)
+
+# ストリーミングで1回に書き出すセグメント数
+_STREAM_CHUNK_SEGMENTS = 256
+
+
+def validate_response_format(response_format: Optional[str]) -> str:
+    response_format = response_format or "json"
+    if response_format not in RESPONSE_FORMATS:
+        raise ValueError(f"Unsupported response_format: {response_format} (expected one of {list(RESPONSE_FORMATS)})")
+    return response_format
+
+
+def parse_segment_fields(value: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """
+    segment_fields (カンマ区切り) を項目のタプルに変換 (未指定なら None = 全項目)
+    先頭に '-' を付けた項目は除外として扱う (例: '-tokens' は tokens 以外の全項目)
+    """
+    if not value or not value.strip():
+        return None
+    names = [v.strip() for v in value.split(",") if v.strip()]
+    excluded = {n[1:] for n in names if n.startswith("-")}
+    included = [n for n in names if not n.startswith("-")]
+    unknown = [n for n in included + sorted(excluded) if n not in SEGMENT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown segment_fields: {unknown} (expected {list(SEGMENT_FIELDS)})")
+    if included and excluded:
+        raise ValueError("segment_fields cannot mix included and excluded ('-') fields")
+    if excluded:
+        return tuple(f for f in SEGMENT_FIELDS if f not in excluded)
+    return tuple(f for f in SEGMENT_FIELDS if f in included)
+
+
+def backend_options(transcriber: Any, response_format: str,
+                    segment_fields: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """
+    Transcriber.transcribe に渡す response_format (と segment_fields)
+    text / srt / vtt に対応していないバックエンドには、生成に必要な情報を含む形式を要求する
+    """
+    supported = getattr(transcriber, "supported_formats", JSON_FORMATS)
+    options: Dict[str, Any] = {"response_format": response_format}
+    if response_format not in supported:
+        options["response_format"] = "json" if response_format == "text" else "verbose_json"
+    if segment_fields is not None and getattr(transcriber, "supports_segment_fields", False):
+        options["segment_fields"] = segment_fields
+    return options
+
+
+def finalize(result: Union[Dict[str, Any], str], response_format: str,
+             segment_fields: Optional[Sequence[str]] = None) -> Union[Dict[str, Any], str]:
+    """バックエンドの結果を要求された形式に揃える (backend_options で形式を変えた場合の変換)"""
+    if response_format in TEXT_FORMATS:
+        if isinstance(result, str):
+            return result
+        return render_text(result.get("segments") or [], result.get("text", ""), response_format,
+                           duration=result.get("duration"))
+    if response_format == "verbose_json" and segment_fields is not None and isinstance(result, dict):
+        segments = result.get("segments")
+        if segments and set(segments[0]) - set(segment_fields):
+            result["segments"] = [select_fields(seg, segment_fields) for seg in segments]
+    return result
+
+
+def select_fields(segment: Dict[str, Any], fields: Sequence[str]) -> Dict[str, Any]:
+    return {k: segment[k] for k in fields if k in segment}
+
+
+def _get(segment: Any, key: str) -> Any:
+    """faster-whisper の Segment と verbose_json の辞書のどちらからも値を取得"""
+    return segment[key] if isinstance(segment, dict) else getattr(segment, key)
+
+
+def _timestamp(seconds: float, separator: str) -> str:
+    millis = max(0, int(round(seconds * 1000)))
+    hours, millis = divmod(millis, 3_600_000)
+    minutes, millis = divmod(millis, 60_000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{millis:03d}"
+
+
+def iter_subtitles(segments: Iterable[Any], response_format: str) -> Iterator[str]:
+    """セグメントを順に字幕のキュー (srt / vtt) に変換"""
+    separator = "," if response_format == "srt" else "."
+    if response_format == "vtt":
+        yield "WEBVTT\n\n"
+    index = 0
+    for segment in segments:
+        text = _get(segment, "text").strip()
+        if not text:
+            continue
+        index += 1
+        cue = f"{_timestamp(_get(segment, 'start'), separator)} --> {_timestamp(_get(segment, 'end'), separator)}\n{text}\n\n"
+        yield f"{index}\n{cue}" if response_format == "srt" else cue
+
+
+def render_text(segments: Sequence[Any], full_text: str, response_format: str,
+                duration: Optional[float] = None) -> str:
+    """
+    text / srt / vtt の本文を生成
+    セグメント (タイムスタンプ) の無いバックエンドは、全文を音声全体の1キューとして出力する
+    """
+    if response_format == "text":
+        return full_text.strip() + "\n"
+    if not segments and full_text.strip():
+        segments = [{"start": 0.0, "end": duration or 0.0, "text": full_text}]
+    return "".join(iter_subtitles(segments, response_format))
+
+
+def dumps(obj: Any) -> bytes:
+    """JSON にエンコード (orjson があれば使用。どちらも非 ASCII 文字はエスケープしない)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def _default(obj: Any) -> Any:
+    # numpy のスカラー・配列 (tokens 等) を標準の型に変換
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def iter_json(result: Dict[str, Any], chunk_segments: int = _STREAM_CHUNK_SEGMENTS) -> Iterator[bytes]:
+    """
+    verbose_json を segments 以外の項目 -> segments を chunk_segments 件ずつの順に書き出す
+    全体を1つのバイト列にしないため、長時間の音声でもメモリ使用量と最初の応答までの時間を抑えられる
+    """
+    segments: List[Any] = result.get("segments") or []
+    head = {k: v for k, v in result.items() if k != "segments"}
+    # '{"task":...,"text":...' の末尾の '}' を外して segments を続ける
+    yield dumps(head)[:-1] + b',"segments":[' if head else b'{"segments":['
+    for start in range(0, len(segments), chunk_segments):
+        chunk = dumps(segments[start:start + chunk_segments])[1:-1]
+        yield chunk if start == 0 else b"," + chunk
+    yield b"]}"
@@ -0,0 +1,219 @@
+"""
+JobScheduler - デプロイメント内のジョブ実行順序の制御
+テナント間は重み付き公平キューイングで処理枠を配分し、テナント内では音声の長さが短いジョブを
+優先 (SJF) する。待ち時間に応じた優先度の引き上げ (エージング) で長いジョブの飢餓を防ぐ
+"""
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict
+
+from .cancellation import CancellationToken, RequestCancelled
+from .tenants import Tenant
+
+POLICIES = ("sjf", "fifo")
+
+# 音声長が不明なジョブの見積もり (秒)
+DEFAULT_JOB_COST = 30.0
+
+
+class TicketEvicted(Exception):
+    """待機中のジョブが枠を得る前に待ち行列から外された (デプロイメントの差し替え時など)"""
+
+
+@dataclass(eq=False)
+class Ticket:
+    """実行枠の予約"""
+    cost: float  # 音声の長さ (秒)
+    arrival: float
+    seq: int
+    long: bool
+    tenant: Optional[Tenant] = field(repr=False, default=None)
+    future: "asyncio.Future" = field(repr=False, default=None)
+
+
+def _tenant_key(ticket: Ticket) -> Optional[str]:
+    return ticket.tenant.name if ticket.tenant is not None else None
+
+
+class JobScheduler:
+    """
+    同時実行枠 (max_concurrency) をジョブに割り当てる
+
+    - sjf: 優先度 = 音声長 - aging_rate × 待ち時間 が小さい順
+           (aging_rate 秒分の音声長を、待ち時間1秒ごとに差し引く)
+    - fifo: 到着順
+    複数テナントのジョブが待機している場合は、重みあたりの処理済み音声長 (仮想サービス量) が
+    最も少ないテナントのジョブから割り当てる。テナントの同時実行数上限に達したジョブは待機する
+    long_job_threshold と short_lane_slots を指定すると、音声長が閾値を超えるジョブは
+    short_lane_slots 個の枠を使えなくなり、短いジョブ専用のレーンが確保される
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        policy: str = "sjf",
+        aging_rate: float = 10.0,
+        long_job_threshold: Optional[float] = None,
+        short_lane_slots: int = 0
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy} (expected one of {POLICIES})")
+        if short_lane_slots and long_job_threshold is None:
+            raise ValueError("short_lane_slots requires long_job_threshold")
+        if short_lane_slots and short_lane_slots >= max_concurrency:
+            raise ValueError("short_lane_slots must be smaller than max_concurrency")
+        self.max_concurrency = max_concurrency
+        self.policy = policy
+        self.aging_rate = aging_rate
+        self.long_job_threshold = long_job_threshold
+        self.short_lane_slots = short_lane_slots
+        self._waiting: List[Ticket] = []
+        self._running = 0
+        self._running_long = 0
+        self._running_cost = 0.0
+        self._seq = itertools.count()
+        # テナントごとの仮想サービス量 (処理枠を割り当てた音声長 / 重み)
+        self._vservice: Dict[Optional[str], float] = {}
+        self._vtime = 0.0
+
+    def _priority(self, ticket: Ticket):
+        if self.policy == "fifo":
+            return (ticket.seq,)
+        # cost - aging_rate × (now - arrival) の大小関係は now に依存しないため、
+        # cost + aging_rate × arrival で比較できる
+        return (ticket.cost + self.aging_rate * ticket.arrival, ticket.seq)
+
+    def _eligible(self, ticket: Ticket) -> bool:
+        if self._running >= self.max_concurrency:
+            return False
+        if ticket.tenant is not None and not ticket.tenant.can_start():
+            return False
+        if ticket.long and self.short_lane_slots:
+            return self._running_long < self.max_concurrency - self.short_lane_slots
+        return True
+
+    def _dispatch(self):
+        """空いている枠を優先度順に割り当てる"""
+        while self._waiting and self._running < self.max_concurrency:
+            candidates = [t for t in self._waiting if self._eligible(t)]
+            if not candidates:
+                return
+            # 仮想サービス量が最も少ないテナントを選び、その中で優先度の高いジョブを割り当てる
+            tenant_key = min({_tenant_key(t) for t in candidates}, key=lambda k: self._vservice.get(k, 0.0))
+            ticket = min((t for t in candidates if _tenant_key(t) == tenant_key), key=self._priority)
+            self._waiting.remove(ticket)
+            self._start(ticket)
+            ticket.future.set_result(None)
+
+    def _start(self, ticket: Ticket):
+        self._running += 1
+        self._running_cost += ticket.cost
+        if ticket.long:
+            self._running_long += 1
+        key = _tenant_key(ticket)
+        self._vtime = self._vservice.get(key, 0.0)
+        weight = ticket.tenant.weight if ticket.tenant is not None else 1.0
+        self._vservice[key] = self._vtime + ticket.cost / weight
+        if ticket.tenant is not None:
+            ticket.tenant.running += 1
+
+    async def acquire(
+        self,
+        cost: Optional[float],
+        token: Optional[CancellationToken] = None,
+        tenant: Optional[Tenant] = None
+    ) -> Ticket:
+        """実行枠を確保するまで待機 (待機中にキャンセルされた場合は RequestCancelled)"""
+        if token is not None:
+            token.check()
+        if cost is None:
+            cost = DEFAULT_JOB_COST
+        ticket = Ticket(
+            cost=cost,
+            arrival=time.monotonic(),
+            seq=next(self._seq),
+            long=self.long_job_threshold is not None and cost > self.long_job_threshold,
+            tenant=tenant,
+            future=asyncio.get_running_loop().create_future()
+        )
+        key = _tenant_key(ticket)
+        # しばらく待機ジョブの無かったテナントが過去の未使用分を溜め込まないよう、現在の仮想時刻に揃える
+        if not any(_tenant_key(t) == key for t in self._waiting):
+            self._vservice[key] = max(self._vservice.get(key, 0.0), self._vtime)
+        if tenant is not None:
+            tenant.waiting_schedulers.add(self)
+        self._waiting.append(ticket)
+        self._dispatch()
+        if ticket.future.done():
+            return ticket
+
+        cancelled = asyncio.ensure_future(token.wait()) if token is not None else None
+        try:
+            waiters = {ticket.future} | ({cancelled} if cancelled else set())
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            self._abandon(ticket)
+            raise
+        finally:
+            if cancelled is not None:
+                cancelled.cancel()
+
+        if ticket.future.done():
+            if not ticket.future.cancelled() and ticket.future.exception() is not None:
+                raise ticket.future.exception()
+            # 枠の割り当てとキャンセルが同時に起きた場合も、枠を得たジョブとして扱う
+            # (実行前の token.check で中断され、release される)
+            return ticket
+        self._abandon(ticket)
+        raise RequestCancelled(token.reason)
+
+    def _abandon(self, ticket: Ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            ticket.future.cancel()
+        elif ticket.future.done() and not ticket.future.cancelled():
+            self.release(ticket)
+
+    def evict_waiting(self) -> int:
+        """待機中のジョブを全て待ち行列から外す (各ジョブの acquire は TicketEvicted を送出する)"""
+        evicted, self._waiting = self._waiting, []
+        for ticket in evicted:
+            ticket.future.set_exception(TicketEvicted())
+        return len(evicted)
+
+    def release(self, ticket: Ticket):
+        self._running -= 1
+        self._running_cost -= ticket.cost
+        if ticket.long:
+            self._running_long -= 1
+        if ticket.tenant is not None:
+            ticket.tenant.running -= 1
+        self._dispatch()
+        if ticket.tenant is not None:
+            # テナントの同時実行枠が空いたので、他のデプロイメントで待機中のジョブも再割り当てする
+            for scheduler in list(ticket.tenant.waiting_schedulers):
+                if scheduler is not self:
+                    scheduler._dispatch()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def queued_audio_seconds(self) -> float:
+        return sum(t.cost for t in self._waiting)
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "queued": self.queued,
+            "running": self.running,
+            "queued_audio_seconds": round(self.queued_audio_seconds, 1),
+            "running_audio_seconds": round(max(self._running_cost, 0.0), 1),
+        }
@@ -0,0 +1,170 @@
+"""
+起動時間のプロファイル (run_app.py --profile-startup)
+パッケージごとの import 時間、デプロイメントごとのモデルロード・ウォームアップ時間を計測し、
+リクエストを受け付けられるようになるまでの時間 (time-to-ready) をレポートする
+"""
+import sys
+import json
+import time
+import builtins
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Iterator
+
+logger = logging.getLogger("startup-profile")
+
+# レポートに表示する import の件数
+_TOP_IMPORTS = 15
+
+# サーバー自身のパッケージ (app) は計測せず、そこから import される依存パッケージを計測する
+_OWN_PACKAGE = __name__.partition(".")[0]
+
+
+class StartupProfile:
+    """
+    起動処理の各段階の所要時間を記録する
+    import 時間は builtins.__import__ をフックして、初めて import されるモジュールごとに計測する
+    (他のパッケージから import されたものは nested として区別し、合計には含めない)
+    """
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.stages: List[Dict[str, Any]] = []
+        self.imports: List[Dict[str, Any]] = []
+        self._current_stage: Optional[str] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._original_import = None
+        self.ready_at: Optional[float] = None
+
+    def install_import_hook(self):
+        if self._original_import is not None:
+            return
+        original = builtins.__import__
+        self._original_import = original
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level or name in sys.modules:
+                return original(name, globals, locals, fromlist, level)
+            package = name.partition(".")[0]
+            active = getattr(self._local, "active", ())
+            if package in active or package == _OWN_PACKAGE:
+                # import 中のパッケージのサブモジュールは外側の import に含まれる
+                return original(name, globals, locals, fromlist, level)
+            self._local.active = active + (package,)
+            start = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                self._local.active = active
+                self._record_import(package, time.perf_counter() - start, nested=bool(active))
+
+        builtins.__import__ = timed_import
+
+    def remove_import_hook(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _record_import(self, package: str, seconds: float, nested: bool):
+        with self._lock:
+            self.imports.append({
+                "package": package,
+                "seconds": seconds,
+                "nested": nested,
+                "stage": self._current_stage,
+            })
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """name の段階の所要時間を記録 (段階内の import 時間も集計する)"""
+        previous = self._current_stage
+        self._current_stage = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({"stage": name, "seconds": time.perf_counter() - start})
+            self._current_stage = previous
+
+    def mark_ready(self):
+        """リクエストを受け付けられる状態になった時点を記録し、import のフックを外す"""
+        self.ready_at = time.perf_counter()
+        self.remove_import_hook()
+
+    def report(self) -> Dict[str, Any]:
+        ready_at = self.ready_at if self.ready_at is not None else time.perf_counter()
+
+        # パッケージ単位に集計 (同じパッケージの複数のサブモジュールは合算する)
+        packages: Dict[tuple, float] = {}
+        for record in self.imports:
+            key = (record["package"], record["nested"])
+            packages[key] = packages.get(key, 0.0) + record["seconds"]
+        imports = sorted(
+            ({"package": p, "nested": n, "seconds": round(s, 3)} for (p, n), s in packages.items()),
+            key=lambda r: r["seconds"],
+            reverse=True,
+        )
+
+        stages = []
+        for stage in self.stages:
+            import_seconds = sum(
+                r["seconds"] for r in self.imports if r["stage"] == stage["stage"] and not r["nested"]
+            )
+            stages.append({
+                "stage": stage["stage"],
+                "seconds": round(stage["seconds"], 3),
+                "import_seconds": round(import_seconds, 3),
+            })
+
+        # プロファイル開始前 (インタプリタ・uvicorn の起動) やサーバーのソケット作成など、段階に含まれない時間
+        other = (ready_at - self.started_at) - sum(stage["seconds"] for stage in self.stages)
+        stages.append({"stage": "other", "seconds": round(other, 3), "import_seconds": 0.0})
+
+        return {
+            "time_to_ready": round(ready_at - self.started_at, 3),
+            "import_seconds": round(sum(r["seconds"] for r in self.imports if not r["nested"]), 3),
+            "stages": stages,
+            "imports": imports,
+        }
+
+    def log_report(self, output: Optional[str] = None) -> Dict[str, Any]:
+        """レポートをログに出力し、output が指定されていれば JSON で書き出す"""
+        report = self.report()
+        lines = [
+            "=" * 60,
+            f"STARTUP PROFILE (time to ready: {report['time_to_ready']:.2f}s, imports: {report['import_seconds']:.2f}s)",
+            "=" * 60,
+            f"{'Stage':<36} {'Time(s)':>10} {'Imports(s)':>11}",
+        ]
+        for stage in report["stages"]:
+            lines.append(f"{stage['stage']:<36} {stage['seconds']:>10.3f} {stage['import_seconds']:>11.3f}")
+        lines.append("-" * 60)
+        lines.append(f"{'Slowest imports':<36} {'Time(s)':>10}")
+        for record in report["imports"][:_TOP_IMPORTS]:
+            name = record["package"] + (" (nested)" if record["nested"] else "")
+            lines.append(f"{name:<36} {record['seconds']:>10.3f}")
+        for line in lines:
+            logger.info(line)
+
+        if output:
+            with open(output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Startup profile written to {output}")
+        return report
+
+
+# グローバルプロファイル (run_app.py --profile-startup で有効化、無効時は None)
+_profile: Optional[StartupProfile] = None
+
+def enable_startup_profile(started_at: Optional[float] = None) -> StartupProfile:
+    """プロファイルを開始し、以降の import を計測する"""
+    global _profile
+    if _profile is None:
+        _profile = StartupProfile(started_at)
+        _profile.install_import_hook()
+    return _profile
+
+def get_startup_profile() -> Optional[StartupProfile]:
+    return _profile
@@ -0,0 +1,195 @@
+"""
+テナント管理 - APIキーとテナントの対応、重み・同時実行数・レート制限、利用量の集計
+"""
+import time
+import logging
+import weakref
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Any, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger("tenants")
+
+DEFAULT_TENANT = "default"
+
+T = TypeVar("T")
+
+# 推論スレッドごとの、Transcriber が報告した音声の長さ (measure_audio_seconds の実行中のみ集計)
+_usage = threading.local()
+
+
+def report_audio_seconds(seconds: float):
+    """Transcriber が実際に推論した音声の長さ (秒) を報告する (テナントの利用量の集計に使う)"""
+    reports = getattr(_usage, "reports", None)
+    if reports is not None:
+        reports.append(seconds)
+
+
+def measure_audio_seconds(fn: Callable[..., T], *args: Any) -> Tuple[T, Optional[float]]:
+    """fn を実行し、結果と実行中に報告された音声の秒数 (報告が無ければ None) を返す"""
+    _usage.reports = []
+    try:
+        result = fn(*args)
+        return result, (sum(_usage.reports) if _usage.reports else None)
+    finally:
+        _usage.reports = None
+
+
+@dataclass
+class TenantConfig:
+    """1テナント分の設定"""
+    name: str
+    api_keys: List[str] = field(default_factory=list)
+    weight: float = 1.0  # 混雑時の処理枠の配分比
+    max_concurrency: Optional[int] = None  # 全デプロイメント合計の同時実行数
+    requests_per_minute: Optional[float] = None
+    audio_seconds_per_minute: Optional[float] = None
+
+    def __post_init__(self):
+        if self.weight <= 0:
+            raise ValueError(f"[tenant {self.name}] weight must be > 0")
+        if self.max_concurrency is not None and self.max_concurrency < 1:
+            raise ValueError(f"[tenant {self.name}] max_concurrency must be >= 1")
+
+
+class QuotaExceeded(Exception):
+    """レート制限超過"""
+
+    def __init__(self, tenant: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded for tenant '{tenant}'")
+        self.retry_after = retry_after
+
+
+class _TokenBucket:
+    """1分あたり rate の補充速度を持つトークンバケット (容量 = rate)"""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.refill_per_second = rate_per_minute / 60.0
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """amount を消費できるまでの秒数 (0 なら即時消費可)"""
+        self._refill()
+        # 容量を超える要求はバケットが満タンなら通す (長い音声を永久に拒否しないため)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class Tenant:
+    """テナントの実行時状態 (イベントループ上でのみ更新する)"""
+
+    def __init__(self, config: TenantConfig):
+        self.config = config
+        self.running = 0
+        self._request_bucket = _TokenBucket(config.requests_per_minute) if config.requests_per_minute else None
+        self._audio_bucket = _TokenBucket(config.audio_seconds_per_minute) if config.audio_seconds_per_minute else None
+        # このテナントのジョブが待機しているスケジューラ (同時実行枠が空いたら再割り当てを促す)
+        self.waiting_schedulers = weakref.WeakSet()
+        self.usage: Dict[str, Dict[str, float]] = {}
+        self.rejected = 0
+
+    @property
+    def name(self) -> str:
+        return self.config.name
+
+    @property
+    def weight(self) -> float:
+        return self.config.weight
+
+    def can_start(self) -> bool:
+        return self.config.max_concurrency is None or self.running < self.config.max_concurrency
+
+    def admit(self, requests: int = 1, audio_seconds: float = 0.0):
+        """レート制限を確認し、許可されれば消費する (超過時は QuotaExceeded)"""
+        waits = []
+        if self._request_bucket:
+            waits.append(self._request_bucket.wait_time(requests))
+        if self._audio_bucket:
+            waits.append(self._audio_bucket.wait_time(audio_seconds))
+        retry_after = max(waits, default=0.0)
+        if retry_after > 0:
+            self.rejected += 1
+            raise QuotaExceeded(self.name, retry_after)
+        if self._request_bucket:
+            self._request_bucket.consume(requests)
+        if self._audio_bucket:
+            self._audio_bucket.consume(audio_seconds)
+
+    def record(self, deployment: str, audio_seconds: float):
+        """処理済みの音声秒数を集計"""
+        entry = self.usage.setdefault(deployment, {"requests": 0, "audio_seconds": 0.0})
+        entry["requests"] += 1
+        entry["audio_seconds"] += audio_seconds
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "max_concurrency": self.config.max_concurrency,
+            "running": self.running,
+            "rejected": self.rejected,
+            "audio_seconds": round(sum(u["audio_seconds"] for u in self.usage.values()), 1),
+            "usage": {k: {"requests": v["requests"], "audio_seconds": round(v["audio_seconds"], 1)}
+                      for k, v in self.usage.items()},
+        }
+
+
+class TenantRegistry:
+    """APIキー -> テナントの解決"""
+
+    def __init__(self):
+        self._tenants: Dict[str, Tenant] = {}
+        self._keys: Dict[str, Tenant] = {}
+        self.allow_unknown_keys = True
+        self._ensure_default()
+
+    def _ensure_default(self):
+        if DEFAULT_TENANT not in self._tenants:
+            self._tenants[DEFAULT_TENANT] = Tenant(TenantConfig(name=DEFAULT_TENANT))
+
+    def load(self, tenants: List[TenantConfig], allow_unknown_keys: bool = True):
+        """テナント設定を読み込む (未登録のキーは allow_unknown_keys なら default テナント)"""
+        self._tenants = {}
+        self._keys = {}
+        for config in tenants:
+            tenant = Tenant(config)
+            self._tenants[config.name] = tenant
+            for key in config.api_keys:
+                if key in self._keys:
+                    raise ValueError(f"API key is assigned to multiple tenants: {self._keys[key].name}, {config.name}")
+                self._keys[key] = tenant
+        self._ensure_default()
+        self.allow_unknown_keys = allow_unknown_keys
+        if tenants:
+            logger.info(f"Loaded tenants: {[t.name for t in tenants]} (allow_unknown_keys={allow_unknown_keys})")
+
+    def resolve(self, api_key: str) -> Optional[Tenant]:
+        """APIキーからテナントを取得 (未登録かつ許可されていない場合は None)"""
+        tenant = self._keys.get(api_key)
+        if tenant is None and self.allow_unknown_keys:
+            tenant = self._tenants[DEFAULT_TENANT]
+        return tenant
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: tenant.stats() for name, tenant in self._tenants.items()}
+
+
+# グローバルレジストリ
+_tenant_registry: Optional[TenantRegistry] = None
+
+def get_tenant_registry() -> TenantRegistry:
+    global _tenant_registry
+    if _tenant_registry is None:
+        _tenant_registry = TenantRegistry()
+    return _tenant_registry
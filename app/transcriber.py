@@ -5,47 +5,152 @@ CPU (INT8) 最適化版 - Kotoba-Whisper v2.2 対応
 import logging
 import os
 import time
-from typing import Optional, Dict, Any, List, Union, BinaryIO
-from faster_whisper import WhisperModel
+import threading
+import dataclasses
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, Union, BinaryIO, Iterator, Sequence
+
+from .cancellation import CancellationToken, RequestCancelled
+from .repetition import RepetitionDetector, LoopDetectorConfig, REPEATED_TEXT
+from .audio_cache import get_audio_cache, content_key
+from .audio import decoded_audio, is_mappable
+from .response_format import RESPONSE_FORMATS, TEXT_FORMATS, render_text
+from .tenants import report_audio_seconds
+
+if TYPE_CHECKING:
+    import numpy as np
 
 # ロギング設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("whisper-transcriber")
 
+SAMPLE_RATE = 16000
+
+# verbose_json のセグメント項目の取得方法 (segment_fields 指定時は選択された項目のみ生成する)
+_SEGMENT_GETTERS = {
+    "id": lambda i, seg: i,
+    "seek": lambda i, seg: getattr(seg, "seek", 0),
+    "start": lambda i, seg: seg.start,
+    "end": lambda i, seg: seg.end,
+    "text": lambda i, seg: seg.text.strip(),
+    "tokens": lambda i, seg: seg.tokens,
+    "temperature": lambda i, seg: getattr(seg, "temperature", 0.0),
+    "avg_logprob": lambda i, seg: getattr(seg, "avg_logprob", 0.0),
+    "compression_ratio": lambda i, seg: getattr(seg, "compression_ratio", 0.0),
+    "no_speech_prob": lambda i, seg: getattr(seg, "no_speech_prob", 0.0),
+}
+
+
+def _shift(segment, offset: float):
+    """途中から再開したデコード結果のタイムスタンプを元の音声の時刻に合わせる"""
+    if not offset:
+        return segment
+    if hasattr(segment, "_replace"):  # NamedTuple (faster-whisper 1.0 以前)
+        return segment._replace(start=segment.start + offset, end=segment.end + offset)
+    return dataclasses.replace(segment, start=segment.start + offset, end=segment.end + offset)
+
+
+class _ReusableFeatures:
+    """
+    faster-whisper の feature_extractor を包み、ループ検出で途中から再開したときに
+    元の音声全体のメル特徴量を切り出して再利用する (同じモデルを並列に使うためスレッドごとに保持)
+    reuse() の中で最初に source を計算した結果を保持し、resume() が返した配列が渡されたら
+    計算せずにその位置以降を返す。それ以外の配列 (VAD で区間を切り出した音声など) は通常どおり計算する
+    """
+
+    def __init__(self, extractor):
+        self._extractor = extractor
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._extractor, name)
+
+    @property
+    def hop_length(self) -> int:
+        return getattr(self._extractor, "hop_length", 160)
+
+    @contextmanager
+    def reuse(self, source: "np.ndarray"):
+        self._local.state = {"source": source, "features": None, "tail": None, "frames": 0}
+        try:
+            yield
+        finally:
+            self._local.state = None
+
+    def resume(self, frames: int) -> "np.ndarray":
+        """source の frames フレーム目以降の音声 (これを transcribe に渡すと特徴量を再利用する)"""
+        state = self._local.state
+        state["tail"] = state["source"][frames * self.hop_length:]
+        state["frames"] = frames
+        return state["tail"]
+
+    def __call__(self, waveform, *args, **kwargs):
+        state = getattr(self._local, "state", None)
+        if state is not None:
+            if waveform is state["source"]:
+                state["features"] = self._extractor(waveform, *args, **kwargs)
+                return state["features"]
+            if waveform is state["tail"] and state["features"] is not None:
+                return state["features"][..., state["frames"]:]
+        return self._extractor(waveform, *args, **kwargs)
+
+
 class WhisperTranscriber:
     """faster-whisper バックエンドでWhisperを実行"""
     
+    # text / srt / vtt はセグメントから直接生成する
+    supported_formats = RESPONSE_FORMATS
+    supports_segment_fields = True
+    
     def __init__(
         self, 
         model_size: str = "RoachLin/kotoba-whisper-v2.2-faster", 
         use_gpu: bool = False, # CPU推論をデフォルトにする
-        cache_dir: Optional[str] = None
+        cache_dir: Optional[str] = None,
+        compute_type: Optional[str] = None,
+        cpu_threads: Optional[int] = None,
+        num_workers: int = 1,
+        decode_options: Optional[Dict[str, Any]] = None,
+        loop_detection: Optional[Dict[str, Any]] = None
     ):
         """
         Args:
             model_size: モデル名またはパス。デフォルトは 'RoachLin/kotoba-whisper-v2.2-faster'
             use_gpu: GPUを使用するか (Recommended: False for INT8 CPU speed with faster-whisper on Ryzen)
             cache_dir: モデルキャッシュディレクトリ (未使用、faster-whisperが管理)
+            compute_type: CTranslate2 の計算型 (省略時は GPU: float16 / CPU: int8)
+            cpu_threads: CPU推論スレッド数 (省略時は全スレッド)
+            num_workers: 同一モデルで並列に推論できる数
+            decode_options: model.transcribe に渡すデコード設定の既定値 (beam_size 等)
+            loop_detection: 繰り返しループ検出の設定 (LoopDetectorConfig の項目。指定時のみ有効、enabled: false で無効)
         """
         self.model_size = model_size
         self.use_gpu = use_gpu
         self.device = "cuda" if use_gpu else "cpu"
-        self.compute_type = "float16" if use_gpu else "int8"
+        self.compute_type = compute_type or ("float16" if use_gpu else "int8")
+        self.cpu_threads = cpu_threads or os.cpu_count()
+        self.num_workers = num_workers
+        self.decode_options = {"beam_size": 5, **(decode_options or {})}
+        self.loop_detection = LoopDetectorConfig(**{"enabled": True, **loop_detection}) \
+            if loop_detection is not None else LoopDetectorConfig()
         
         logger.info(f"Initializing faster-whisper with model: {self.model_size}")
-        logger.info(f"Device: {self.device}, Compute Type: {self.compute_type}")
+        logger.info(f"Device: {self.device}, Compute Type: {self.compute_type}, Threads: {self.cpu_threads}")
         
         self._load_model()
     
     def _load_model(self):
-        """モデルをロード"""
+        """モデルをロード (faster-whisper / CTranslate2 の import に時間がかかるため、使うデプロイメントでのみ import する)"""
+        from faster_whisper import WhisperModel
         try:
             self.model = WhisperModel(
                 self.model_size, 
                 device=self.device, 
                 compute_type=self.compute_type,
-                cpu_threads=os.cpu_count() # 全スレッド使用
+                cpu_threads=self.cpu_threads,
+                num_workers=self.num_workers
             )
+            # ループ検出で再開するときにメル特徴量を再計算しない
+            self.model.feature_extractor = _ReusableFeatures(self.model.feature_extractor)
             logger.info("✓ Model loaded successfully")
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
@@ -56,8 +161,10 @@ class WhisperTranscriber:
         audio_path: Union[str, BinaryIO],
         language: Optional[str] = "ja", # 日本語特化モデルのためデフォルトja
         prompt: Optional[str] = None,
-        response_format: str = "json"
-    ) -> Dict[str, Any]:
+        response_format: str = "json",
+        cancel_token: Optional[CancellationToken] = None,
+        segment_fields: Optional[Sequence[str]] = None
+    ) -> Union[Dict[str, Any], str]:
         """
         音声ファイルを文字起こし
         
@@ -65,70 +172,230 @@ class WhisperTranscriber:
             audio_path: 音声ファイルのパス または ファイルオブジェクト
             language: 言語コード
             prompt: 初期プロンプト (faster-whisperでは initial_prompt)
-            response_format: "json" or "verbose_json"
+            response_format: "json", "verbose_json", "text", "srt" or "vtt"
+            cancel_token: キャンセルされるとセグメントの区切りで推論を打ち切る
+            segment_fields: verbose_json のセグメントに含める項目 (省略時は全項目)
         
         Returns:
-            Azure OpenAI互換のレスポンス
+            Azure OpenAI互換のレスポンス (text / srt / vtt は本文の文字列)
         """
-        logger.info(f"Transcribing: {audio_path if isinstance(audio_path, str) else 'Buffered Reader'} (language={language})")
+        logger.debug(f"Transcribing: {audio_path if isinstance(audio_path, str) else 'Buffered Reader'} (language={language})")
         
+        segments = []
+        loops: List[Dict[str, Any]] = []
         try:
             # inference
             start_time = time.time()
-            segments_generator, info = self.model.transcribe(
-                audio_path, 
-                language=language,
-                beam_size=5,
-                initial_prompt=prompt
-            )
-            
-            # ジェネレータを展開して結果を取得 (ここで推論が実行される)
-            segments = list(segments_generator)
+            # ループ検出時は途中から再開できるよう、音声は先にデコードしておく
+            decode = self.loop_detection.enabled or get_audio_cache() is not None
+            with self._audio_input(audio_path, decode) as audio:
+                if self.loop_detection.enabled:
+                    segments, duration, loops = self._transcribe_with_loop_detection(
+                        audio, language, prompt, cancel_token, segments
+                    )
+                else:
+                    segments_generator, info = self.model.transcribe(
+                        audio, 
+                        language=language,
+                        initial_prompt=prompt,
+                        **self.decode_options
+                    )
+                    
+                    # ジェネレータを展開して結果を取得 (ここで推論が実行される)
+                    # セグメントごとにキャンセルを確認し、中断時は残りのデコードを行わない
+                    for segment in segments_generator:
+                        if cancel_token is not None:
+                            cancel_token.check()
+                        segments.append(segment)
+                    
+                    # infoからduration取得
+                    duration = info.duration
             inference_time = time.time() - start_time
-            logger.info(f"Inference completed in {inference_time:.2f}s")
+            logger.debug(f"Inference completed in {inference_time:.2f}s")
+            report_audio_seconds(duration)
             
             # テキスト結合
             full_text = "".join([segment.text for segment in segments])
             
-            # infoからduration取得
-            duration = info.duration
-            
+        except RequestCancelled as e:
+            logger.info(f"Transcription stopped after {len(segments)} segments: {e.reason}")
+            raise
         except Exception as e:
             logger.error(f"Transcription failed: {e}")
             raise
         
         # レスポンス形式の構築
+        if response_format in TEXT_FORMATS:
+            return render_text(segments, full_text, response_format, duration)
         if response_format == "verbose_json":
             start_build = time.time()
-            resp = self._build_verbose_response(segments, full_text, duration, language)
-            logger.info(f"Response build time: {time.time() - start_build:.4f}s")
+            resp = self._build_verbose_response(segments, full_text, duration, language, segment_fields)
+            if loops:
+                resp["repetition_loops"] = loops
+            logger.debug(f"Response build time: {time.time() - start_build:.4f}s")
             return resp
         else:
             return {"text": full_text.strip()}
     
+    @contextmanager
+    def _audio_input(self, audio_path: Union[str, BinaryIO], decode: bool) -> Iterator[Any]:
+        """
+        model.transcribe に渡す入力
+        サーバーローカルの WAV / raw PCM は mmap で参照し (decoded_audio)、decode が真ならデコード済みの配列、
+        それ以外は faster-whisper 内でデコードさせるためそのまま渡す
+        """
+        if isinstance(audio_path, str) and is_mappable(audio_path):
+            with decoded_audio(audio_path) as audio:
+                yield audio
+        elif decode:
+            yield self._load_audio(audio_path)
+        else:
+            yield audio_path
+    
+    def _load_audio(self, audio_path: Union[str, BinaryIO]):
+        """
+        16kHz モノラル float32 にデコード
+        キャッシュが有効なら内容のハッシュで検索し、他のモデル・パラメータ違いのリクエストと共有する
+        """
+        from faster_whisper import decode_audio
+        cache = get_audio_cache()
+        if cache is None:
+            return decode_audio(audio_path, sampling_rate=SAMPLE_RATE)
+        key = content_key(audio_path)
+        audio = cache.get(key)
+        if audio is None:
+            audio = decode_audio(audio_path, sampling_rate=SAMPLE_RATE)
+            cache.put(key, audio)
+        return audio
+    
+    def _transcribe_with_loop_detection(
+        self,
+        audio: "np.ndarray",
+        language: Optional[str],
+        prompt: Optional[str],
+        cancel_token: Optional[CancellationToken],
+        segments: List[Any]
+    ):
+        """
+        セグメントごとに繰り返しを確認しながら推論 (audio はデコード済みの 16kHz モノラル float32)
+        ループを検出したらその時点でデコードを打ち切り、繰り返し部分を除いてループ区間の直後から
+        直前のテキストを条件にせずに再開する (max_skips 回を超えたら以降は打ち切る)
+        
+        Returns:
+            (segments, duration, loops)
+        """
+        config = self.loop_detection
+        detector = RepetitionDetector(config)
+        duration = len(audio) / SAMPLE_RATE
+        options = {"language": language, "initial_prompt": prompt, **self.decode_options}
+        loops: List[Dict[str, Any]] = []
+        features = self.model.feature_extractor
+        with features.reuse(audio):
+            return self._decode_with_loop_detection(
+                audio, features, options, detector, duration, loops, cancel_token, segments
+            )
+    
+    def _decode_with_loop_detection(
+        self,
+        audio: "np.ndarray",
+        features: _ReusableFeatures,
+        options: Dict[str, Any],
+        detector: RepetitionDetector,
+        duration: float,
+        loops: List[Dict[str, Any]],
+        cancel_token: Optional[CancellationToken],
+        segments: List[Any]
+    ):
+        """_transcribe_with_loop_detection の本体 (再開時は最初に計算した特徴量を切り出して使う)"""
+        config = self.loop_detection
+        offset = 0.0
+        frames = 0
+        
+        while True:
+            segments_generator, _ = self.model.transcribe(
+                features.resume(frames) if frames else audio,
+                **options
+            )
+            detector.reset()
+            loop = None
+            for segment in segments_generator:
+                if cancel_token is not None:
+                    cancel_token.check()
+                segment = _shift(segment, offset)
+                reason = detector.check(segment.text, len(segments))
+                if reason is None:
+                    segments.append(segment)
+                    continue
+                
+                # 繰り返しは最初の1回だけ残す (間の空のセグメントは残し、繰り返しに数えたものだけを除く)
+                dropped = [segment]
+                if reason == REPEATED_TEXT:
+                    repeated = set(detector.run[1:-1])
+                    dropped = [segments[i] for i in sorted(repeated)] + dropped
+                    segments[:] = [seg for i, seg in enumerate(segments) if i not in repeated]
+                loop = {
+                    "start": dropped[0].start,
+                    "end": segment.end,
+                    "reason": reason,
+                    "dropped_segments": len(dropped),
+                    "text": segment.text.strip()[:100],
+                }
+                break
+            
+            if loop is None:
+                return segments, duration, loops
+            
+            # 残りのウィンドウはデコードしない
+            segments_generator.close()
+            loops.append(loop)
+            if len(loops) > config.max_skips or loop["end"] >= duration - 1.0:
+                loop["action"] = "stopped"
+                logger.warning(
+                    f"Repetition loop ({loop['reason']}) at {loop['start']:.1f}-{loop['end']:.1f}s, "
+                    f"stopping decode: {loop['text'][:40]}"
+                )
+                return segments, duration, loops
+            
+            loop["action"] = "skipped"
+            logger.warning(
+                f"Repetition loop ({loop['reason']}) at {loop['start']:.1f}-{loop['end']:.1f}s, "
+                f"resuming after it: {loop['text'][:40]}"
+            )
+            # 特徴量を切り出せるようフレーム境界に揃える
+            frames = int(max(loop["end"], offset + 1.0) * SAMPLE_RATE) // features.hop_length
+            offset = frames * features.hop_length / SAMPLE_RATE
+            # ループしたテキストを次のウィンドウの条件にしない
+            options["condition_on_previous_text"] = False
+    
     def _build_verbose_response(
         self, 
         segments: List[Any], 
         full_text: str,
         duration: float,
-        language: Optional[str]
+        language: Optional[str],
+        segment_fields: Optional[Sequence[str]] = None
     ) -> Dict[str, Any]:
         """verbose_json形式のレスポンスを構築"""
         
-        api_segments = []
-        for i, seg in enumerate(segments):
-            api_segments.append({
-                "id": i,
-                "seek": getattr(seg, "seek", 0), # faster-whisperのバージョンによる
-                "start": seg.start,
-                "end": seg.end,
-                "text": seg.text.strip(),
-                "tokens": seg.tokens,
-                "temperature": getattr(seg, "temperature", 0.0),
-                "avg_logprob": getattr(seg, "avg_logprob", 0.0),
-                "compression_ratio": getattr(seg, "compression_ratio", 0.0),
-                "no_speech_prob": getattr(seg, "no_speech_prob", 0.0)
-            })
+        if segment_fields is not None:
+            # 選択された項目のみ生成する (tokens 等の大きい項目を省略した場合の構築・シリアライズを軽くする)
+            getters = [(f, _SEGMENT_GETTERS[f]) for f in segment_fields]
+            api_segments = [{f: get(i, seg) for f, get in getters} for i, seg in enumerate(segments)]
+        else:
+            api_segments = []
+            for i, seg in enumerate(segments):
+                api_segments.append({
+                    "id": i,
+                    "seek": getattr(seg, "seek", 0), # faster-whisperのバージョンによる
+                    "start": seg.start,
+                    "end": seg.end,
+                    "text": seg.text.strip(),
+                    "tokens": seg.tokens,
+                    "temperature": getattr(seg, "temperature", 0.0),
+                    "avg_logprob": getattr(seg, "avg_logprob", 0.0),
+                    "compression_ratio": getattr(seg, "compression_ratio", 0.0),
+                    "no_speech_prob": getattr(seg, "no_speech_prob", 0.0)
+                })
         
         return {
             "task": "transcribe",
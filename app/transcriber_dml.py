@@ -5,7 +5,6 @@ from transformers import pipeline
 import torch_directml
 
 # ロギング設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class WhisperInference:
@@ -59,7 +58,7 @@ class WhisperInference:
         response_format: str = "json"
     ) -> Dict[str, Any]:
         
-        logger.info(f"Transcribing {audio_file} (Language: {language})")
+        logger.debug(f"Transcribing {audio_file} (Language: {language})")
         
         generate_kwargs = {}
         if language:
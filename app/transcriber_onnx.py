@@ -1,39 +1,237 @@
 """
-ONNX Runtime + DirectML を使用した Whisper推論エンジン
-WSL2環境でAMD GPU (Radeon 780M) を使用
+ONNX Runtime を使用した Whisper推論エンジン
+CPU / DirectML 対応。エクスポート済み・グラフ最適化済み・INT8量子化済みのONNXモデルを
+ディスクにキャッシュし、2回目以降の起動ではエクスポートをスキップする
 """
 import os
+import shutil
 import logging
-from typing import Optional, Dict, Any
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Optional, Dict, Any, Union, BinaryIO
 
 import onnxruntime as ort
-from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
-from transformers import AutoProcessor, pipeline
+
+from .cancellation import CancellationToken
+from .audio import decoded_audio, is_mappable, TARGET_SAMPLE_RATE
+from .tenants import report_audio_seconds
 
 # ロギング設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# キャッシュのルート (ONNX_CACHE_DIR で上書き可)
+DEFAULT_ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "whisper-server", "onnx")
+
+# キャッシュが書き込み完了していることを示すマーカー
+_CACHE_MARKER = ".complete"
+
+_GRAPH_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def resolve_model_id(model_size: str) -> str:
+    """モデルサイズ名 (small, large-v3 等) または HuggingFace のモデルIDを正規化"""
+    if "/" in model_size:
+        return model_size
+    return f"openai/whisper-{model_size}"
+
+
+def get_onnx_cache_dir(model_id: str, variant: str) -> Path:
+    """モデルIDとORTバージョンをキーにしたキャッシュディレクトリ"""
+    root = Path(os.getenv("ONNX_CACHE_DIR", DEFAULT_ONNX_CACHE_DIR))
+    return root / model_id.replace("/", "--") / f"ort-{ort.__version__}" / variant
+
+
+def _is_cached(path: Path) -> bool:
+    return (path / _CACHE_MARKER).exists()
+
+
+def _mark_cached(path: Path):
+    (path / _CACHE_MARKER).touch()
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def build_session_options(
+    intra_op_threads: Optional[int] = None,
+    inter_op_threads: Optional[int] = None,
+    graph_optimization_level: Optional[str] = None,
+    enable_mem_arena: Optional[bool] = None
+) -> ort.SessionOptions:
+    """
+    ONNX Runtime のセッションオプションを構築
+    未指定の項目は環境変数 (ONNX_INTRA_OP_THREADS, ONNX_INTER_OP_THREADS,
+    ONNX_GRAPH_OPT_LEVEL, ONNX_ENABLE_MEM_ARENA) から読み込む
+    """
+    if intra_op_threads is None:
+        intra_op_threads = _env_int("ONNX_INTRA_OP_THREADS")
+    if inter_op_threads is None:
+        inter_op_threads = _env_int("ONNX_INTER_OP_THREADS")
+    if graph_optimization_level is None:
+        graph_optimization_level = os.getenv("ONNX_GRAPH_OPT_LEVEL", "all")
+    if enable_mem_arena is None:
+        enable_mem_arena = os.getenv("ONNX_ENABLE_MEM_ARENA", "1") == "1"
+
+    if graph_optimization_level not in _GRAPH_OPT_LEVELS:
+        raise ValueError(
+            f"Unknown graph optimization level: {graph_optimization_level} "
+            f"(expected one of {list(_GRAPH_OPT_LEVELS)})"
+        )
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads or os.cpu_count()
+    if inter_op_threads:
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    options.graph_optimization_level = _GRAPH_OPT_LEVELS[graph_optimization_level]
+    options.enable_cpu_mem_arena = enable_mem_arena
+    return options
+
+
+def export_onnx_model(model_id: str) -> Path:
+    """
+    ONNXエクスポート結果をキャッシュに保存 (キャッシュ済みなら何もしない)
+
+    Returns:
+        エクスポート済みモデルのディレクトリ
+    """
+    export_dir = get_onnx_cache_dir(model_id, "exported")
+    if _is_cached(export_dir):
+        logger.info(f"Using cached ONNX export: {export_dir}")
+        return export_dir
+
+    from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+    from transformers import AutoProcessor
+
+    logger.info(f"Exporting {model_id} to ONNX (first run only): {export_dir}")
+    shutil.rmtree(export_dir, ignore_errors=True)
+    export_dir.mkdir(parents=True, exist_ok=True)
+
+    model = ORTModelForSpeechSeq2Seq.from_pretrained(
+        model_id,
+        export=True,
+        provider="CPUExecutionProvider"
+    )
+    model.save_pretrained(export_dir)
+    AutoProcessor.from_pretrained(model_id).save_pretrained(export_dir)
+    _mark_cached(export_dir)
+    return export_dir
+
+
+def optimize_onnx_model(model_id: str, source_dir: Path) -> Path:
+    """
+    ONNX Runtime のオフライングラフ最適化を実行し、結果をキャッシュに保存
+    最適化後のグラフはCPUプロバイダ向けのため、DirectML では使用しない
+
+    Returns:
+        最適化済みモデルのディレクトリ
+    """
+    optimized_dir = get_onnx_cache_dir(model_id, "optimized")
+    if _is_cached(optimized_dir):
+        logger.info(f"Using cached optimized ONNX model: {optimized_dir}")
+        return optimized_dir
+
+    logger.info(f"Optimizing ONNX graphs: {optimized_dir}")
+    shutil.rmtree(optimized_dir, ignore_errors=True)
+    # 設定ファイル・トークナイザーをそのままコピーし、.onnx だけ最適化版で置き換える
+    shutil.copytree(source_dir, optimized_dir, ignore=shutil.ignore_patterns(_CACHE_MARKER))
+
+    for onnx_path in sorted(source_dir.glob("*.onnx")):
+        target = optimized_dir / onnx_path.name
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        options.optimized_model_filepath = str(target)
+        # セッション生成時に最適化済みグラフが書き出される
+        ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        logger.info(f"Optimized {onnx_path.name}")
+
+    _mark_cached(optimized_dir)
+    return optimized_dir
+
+
+def quantize_onnx_model(model_id: str, source_dir: Path) -> Path:
+    """
+    エンコーダ/デコーダのONNXモデルを動的INT8量子化し、結果をキャッシュに保存
+    重みのみINT8化し、活性化は実行時に量子化する (キャリブレーションデータ不要)
+    量子化演算子はCPUプロバイダ専用
+
+    Returns:
+        量子化済みモデルのディレクトリ
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantized_dir = get_onnx_cache_dir(model_id, "int8")
+    if _is_cached(quantized_dir):
+        logger.info(f"Using cached INT8 ONNX model: {quantized_dir}")
+        return quantized_dir
+
+    logger.info(f"Quantizing ONNX model to INT8: {quantized_dir}")
+    shutil.rmtree(quantized_dir, ignore_errors=True)
+    # .onnx と外部データファイル以外 (設定ファイル・トークナイザー) をコピー
+    shutil.copytree(
+        source_dir,
+        quantized_dir,
+        ignore=shutil.ignore_patterns(_CACHE_MARKER, "*.onnx", "*.onnx_data", "*.onnx.data")
+    )
+
+    # 2GBを超えるモデル (large系) は外部データ形式で保存されている
+    use_external_data = any(source_dir.glob("*.onnx_data")) or any(source_dir.glob("*.onnx.data"))
+
+    for onnx_path in sorted(source_dir.glob("*.onnx")):
+        quantize_dynamic(
+            model_input=str(onnx_path),
+            model_output=str(quantized_dir / onnx_path.name),
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            op_types_to_quantize=["MatMul", "Gemm"],
+            use_external_data_format=use_external_data
+        )
+        logger.info(f"Quantized {onnx_path.name}")
+
+    _mark_cached(quantized_dir)
+    return quantized_dir
+
+
 class WhisperInference:
-    def __init__(self, model_size: str = "large-v3", device: str = "gpu", compute_type: str = "float32"):
+    def __init__(
+        self,
+        model_size: str = "large-v3",
+        device: str = "gpu",
+        compute_type: str = "float32",
+        session_options: Optional[ort.SessionOptions] = None
+    ):
         """
-        ONNX Runtime + DirectML バックエンドでWhisperモデルをロード
-        
+        ONNX Runtime バックエンドでWhisperモデルをロード
+
         Args:
-            model_size: モデルサイズ (base, small, medium, large-v3等)
+            model_size: モデルサイズ (base, small, medium, large-v3等) または HuggingFace のモデルID
             device: "gpu" (DirectML) or "cpu"
-            compute_type: 現在は float32 のみ対応
+            compute_type: "float32" または "int8" (動的量子化、CPUのみ)
+            session_options: ONNX Runtime のセッションオプション (省略時は環境変数から構築)
         """
-        self.model_id = f"openai/whisper-{model_size}"
-        if model_size == "large-v3":
-            self.model_id = "openai/whisper-large-v3"
-        
+        if compute_type not in ("float32", "int8"):
+            raise ValueError(f"Unsupported compute_type for ONNX backend: {compute_type}")
+
+        self.model_id = resolve_model_id(model_size)
+        self._compute_type = compute_type
+        self.session_options = session_options or build_session_options()
+
         # ONNX Runtime のプロバイダー設定
         # DirectML execution provider を使用してGPU加速
         available_providers = ort.get_available_providers()
         logger.info(f"Available ONNX Runtime providers: {available_providers}")
-        
-        if device == "gpu" and "DmlExecutionProvider" in available_providers:
+
+        if device == "gpu" and compute_type == "int8":
+            logger.warning("INT8 quantized models run on CPU only, ignoring GPU request")
+            self.provider = "CPUExecutionProvider"
+        elif device == "gpu" and "DmlExecutionProvider" in available_providers:
             self.provider = "DmlExecutionProvider"
             logger.info("Using DirectML (DmlExecutionProvider) for GPU acceleration")
         elif device == "gpu":
@@ -42,90 +240,119 @@ class WhisperInference:
         else:
             self.provider = "CPUExecutionProvider"
             logger.info("Using CPU execution provider")
-        
+
         logger.info(f"Loading ONNX model: {self.model_id} with provider: {self.provider}")
-        
+
         try:
-            # Optimum を使用して ONNX 形式でモデルをロード
-            # export=True で自動的に ONNX にエクスポート (初回のみ)
-            self.processor = AutoProcessor.from_pretrained(self.model_id)
-            self.model = ORTModelForSpeechSeq2Seq.from_pretrained(
-                self.model_id,
-                export=True,  # 初回は変換が必要
-                provider=self.provider
-            )
-            
-            # パイプラインを作成 (device_id はDirectMLでは使用しない)
-            self.pipe = pipeline(
-                "automatic-speech-recognition",
-                model=self.model,
-                tokenizer=self.processor.tokenizer,
-                feature_extractor=self.processor.feature_extractor,
-                chunk_length_s=30,
-            )
-            
+            self._load_pipeline()
             logger.info("ONNX model loaded successfully.")
         except Exception as e:
+            if self.provider == "CPUExecutionProvider":
+                logger.error(f"Failed to load ONNX model: {e}")
+                raise RuntimeError("All model loading attempts failed.") from e
+
             logger.error(f"Failed to load ONNX model: {e}")
             logger.warning("Attempting CPU fallback...")
-            
+
             try:
                 self.provider = "CPUExecutionProvider"
-                self.processor = AutoProcessor.from_pretrained(self.model_id)
-                self.model = ORTModelForSpeechSeq2Seq.from_pretrained(
-                    self.model_id,
-                    export=True,
-                    provider=self.provider
-                )
-                self.pipe = pipeline(
-                    "automatic-speech-recognition",
-                    model=self.model,
-                    tokenizer=self.processor.tokenizer,
-                    feature_extractor=self.processor.feature_extractor,
-                    chunk_length_s=30,
-                )
+                self._load_pipeline()
                 logger.info("Fallback to CPU successful.")
             except Exception as fb_e:
                 logger.error(f"CPU fallback also failed: {fb_e}")
                 raise RuntimeError("All model loading attempts failed.") from fb_e
 
+    def _resolve_model_dir(self) -> Path:
+        """キャッシュ済みのモデルディレクトリを取得 (未キャッシュならエクスポート)"""
+        export_dir = export_onnx_model(self.model_id)
+        if self._compute_type == "int8":
+            # 量子化は最適化前のグラフに対して行う (融合済み演算子は量子化対象外になるため)
+            return quantize_onnx_model(self.model_id, export_dir)
+        if self.provider != "CPUExecutionProvider":
+            return export_dir
+        try:
+            return optimize_onnx_model(self.model_id, export_dir)
+        except Exception as e:
+            logger.warning(f"Offline graph optimization failed, using exported model: {e}")
+            return export_dir
+
+    def _load_pipeline(self):
+        """キャッシュからONNXモデルをロードしてパイプラインを作成"""
+        # optimum / transformers (torch) は import に時間がかかるため、ロード時まで遅延させる
+        from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+        from transformers import AutoProcessor, pipeline
+
+        model_dir = self._resolve_model_dir()
+
+        self.processor = AutoProcessor.from_pretrained(model_dir)
+        self.model = ORTModelForSpeechSeq2Seq.from_pretrained(
+            model_dir,
+            export=False,
+            provider=self.provider,
+            session_options=self.session_options
+        )
+
+        # パイプラインを作成 (device_id はDirectMLでは使用しない)
+        self.pipe = pipeline(
+            "automatic-speech-recognition",
+            model=self.model,
+            tokenizer=self.processor.tokenizer,
+            feature_extractor=self.processor.feature_extractor,
+            chunk_length_s=30,
+        )
+
     def transcribe(
-        self, 
-        audio_file: str, 
-        language: Optional[str] = None, 
+        self,
+        audio_path: Union[str, BinaryIO],
+        language: Optional[str] = None,
         prompt: Optional[str] = None,
-        response_format: str = "json"
+        response_format: str = "json",
+        cancel_token: Optional[CancellationToken] = None
     ) -> Dict[str, Any]:
         """
         音声ファイルを文字起こし
-        
+
         Args:
-            audio_file: 音声ファイルのパス
+            audio_path: 音声ファイルのパス または ファイルオブジェクト
             language: 言語コード (ja, en など)
             prompt: 初期プロンプト (現在は未使用)
             response_format: "json" or "verbose_json"
-        
+            cancel_token: 推論開始前にキャンセルを確認 (パイプライン実行中は中断できない)
+
         Returns:
             Azure OpenAI互換のレスポンス
         """
-        logger.info(f"Transcribing {audio_file} (Language: {language})")
-        
+        logger.debug(f"Transcribing {audio_path if isinstance(audio_path, str) else 'Buffered Reader'} (Language: {language})")
+
         generate_kwargs = {}
         if language:
             generate_kwargs["language"] = language
-        
-        try:
-            result = self.pipe(
-                audio_file,
-                return_timestamps=True,
-                generate_kwargs=generate_kwargs
-            )
-        except Exception as e:
-            logger.error(f"Transcription failed: {e}")
-            raise e
-        
+
+        if cancel_token is not None:
+            cancel_token.check()
+
+        with ExitStack() as stack:
+            if isinstance(audio_path, str) and is_mappable(audio_path):
+                # サーバーローカルの WAV / raw PCM は mmap で参照した配列を渡す (ffmpeg でデコードしない)
+                audio = stack.enter_context(decoded_audio(audio_path))
+                audio_input = {"raw": audio, "sampling_rate": TARGET_SAMPLE_RATE}
+                report_audio_seconds(len(audio) / TARGET_SAMPLE_RATE)
+            else:
+                # パイプラインはファイルパスかバイト列を受け付ける
+                audio_input = audio_path.read() if hasattr(audio_path, "read") else audio_path
+
+            try:
+                result = self.pipe(
+                    audio_input,
+                    return_timestamps=True,
+                    generate_kwargs=generate_kwargs
+                )
+            except Exception as e:
+                logger.error(f"Transcription failed: {e}")
+                raise e
+
         text = result["text"]
-        
+
         if response_format == "verbose_json":
             segments = []
             if "chunks" in result:
@@ -144,7 +371,7 @@ class WhisperInference:
                         "compression_ratio": 0.0,
                         "no_speech_prob": 0.0
                     })
-            
+
             return {
                 "task": "transcribe",
                 "language": language or "unknown",
@@ -156,3 +383,19 @@ class WhisperInference:
             return {
                 "text": text
             }
+
+    @property
+    def model_size(self) -> str:
+        return self.model_id
+
+    @property
+    def device(self) -> str:
+        return "gpu" if self.provider == "DmlExecutionProvider" else "cpu"
+
+    @property
+    def compute_type(self) -> str:
+        return self._compute_type
+
+    @property
+    def is_gpu_enabled(self) -> bool:
+        return self.provider == "DmlExecutionProvider"
@@ -0,0 +1,296 @@
+"""
+Hardware Auto-Tuner
+Sweeps thread counts, replica counts, batch sizes and compute types for one backend on the
+local machine, measures throughput and p95 latency on local audio, and writes the best
+combination as a deployment config file (same format as deployments.example.yaml)
+
+Usage:
+    python autotune.py --backend faster-whisper --audio sample1.wav sample2.mp3 --output tuned.yaml
+    python autotune.py --backend reazonspeech --audio clips/*.wav --batch-sizes 1 8 16 --objective latency
+    python autotune.py --backend faster-whisper --audio a.wav --max-p95 10 --report autotune_report.json
+"""
+import io
+import os
+import json
+import math
+import time
+import asyncio
+import argparse
+import itertools
+import traceback
+from dataclasses import dataclass
+from typing import List, Dict, Any, Optional
+
+from app.deployment_config import DeploymentConfig, BACKENDS
+from app.model_registry import Deployment
+from app.audio import probe_duration
+from app.batch import transcribe_batch
+
+OBJECTIVES = ["throughput", "latency"]
+
+# backend ごとに試す compute_type の既定値
+DEFAULT_COMPUTE_TYPES = {
+    "faster-whisper": ["int8", "int8_float32", "float32", "int8_float16", "float16", "bfloat16", "int8_bfloat16"],
+    "reazonspeech": ["fp32", "int8", "int8-fp32"],
+    "onnx": ["float32", "int8"],
+}
+
+
+@dataclass
+class Clip:
+    name: str
+    data: bytes
+    duration: float
+
+
+def load_clips(paths: List[str]) -> List[Clip]:
+    """音声ファイルをメモリに読み込む (ディスクI/Oを計測に含めない)"""
+    clips = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        duration = probe_duration(io.BytesIO(data))
+        clips.append(Clip(os.path.basename(path), data, duration or 0.0))
+    return clips
+
+
+def supported_compute_types(backend: str, device: str, requested: Optional[List[str]]) -> List[str]:
+    """試す compute_type の一覧 (faster-whisper は CTranslate2 が対応するものだけに絞る)"""
+    candidates = requested or DEFAULT_COMPUTE_TYPES.get(backend, [None])
+    if backend == "faster-whisper":
+        try:
+            import ctranslate2
+            supported = ctranslate2.get_supported_compute_types(device)
+            skipped = [c for c in candidates if c not in supported]
+            if skipped:
+                print(f"Skipping compute types not supported on {device}: {skipped}")
+            candidates = [c for c in candidates if c in supported]
+        except Exception as e:
+            print(f"Could not query CTranslate2 compute types: {e}")
+    return candidates
+
+
+def default_thread_counts(cpu_count: int) -> List[int]:
+    """1, 2, 4, ... と CPU コア数"""
+    counts = [2 ** i for i in range(cpu_count.bit_length()) if 2 ** i <= cpu_count]
+    if cpu_count not in counts:
+        counts.append(cpu_count)
+    return counts
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    # nearest-rank 法
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def run_trial(config: DeploymentConfig, clips: List[Clip], num_requests: int, language: str) -> Dict[str, Any]:
+    """1つの組み合わせでデプロイメントをロードし、並列にリクエストを流して計測"""
+    loop = asyncio.get_running_loop()
+    load_start = time.perf_counter()
+    deployment = await loop.run_in_executor(None, Deployment.from_config, config)
+    load_time = time.perf_counter() - load_start
+
+    try:
+        await deployment.warm_up()
+
+        jobs = [clips[i % len(clips)] for i in range(num_requests)]
+        groups = [jobs[i:i + config.max_batch_size] for i in range(0, len(jobs), config.max_batch_size)]
+        # 常に待ち行列が空にならないよう、同時実行数の2倍のクライアントから送り続ける
+        clients = asyncio.Semaphore(config.max_concurrency * 2)
+        latencies: List[float] = []
+        errors = 0
+
+        async def send(group: List[Clip]):
+            nonlocal errors
+            async with clients:
+                start = time.perf_counter()
+                if len(group) > 1:
+                    results = await transcribe_batch(
+                        deployment,
+                        [(c.name, io.BytesIO(c.data)) for c in group],
+                        language=language,
+                        prompt=None,
+                        response_format="json",
+                        durations=[c.duration for c in group]
+                    )
+                    errors += sum(1 for r in results if r["status"] != "succeeded")
+                else:
+                    clip = group[0]
+                    await deployment.run(
+                        lambda t: t.transcribe(io.BytesIO(clip.data), language=language),
+                        cost=clip.duration
+                    )
+                latencies.extend([time.perf_counter() - start] * len(group))
+
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(send(g) for g in groups))
+        wall = time.perf_counter() - wall_start
+    finally:
+        deployment.close()
+
+    audio_seconds = sum(c.duration for c in jobs)
+    return {
+        "load_time": round(load_time, 2),
+        "wall_time": round(wall, 2),
+        "requests": len(jobs),
+        "errors": errors,
+        "throughput_rps": round(len(jobs) / wall, 3),
+        "audio_seconds_per_second": round(audio_seconds / wall, 2),
+        "p50_latency": round(percentile(latencies, 50), 3),
+        "p95_latency": round(percentile(latencies, 95), 3),
+    }
+
+
+def build_trials(args, cpu_count: int) -> List[DeploymentConfig]:
+    """スイープする組み合わせの一覧 (スレッド数 × レプリカ数が CPU コア数を超えるものは除外)"""
+    threads = args.threads or default_thread_counts(cpu_count)
+    compute_types = supported_compute_types(args.backend, args.device, args.compute_types)
+    batch_sizes = args.batch_sizes if args.backend == "reazonspeech" else [1]
+    if args.backend != "reazonspeech" and args.batch_sizes != [1]:
+        print(f"Batch sizes are only swept for reazonspeech; using 1 for {args.backend}")
+
+    trials = []
+    for compute_type, cpu_threads, replicas, batch_size in itertools.product(
+        compute_types, threads, args.replicas, batch_sizes
+    ):
+        if cpu_threads * replicas > cpu_count and not args.oversubscribe:
+            continue
+        trials.append(DeploymentConfig(
+            name=args.name or args.backend,
+            backend=args.backend,
+            model=args.model,
+            device=args.device,
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            replicas=replicas,
+            max_batch_size=batch_size,
+        ))
+    return trials
+
+
+def select_best(results: List[Dict[str, Any]], objective: str, max_p95: Optional[float]) -> Optional[Dict[str, Any]]:
+    """目的に応じて最良の組み合わせを選ぶ (max_p95 を超える組み合わせは除外)"""
+    valid = [r for r in results if "metrics" in r and not r["metrics"]["errors"]]
+    if max_p95 is not None:
+        valid = [r for r in valid if r["metrics"]["p95_latency"] <= max_p95]
+    if not valid:
+        return None
+    if objective == "latency":
+        return min(valid, key=lambda r: (r["metrics"]["p95_latency"], -r["metrics"]["audio_seconds_per_second"]))
+    return max(valid, key=lambda r: (r["metrics"]["audio_seconds_per_second"], -r["metrics"]["p95_latency"]))
+
+
+def config_to_dict(config: DeploymentConfig) -> Dict[str, Any]:
+    entry = {
+        "name": config.name,
+        "backend": config.backend,
+        "model": config.model,
+        "device": config.device,
+        "compute_type": config.compute_type,
+        "cpu_threads": config.cpu_threads,
+        "replicas": config.replicas,
+        "max_concurrency": config.max_concurrency,
+        "max_batch_size": config.max_batch_size,
+    }
+    return {k: v for k, v in entry.items() if v is not None}
+
+
+def write_config(path: str, config: DeploymentConfig):
+    """最良の組み合わせをデプロイメント設定ファイルとして書き出す"""
+    data = {"default_deployment": config.name, "deployments": [config_to_dict(config)]}
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "w", encoding="utf-8") as f:
+        if ext in (".yaml", ".yml"):
+            import yaml
+            yaml.safe_dump(data, f, allow_unicode=True, sort_keys=False)
+        elif ext == ".json":
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        else:
+            raise ValueError(f"Unsupported output format: {path} (expected .json, .yaml or .yml)")
+    print(f"Config written to {path}")
+
+
+def print_results(results: List[Dict[str, Any]], best: Optional[Dict[str, Any]]):
+    print("\n" + "="*78)
+    print("SUMMARY")
+    print("="*78)
+    print(f"{'Compute':<14} {'Threads':<8} {'Replicas':<9} {'Batch':<6} {'Audio s/s':<10} {'p50':<8} {'p95':<8} {'Errors':<6}")
+    print("-"*78)
+    for r in results:
+        c = r["config"]
+        prefix = f"{str(c.get('compute_type')):<14} {c['cpu_threads']:<8} {c['replicas']:<9} {c['max_batch_size']:<6} "
+        if "metrics" not in r:
+            print(prefix + f"FAILED: {r['error']}")
+            continue
+        m = r["metrics"]
+        mark = "  <- best" if r is best else ""
+        print(prefix + f"{m['audio_seconds_per_second']:<10} {m['p50_latency']:<8} {m['p95_latency']:<8} {m['errors']:<6}{mark}")
+
+
+async def tune(args) -> List[Dict[str, Any]]:
+    cpu_count = os.cpu_count() or 1
+    clips = load_clips(args.audio)
+    trials = build_trials(args, cpu_count)
+    print(f"CPU cores: {cpu_count}, audio: {sum(c.duration for c in clips):.1f}s in {len(clips)} files, trials: {len(trials)}")
+
+    results = []
+    for i, config in enumerate(trials, 1):
+        print(
+            f"\n[{i}/{len(trials)}] compute_type={config.compute_type} cpu_threads={config.cpu_threads} "
+            f"replicas={config.replicas} max_batch_size={config.max_batch_size}"
+        )
+        num_requests = args.requests or max(len(clips), config.max_concurrency * config.max_batch_size * 4)
+        entry = {"config": config_to_dict(config)}
+        try:
+            entry["metrics"] = await run_trial(config, clips, num_requests, args.language)
+            m = entry["metrics"]
+            print(f"  {m['audio_seconds_per_second']} audio s/s, p95 {m['p95_latency']}s, load {m['load_time']}s")
+        except Exception as e:
+            print(f"  Failed: {e}")
+            traceback.print_exc()
+            entry["error"] = str(e)
+        results.append(entry)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep server settings on this machine and write the best deployment config")
+    parser.add_argument("--backend", type=str, default="faster-whisper", choices=list(BACKENDS), help="Backend to tune (default: faster-whisper)")
+    parser.add_argument("--model", type=str, default=None, help="Model path/name (backend default if omitted)")
+    parser.add_argument("--name", type=str, default=None, help="Deployment name in the written config (default: backend name)")
+    parser.add_argument("--device", type=str, default="cpu", help="Device (default: cpu)")
+    parser.add_argument("--audio", nargs="+", required=True, metavar="AUDIO", help="Local audio files used as the workload")
+    parser.add_argument("--language", type=str, default="ja", help="Language code (default: ja)")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="cpu_threads values (default: 1, 2, 4, ... up to the core count)")
+    parser.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 4], help="Replica counts (default: 1 2 4)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1], help="max_batch_size values (reazonspeech only, default: 1)")
+    parser.add_argument("--compute-types", nargs="+", default=None, help="Compute types (default: all supported for the backend)")
+    parser.add_argument("--requests", type=int, default=None, help="Requests per trial (default: 4x the concurrent capacity)")
+    parser.add_argument("--objective", type=str, default="throughput", choices=OBJECTIVES, help="Selection objective (default: throughput)")
+    parser.add_argument("--max-p95", type=float, default=None, help="Discard combinations whose p95 latency exceeds this many seconds")
+    parser.add_argument("--oversubscribe", action="store_true", help="Also try threads x replicas above the core count")
+    parser.add_argument("--output", type=str, default="autotuned.yaml", help="Config file to write (.yaml/.json, default: autotuned.yaml)")
+    parser.add_argument("--report", type=str, default=None, help="Write all trial results as JSON")
+
+    args = parser.parse_args()
+
+    results = asyncio.run(tune(args))
+    best = select_best(results, args.objective, args.max_p95)
+    print_results(results, best)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"objective": args.objective, "max_p95": args.max_p95, "best": best, "trials": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"Report written to {args.report}")
+
+    if best is None:
+        print("\nNo combination satisfied the objective; config not written.")
+        return
+
+    write_config(args.output, DeploymentConfig(**best["config"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Audio Preprocessing Micro-Benchmark
+Runs each preprocessing stage of the ReazonSpeech path (decode -> downmix -> resample
+-> audio_from_numpy) on generated signals across formats, sample rates, channel counts and
+durations, reports time and peak memory per stage, and fails on regression against a baseline
+
+Usage:
+    python benchmark_preprocess.py --update-baseline          # record the baseline on this machine
+    python benchmark_preprocess.py                            # compare against the baseline (exit 1 on regression)
+    python benchmark_preprocess.py --quick --formats wav mp3 --output result.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import tracemalloc
+from typing import Dict, Any, List, Optional, Callable
+
+import numpy as np
+import soundfile as sf
+import scipy
+
+from app.audio import BufferPool, read_pcm, downmix, resample, decoded_audio, TARGET_SAMPLE_RATE
+
+# soundfile の format / subtype
+FORMATS = {
+    "wav": ("WAV", "PCM_16"),
+    "flac": ("FLAC", "PCM_16"),
+    "ogg": ("OGG", "VORBIS"),
+    "mp3": ("MP3", "MPEG_LAYER_III"),  # libsndfile 1.1.0 以降
+}
+
+DEFAULT_SAMPLE_RATES = [16000, 44100, 48000]
+DEFAULT_CHANNELS = [1, 2]
+DEFAULT_DURATIONS = [5, 60]
+QUICK_DURATIONS = [5]
+
+DEFAULT_BASELINE = "preprocess_baseline.json"
+
+
+def generate_signal(duration: float, sr: int, channels: int, seed: int = 0) -> np.ndarray:
+    """音声に近い信号 (複数の正弦波 + 振幅変調 + ノイズ) を生成"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr), dtype=np.float64) / sr
+    data = np.empty((len(t), channels), dtype=np.float32)
+    for ch in range(channels):
+        tone = sum(np.sin(2 * np.pi * f * t + ch) / (i + 1) for i, f in enumerate((220.0, 440.0, 1250.0)))
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3.0 * t)
+        data[:, ch] = 0.2 * tone * envelope + 0.01 * rng.standard_normal(len(t))
+    return data
+
+
+def encode(data: np.ndarray, sr: int, fmt: str) -> Optional[bytes]:
+    """生成した信号を指定形式にエンコード (libsndfile が未対応なら None)"""
+    container, subtype = FORMATS[fmt]
+    buf = io.BytesIO()
+    try:
+        sf.write(buf, data, sr, format=container, subtype=subtype)
+    except Exception:
+        return None
+    return buf.getvalue()
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """実行時間の中央値 (ms) と、別の1回で計測したピークメモリ (MB)"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    # tracemalloc は実行時間に影響するため、計時とは別に実行する (numpy の確保も追跡される)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"time_ms": round(statistics.median(times), 3), "peak_mb": round(peak / (1024 * 1024), 3)}
+
+
+def load_audio_from_numpy():
+    try:
+        from reazonspeech.k2.asr import audio_from_numpy
+        return audio_from_numpy
+    except ImportError:
+        return None
+
+
+def bench_case(payload: bytes, repeat: int, audio_from_numpy) -> Dict[str, Dict[str, float]]:
+    """
+    1ケース分の各段階を計測 (各段階の入力は前段の出力を事前に用意して渡す)
+    サーバーと同じくバッファプールを使うため、ピークメモリはプールが温まった状態での確保量になる
+    """
+    pool = BufferPool(max_bytes=1024 * 1024 * 1024)
+    stages = {}
+
+    def pooled(fn):
+        def run():
+            buffers = []
+            try:
+                fn(buffers)
+            finally:
+                for buf in buffers:
+                    pool.release(buf)
+        return run
+
+    stages["decode"] = measure(pooled(lambda buffers: read_pcm(io.BytesIO(payload), pool, buffers)), repeat)
+
+    decoded, sr = read_pcm(io.BytesIO(payload), pool, [])
+
+    def mix(buffers):
+        if decoded.ndim > 1:
+            out = pool.acquire(len(decoded))
+            buffers.append(out)
+            downmix(decoded, out=out)
+    stages["downmix"] = measure(pooled(mix), repeat)
+
+    mono = downmix(decoded)
+    stages["resample"] = measure(lambda: resample(mono, sr), repeat)
+
+    if audio_from_numpy is not None:
+        resampled = resample(mono, sr)
+        stages["audio_from_numpy"] = measure(lambda: audio_from_numpy(resampled, TARGET_SAMPLE_RATE), repeat)
+
+    # リクエストと同じ経路全体 (decoded_audio)
+    def total():
+        with decoded_audio(io.BytesIO(payload), pool=pool):
+            pass
+    stages["total"] = measure(total, repeat)
+    return stages
+
+
+def run_benchmark(formats: List[str], sample_rates: List[int], channels: List[int],
+                  durations: List[float], repeat: int) -> Dict[str, Any]:
+    audio_from_numpy = load_audio_from_numpy()
+    if audio_from_numpy is None:
+        print("reazonspeech not installed; skipping the audio_from_numpy stage")
+
+    cases = {}
+    skipped = set()
+    for fmt in formats:
+        for sr in sample_rates:
+            for ch in channels:
+                for duration in durations:
+                    key = f"{fmt}-{sr}hz-{ch}ch-{duration:g}s"
+                    payload = encode(generate_signal(duration, sr, ch), sr, fmt)
+                    if payload is None:
+                        skipped.add(fmt)
+                        continue
+                    stages = bench_case(payload, repeat, audio_from_numpy)
+                    cases[key] = stages
+                    total = stages["total"]
+                    print(f"{key:<28} total {total['time_ms']:>9.2f}ms  peak {total['peak_mb']:>8.2f}MB")
+
+    if skipped:
+        print(f"Formats not supported by this libsndfile build (skipped): {sorted(skipped)}")
+
+    return {
+        "environment": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "soundfile": sf.__version__,
+            "libsndfile": sf.__libsndfile_version__,
+        },
+        "repeat": repeat,
+        "cases": cases,
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], time_tolerance: float, memory_tolerance: float) -> List[str]:
+    """ベースラインより遅い・メモリを多く使う段階を列挙 (ノイズ程度の差は無視する)"""
+    if result["environment"] != baseline.get("environment"):
+        print("Warning: environment differs from the baseline; timings may not be comparable")
+
+    regressions = []
+    for key, stages in result["cases"].items():
+        base_stages = baseline["cases"].get(key)
+        if base_stages is None:
+            continue
+        for stage, m in stages.items():
+            base = base_stages.get(stage)
+            if base is None:
+                continue
+            if m["time_ms"] > base["time_ms"] * (1 + time_tolerance) and m["time_ms"] - base["time_ms"] > 1.0:
+                regressions.append(f"{key} {stage}: time {base['time_ms']:.2f}ms -> {m['time_ms']:.2f}ms")
+            if m["peak_mb"] > base["peak_mb"] * (1 + memory_tolerance) and m["peak_mb"] - base["peak_mb"] > 0.5:
+                regressions.append(f"{key} {stage}: peak {base['peak_mb']:.2f}MB -> {m['peak_mb']:.2f}MB")
+    return regressions
+
+
+def print_stages(result: Dict[str, Any], baseline: Optional[Dict[str, Any]]):
+    print("\n" + "="*86)
+    print("PER-STAGE RESULTS" + (" (vs baseline)" if baseline else ""))
+    print("="*86)
+    print(f"{'Case':<28} {'Stage':<18} {'Time(ms)':>10} {'Base':>10} {'Peak(MB)':>10} {'Base':>10}")
+    print("-"*86)
+    for key, stages in result["cases"].items():
+        base_stages = (baseline or {}).get("cases", {}).get(key, {})
+        for stage, m in stages.items():
+            base = base_stages.get(stage, {})
+            print(
+                f"{key:<28} {stage:<18} {m['time_ms']:>10.2f} {str(base.get('time_ms', '-')):>10} "
+                f"{m['peak_mb']:>10.2f} {str(base.get('peak_mb', '-')):>10}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark the audio preprocessing stages")
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=list(FORMATS), help="Formats (default: all)")
+    parser.add_argument("--sample-rates", type=int, nargs="+", default=DEFAULT_SAMPLE_RATES, help="Sample rates (default: 16000 44100 48000)")
+    parser.add_argument("--channels", type=int, nargs="+", default=DEFAULT_CHANNELS, help="Channel counts (default: 1 2)")
+    parser.add_argument("--durations", type=float, nargs="+", default=None, help="Durations in seconds (default: 5 60)")
+    parser.add_argument("--quick", action="store_true", help="Only 5 second signals")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage, median is reported (default: 5)")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help=f"Baseline file (default: {DEFAULT_BASELINE})")
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--time-tolerance", type=float, default=0.25, help="Allowed slowdown ratio per stage (default: 0.25)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10, help="Allowed peak memory growth ratio per stage (default: 0.10)")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+
+    args = parser.parse_args()
+    durations = args.durations or (QUICK_DURATIONS if args.quick else DEFAULT_DURATIONS)
+
+    result = run_benchmark(args.formats, args.sample_rates, args.channels, durations, args.repeat)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.update_baseline:
+        print_stages(result, None)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print_stages(result, None)
+        print(f"\nNo baseline at {args.baseline}; run with --update-baseline to record one.")
+        return
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print_stages(result, baseline)
+
+    regressions = compare(result, baseline, args.time_tolerance, args.memory_tolerance)
+    if regressions:
+        print(f"\nREGRESSION ({len(regressions)}):")
+        for r in regressions:
+            print(f"  {r}")
+        sys.exit(1)
+    print("\nNo regression.")
+
+
+if __name__ == "__main__":
+    main()
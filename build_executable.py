@@ -1,6 +1,13 @@
 import PyInstaller.__main__
 import os
 import shutil
+import argparse
+
+from app.deployment_config import BACKENDS
+
+parser = argparse.ArgumentParser(description="Build the WhisperServer executable with PyInstaller")
+parser.add_argument("--include-onnx", action="store_true", help="Bundle the ONNX Runtime backend (pulls in optimum/transformers/torch)")
+args = parser.parse_args()
 
 # Clean previous build
 if os.path.exists("build"):
@@ -10,29 +17,41 @@ if os.path.exists("dist"):
 
 print("Building WhisperServer executable...")
 
+# Backends are imported by name only when a deployment uses them, so PyInstaller cannot see them
+backend_modules = sorted({target.split(":")[0] for target in BACKENDS.values()})
+# The ONNX backend imports optimum/transformers (and through them torch) inside its functions.
+# Following those imports bundles torch whenever it is installed, so it is opt-in
+ONNX_MODULE = BACKENDS["onnx"].split(":")[0]
+ONNX_HEAVY_MODULES = ["optimum", "transformers", "torch"]
+if not args.include_onnx:
+    backend_modules.remove(ONNX_MODULE)
+    print(f"Skipping {ONNX_MODULE} (use --include-onnx to bundle the ONNX Runtime backend)")
+
 PyInstaller.__main__.run([
     'run_app.py',
     '--name=WhisperServer',
     '--clean',
     '--noconfirm',
-    # Collect generic data often needed
-    '--collect-all=sherpa_onnx',
+    # Native libraries only. --collect-all also bundles every submodule and data file
+    # (tests, docs, unused backends), which makes the build larger and the frozen app slower to start
+    '--collect-binaries=sherpa_onnx',
     '--collect-all=soundfile',
-    '--collect-all=uvicorn',
-    '--collect-all=fastapi',
-    # Hidden imports that PyInstaller might miss
+    # Hidden imports that PyInstaller might miss (uvicorn loads its protocol/loop implementations by name)
+    *[f'--hidden-import={module}' for module in backend_modules],
     '--hidden-import=uvicorn.logging',
     '--hidden-import=uvicorn.loops',
     '--hidden-import=uvicorn.loops.auto',
     '--hidden-import=uvicorn.protocols',
     '--hidden-import=uvicorn.protocols.http',
     '--hidden-import=uvicorn.protocols.http.auto',
+    '--hidden-import=uvicorn.protocols.websockets.auto',
     '--hidden-import=uvicorn.lifespan.on',
     '--hidden-import=faster_whisper',
     '--hidden-import=reazonspeech',
 
     # Exclude unnecessary heavy modules if possible (though we need most)
     # '--exclude-module=tkinter',
+    *([] if args.include_onnx else [f'--exclude-module={module}' for module in ONNX_HEAVY_MODULES]),
 ])
 
 # Create a launcher batch file for the exe
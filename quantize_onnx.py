@@ -0,0 +1,179 @@
+"""
+ONNX Whisper INT8 Quantization Tool
+Exports the model to ONNX, builds the dynamically quantized INT8 variant in the cache,
+and optionally compares float32 vs INT8 accuracy and speed on local audio files
+
+Usage:
+    python quantize_onnx.py --model small
+    python quantize_onnx.py --model small --report audio1.wav audio2.mp3 --output report.json
+"""
+import os
+import json
+import time
+import argparse
+import traceback
+
+from app.audio import probe_duration
+from app.transcriber_onnx import (
+    WhisperInference,
+    resolve_model_id,
+    export_onnx_model,
+    quantize_onnx_model,
+)
+
+COMPUTE_TYPES = ["float32", "int8"]
+
+
+def char_error_rate(reference: str, hypothesis: str) -> float:
+    """文字誤り率 (日本語向けに文字単位のレーベンシュタイン距離で計算)"""
+    ref = reference.replace(" ", "")
+    hyp = hypothesis.replace(" ", "")
+    if not ref:
+        return 0.0 if not hyp else 1.0
+
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        curr = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            curr[j] = min(prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = curr
+    return prev[-1] / len(ref)
+
+
+def dir_size_mb(path) -> float:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file()) / (1024 * 1024)
+
+
+def load_reference(audio_file: str):
+    """音声ファイルと同名の .txt があれば正解テキストとして使用"""
+    ref_path = os.path.splitext(audio_file)[0] + ".txt"
+    if os.path.exists(ref_path):
+        with open(ref_path, encoding="utf-8") as f:
+            return f.read().strip()
+    return None
+
+
+def benchmark_variant(model: str, compute_type: str, audio_files, language: str, runs: int):
+    """1つの量子化バリアントをロードして全音声を文字起こし"""
+    print("\n" + "="*50)
+    print(f"{compute_type} Benchmark")
+    print("="*50)
+
+    load_start = time.time()
+    transcriber = WhisperInference(model_size=model, device="cpu", compute_type=compute_type)
+    load_time = time.time() - load_start
+    print(f"Model loaded in {load_time:.2f}s")
+
+    results = {}
+    for audio_file in audio_files:
+        times = []
+        text = ""
+        for _ in range(runs):
+            start = time.time()
+            text = transcriber.transcribe(audio_file, language=language)["text"]
+            times.append(time.time() - start)
+        results[audio_file] = {"text": text, "inference_time": min(times)}
+        print(f"{os.path.basename(audio_file)}: {min(times):.2f}s  {text[:50]}...")
+
+    return {"load_time": load_time, "files": results}
+
+
+def build_report(model: str, export_dir, quantized_dir, audio_files, language: str, runs: int):
+    """float32 と INT8 の速度・精度比較レポートを作成"""
+    variants = {}
+    for compute_type in COMPUTE_TYPES:
+        variants[compute_type] = benchmark_variant(model, compute_type, audio_files, language, runs)
+
+    report = {
+        "model": resolve_model_id(model),
+        "model_size_mb": {
+            "float32": round(dir_size_mb(export_dir), 1),
+            "int8": round(dir_size_mb(quantized_dir), 1),
+        },
+        "variants": {},
+    }
+
+    for compute_type, variant in variants.items():
+        total_audio = 0.0
+        total_infer = 0.0
+        rtf_infer = 0.0
+        cers = []
+        for audio_file, res in variant["files"].items():
+            total_infer += res["inference_time"]
+            # mp3 等も読めるようサーバーと同じヘッダー解析で長さを取得 (取得できなければ RTF の計算から除外)
+            duration = probe_duration(audio_file)
+            if duration:
+                total_audio += duration
+                rtf_infer += res["inference_time"]
+            # 正解テキストが無ければ float32 の出力を基準にする
+            reference = load_reference(audio_file) or variants["float32"]["files"][audio_file]["text"]
+            cers.append(char_error_rate(reference, res["text"]))
+
+        report["variants"][compute_type] = {
+            "load_time": round(variant["load_time"], 2),
+            "inference_time": round(total_infer, 2),
+            "rtf": round(rtf_infer / total_audio, 4) if total_audio else None,
+            "cer": round(sum(cers) / len(cers), 4) if cers else None,
+        }
+
+    return report
+
+
+def _fmt(value) -> str:
+    return "-" if value is None else str(value)
+
+
+def print_report(report):
+    print("\n" + "="*50)
+    print(f"SUMMARY ({report['model']})")
+    print("="*50)
+    print(f"{'Variant':<10} {'Size(MB)':<10} {'Load':<9} {'Infer':<9} {'RTF':<8} {'CER':<8}")
+    print("-"*54)
+    for compute_type, v in report["variants"].items():
+        print(
+            f"{compute_type:<10} {report['model_size_mb'][compute_type]:<10} "
+            f"{v['load_time']:.2f}s{'':<4} {v['inference_time']:.2f}s{'':<4} "
+            f"{_fmt(v['rtf']):<8} {_fmt(v['cer']):<8}"
+        )
+
+    fp32 = report["variants"]["float32"]
+    int8 = report["variants"]["int8"]
+    if int8["inference_time"]:
+        print(f"\nINT8 speedup: {fp32['inference_time'] / int8['inference_time']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and evaluate INT8 quantized ONNX Whisper models")
+    parser.add_argument("--model", type=str, default="small", help="Model size or HuggingFace model id")
+    parser.add_argument("--report", nargs="*", default=None, metavar="AUDIO", help="Audio files for the float32 vs INT8 comparison")
+    parser.add_argument("--language", type=str, default="ja", help="Language code (default: ja)")
+    parser.add_argument("--runs", type=int, default=1, help="Runs per file, fastest is reported (default: 1)")
+    parser.add_argument("--output", type=str, default=None, help="Write the report as JSON")
+
+    args = parser.parse_args()
+
+    model_id = resolve_model_id(args.model)
+    export_dir = export_onnx_model(model_id)
+    quantized_dir = quantize_onnx_model(model_id, export_dir)
+    print(f"INT8 model cached at: {quantized_dir}")
+
+    if not args.report:
+        return
+
+    try:
+        report = build_report(args.model, export_dir, quantized_dir, args.report, args.language, args.runs)
+    except Exception as e:
+        print(f"Error: {e}")
+        traceback.print_exc()
+        return
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Traffic Replay Tool
+Re-issues a trace captured with CAPTURE_DIR (see app/capture.py) against a server, keeping the
+original inter-arrival times (optionally scaled), and compares latency distributions between runs
+
+Usage:
+    python replay.py run captures/ --url http://127.0.0.1:8000 --output before.json
+    python replay.py run captures/ --speed 2.0 --output after.json      # 2x faster arrivals
+    python replay.py compare before.json after.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+
+import requests
+
+TRACE_FILE = "trace.jsonl"
+AUDIO_DIR = "audio"
+
+
+def load_trace(capture_dir: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """trace.jsonl を到着順に読み込む"""
+    with open(os.path.join(capture_dir, TRACE_FILE), encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r["arrival"])
+    return records[:limit] if limit else records
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    # nearest-rank 法
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies: List[float]) -> Dict[str, Any]:
+    def r(v):
+        return round(v, 3) if v is not None else None
+    return {
+        "count": len(latencies),
+        "mean": r(sum(latencies) / len(latencies)) if latencies else None,
+        "p50": r(percentile(latencies, 50)),
+        "p90": r(percentile(latencies, 90)),
+        "p95": r(percentile(latencies, 95)),
+        "p99": r(percentile(latencies, 99)),
+        "max": r(max(latencies)) if latencies else None,
+    }
+
+
+def send(url: str, api_key: str, capture_dir: str, record: Dict[str, Any], deployment: Optional[str]) -> Dict[str, Any]:
+    """記録された1リクエストを再送"""
+    audio_path = os.path.join(capture_dir, AUDIO_DIR, record["audio"])
+    with open(audio_path, "rb") as f:
+        audio = f.read()
+
+    data = {k: record[k] for k in ("language", "prompt", "response_format", "segment_fields") if record.get(k) is not None}
+    headers = {"api-key": api_key}
+    if record.get("request_timeout_ms") is not None:
+        headers["x-request-timeout-ms"] = str(int(record["request_timeout_ms"]))
+    endpoint = f"{url}/openai/deployments/{deployment or record['deployment_id']}/audio/transcriptions"
+
+    start = time.perf_counter()
+    try:
+        response = requests.post(
+            endpoint,
+            headers=headers,
+            files={"file": (record.get("filename") or record["audio"], audio)},
+            data=data
+        )
+        status = response.status_code
+    except requests.exceptions.RequestException as e:
+        status = None
+        print(f"Request failed: {e}")
+    return {"latency": time.perf_counter() - start, "status": status}
+
+
+def run(args):
+    records = load_trace(args.capture_dir, args.limit)
+    if not records:
+        print("Trace is empty.")
+        return
+    first = records[0]["arrival"]
+    span = (records[-1]["arrival"] - first) / args.speed
+    print(f"Replaying {len(records)} requests over {span:.1f}s (speed x{args.speed}) against {args.url}")
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(records)
+    lock = threading.Lock()
+    done = 0
+
+    def task(index: int, record: Dict[str, Any]):
+        nonlocal done
+        result = send(args.url, args.api_key, args.capture_dir, record, args.deployment)
+        results[index] = {
+            "deployment_id": args.deployment or record["deployment_id"],
+            "audio_seconds": record.get("audio_seconds"),
+            "original_status": record.get("status"),
+            "original_latency": record.get("timings", {}).get("total"),
+            **result,
+        }
+        with lock:
+            done += 1
+            if done % 10 == 0 or done == len(records):
+                print(f"  {done}/{len(records)} completed")
+
+    # 到着時刻に合わせて送信する (応答を待たずに次の送信を行うため、スレッド数は十分に大きくする)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.max_workers) as pool:
+        for index, record in enumerate(records):
+            delay = (record["arrival"] - first) / args.speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(task, index, record)
+    wall = time.perf_counter() - start
+
+    ok = [r for r in results if r and r["status"] == 200]
+    report = {
+        "capture_dir": os.path.abspath(args.capture_dir),
+        "url": args.url,
+        "speed": args.speed,
+        "wall_time": round(wall, 2),
+        "errors": len(results) - len(ok),
+        "status_counts": _count(r["status"] for r in results if r),
+        "latency": summarize([r["latency"] for r in ok]),
+        "original_latency": summarize([
+            r["original_latency"] for r in results
+            if r and r["original_status"] == 200 and r["original_latency"] is not None
+        ]),
+        "results": results,
+    }
+
+    print_summary(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+
+
+def _count(values) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for v in values:
+        counts[str(v)] = counts.get(str(v), 0) + 1
+    return counts
+
+
+def print_summary(report: Dict[str, Any]):
+    print("\n" + "="*60)
+    print(f"REPLAY SUMMARY (x{report['speed']}, {report['wall_time']}s, errors: {report['errors']})")
+    print("="*60)
+    print(f"{'':<10} {'Replay':<12} {'Captured':<12}")
+    for key in ("count", "mean", "p50", "p90", "p95", "p99", "max"):
+        print(f"{key:<10} {str(report['latency'][key]):<12} {str(report['original_latency'][key]):<12}")
+
+
+def compare(args):
+    """2つのリプレイ結果のレイテンシ分布を比較"""
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    print("\n" + "="*60)
+    print(f"BASELINE:  {args.baseline} (errors: {baseline['errors']})")
+    print(f"CANDIDATE: {args.candidate} (errors: {candidate['errors']})")
+    print("="*60)
+    print(f"{'':<10} {'Baseline':<12} {'Candidate':<12} {'Change':<10}")
+    print("-"*46)
+    regressed = False
+    for key in ("mean", "p50", "p90", "p95", "p99", "max"):
+        a = baseline["latency"][key]
+        b = candidate["latency"][key]
+        change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "-"
+        print(f"{key:<10} {str(a):<12} {str(b):<12} {change:<10}")
+        if key == "p95" and a and b is not None and b > a * (1 + args.threshold / 100):
+            regressed = True
+
+    if candidate["errors"] > baseline["errors"]:
+        print(f"\nErrors increased: {baseline['errors']} -> {candidate['errors']}")
+        regressed = True
+    if regressed:
+        print(f"\nREGRESSION (p95 threshold: +{args.threshold}%)")
+        sys.exit(1)
+    print("\nNo regression.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic and compare latency distributions")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="Replay a capture directory against a server")
+    p_run.add_argument("capture_dir", help="Directory written by the server with CAPTURE_DIR")
+    p_run.add_argument("--url", type=str, default="http://127.0.0.1:8000", help="Server URL (default: http://127.0.0.1:8000)")
+    p_run.add_argument("--api-key", type=str, default="test", help="api-key header (default: test)")
+    p_run.add_argument("--speed", type=float, default=1.0, help="Arrival rate multiplier; 2.0 replays twice as fast (default: 1.0)")
+    p_run.add_argument("--deployment", type=str, default=None, help="Send every request to this deployment instead of the captured one")
+    p_run.add_argument("--limit", type=int, default=None, help="Replay only the first N requests")
+    p_run.add_argument("--max-workers", type=int, default=64, help="Maximum concurrent requests (default: 64)")
+    p_run.add_argument("--output", type=str, default=None, help="Write the results as JSON (input for 'compare')")
+
+    p_cmp = sub.add_parser("compare", help="Compare two replay results")
+    p_cmp.add_argument("baseline", help="Results JSON of the baseline run")
+    p_cmp.add_argument("candidate", help="Results JSON of the candidate run")
+    p_cmp.add_argument("--threshold", type=float, default=10.0, help="Fail if p95 grows by more than this percentage (default: 10)")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        if args.speed <= 0:
+            parser.error("--speed must be > 0")
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
+import time
+# 起動時間のプロファイル (--profile-startup) の起点
+_STARTED_AT = time.perf_counter()
+
 import os
 import sys
+import asyncio
 import argparse
 import uvicorn
 import multiprocessing
@@ -7,21 +12,112 @@ import multiprocessing
 # Windowsでのmultiprocessing対応 (PyInstallerで必要)
 multiprocessing.freeze_support()
 
+
+class GracefulServer(uvicorn.Server):
+    """
+    終了シグナル受信時に、まず新規受付を停止して /health を not-ready にし、
+    処理中・待機中の推論が終わるまで (最大 drain_timeout 秒) 待ってから uvicorn を停止する
+    2回目のシグナルでは即時終了する
+    """
+
+    def __init__(self, config: uvicorn.Config, drain_timeout: float,
+                 profile_output: str = None, exit_after_startup: bool = False):
+        super().__init__(config)
+        self.drain_timeout = drain_timeout
+        self.profile_output = profile_output
+        self.exit_after_startup = exit_after_startup
+        self._draining = False
+        self._loop = None
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        # --profile-startup: リクエストを受け付けられるようになった時点でレポートを出力
+        from app.startup_profile import get_startup_profile
+        profile = get_startup_profile()
+        if profile is not None:
+            profile.mark_ready()
+            profile.log_report(self.profile_output)
+        if self.exit_after_startup:
+            self.should_exit = True
+
+    async def serve(self, sockets=None):
+        self._loop = asyncio.get_running_loop()
+        await super().serve(sockets)
+
+    def handle_exit(self, sig, frame):
+        if self._draining or self._loop is None:
+            return super().handle_exit(sig, frame)
+        self._draining = True
+        self._loop.call_soon_threadsafe(
+            lambda: self._loop.create_task(self._drain_then_exit(sig, frame))
+        )
+
+    async def _drain_then_exit(self, sig, frame):
+        from app.model_registry import get_registry
+        registry = get_registry()
+        registry.begin_shutdown()
+        print(f"Draining in-flight requests (up to {self.drain_timeout:.0f}s)...")
+        if not await registry.drain(self.drain_timeout):
+            print("Drain deadline exceeded.")
+        super().handle_exit(sig, frame)
+
 def main():
     parser = argparse.ArgumentParser(description="Whisper API Server (Windows Native)")
     parser.add_argument("--port", type=int, default=8000, help="Port to bind (default: 8000)")
     parser.add_argument("--model", type=str, default="RoachLin/kotoba-whisper-v2.2-faster", help="Whisper model path/name")
+    parser.add_argument("--config", type=str, default=None, help="Deployment config file (.json/.yaml/.toml); overrides --model/--gpu/--onnx-*")
+    parser.add_argument("--onnx-model", type=str, default=None, help="Also serve an ONNX Runtime (CPU) Whisper deployment, e.g. 'small'")
+    parser.add_argument("--onnx-int8", action="store_true", help="Also serve the INT8 quantized ONNX deployment (requires --onnx-model)")
     parser.add_argument("--gpu", action="store_true", help="Enable GPU (CUDA)")
     parser.add_argument("--reload", action="store_true", help="Enable hot reload (dev only)")
+    parser.add_argument("--drain-timeout", type=float, default=30.0, help="Seconds to wait for in-flight requests on shutdown (default: 30)")
+    parser.add_argument("--local-input-dir", type=str, nargs="+", default=None, metavar="DIR", help="Allow file_path requests to read files under DIR (server-local input)")
+    parser.add_argument("--capture", type=str, default=None, metavar="DIR", help="Record sampled requests to DIR for replay.py")
+    parser.add_argument("--capture-sample-rate", type=float, default=1.0, help="Fraction of requests to record with --capture (default: 1.0)")
+    parser.add_argument("--capture-max-mb", type=float, default=1024, help="Stop recording once the capture reaches this size (default: 1024)")
+    parser.add_argument("--access-log", type=str, default=None, metavar="PATH", help="Write one JSON line per request (model, audio duration, timings, RTF) to PATH ('-' for stdout)")
+    parser.add_argument("--access-log-sample-rate", type=float, default=1.0, help="Fraction of successful requests to write with --access-log; errors are always written (default: 1.0)")
+    parser.add_argument("--access-log-transcripts", action="store_true", help="Include transcript text in --access-log records")
+    parser.add_argument("--warm-up", action="store_true", help="Run a warm-up inference on every deployment before accepting requests")
+    parser.add_argument("--profile-startup", action="store_true", help="Report time spent per import, model load and warm-up until the server is ready")
+    parser.add_argument("--profile-output", type=str, default=None, help="Write the --profile-startup report as JSON")
+    parser.add_argument("--exit-after-startup", action="store_true", help="Shut down as soon as the server is ready (use with --profile-startup)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind (default: 127.0.0.1)")
+    parser.add_argument("--gateway", action="store_true", help="Run as a load-balancing gateway in front of other WhisperServer instances")
+    parser.add_argument("--backends", type=str, default=None, help="Comma-separated backend URLs for --gateway, e.g. 'http://10.0.0.2:8000,http://10.0.0.3:8000'")
+    parser.add_argument("--health-interval", type=float, default=2.0, help="Seconds between backend health checks in --gateway mode (default: 2)")
     
     args = parser.parse_args()
     
+    if args.gateway:
+        run_gateway(args)
+        return
+    
     # Set environment variables
     os.environ["WHISPER_MODEL"] = args.model
     os.environ["USE_GPU"] = "1" if args.gpu else "0"
+    os.environ["SHUTDOWN_DRAIN_TIMEOUT"] = str(args.drain_timeout)
+    if args.onnx_model:
+        os.environ["ONNX_WHISPER_MODEL"] = args.onnx_model
+    if args.onnx_int8:
+        os.environ["ONNX_WHISPER_INT8"] = "1"
+    if args.local_input_dir:
+        os.environ["LOCAL_INPUT_DIRS"] = os.pathsep.join(os.path.abspath(d) for d in args.local_input_dir)
+    if args.capture:
+        os.environ["CAPTURE_DIR"] = os.path.abspath(args.capture)
+        os.environ["CAPTURE_SAMPLE_RATE"] = str(args.capture_sample_rate)
+        os.environ["CAPTURE_MAX_MB"] = str(args.capture_max_mb)
+    if args.access_log:
+        os.environ["ACCESS_LOG"] = args.access_log if args.access_log == "-" else os.path.abspath(args.access_log)
+        os.environ["ACCESS_LOG_SAMPLE_RATE"] = str(args.access_log_sample_rate)
+        os.environ["ACCESS_LOG_TRANSCRIPTS"] = "1" if args.access_log_transcripts else "0"
+    if args.config:
+        os.environ["WHISPER_SERVER_CONFIG"] = os.path.abspath(args.config)
+    if args.warm_up:
+        os.environ["STARTUP_WARM_UP"] = "1"
     
     print(f"Starting Whisper Server on port {args.port}...")
-    print(f"Model: {args.model}")
+    print(f"Config: {args.config}" if args.config else f"Model: {args.model}")
     print(f"GPU: {'Enabled' if args.gpu else 'Disabled'}")
     
     # Run uvicorn
@@ -31,12 +127,50 @@ def main():
     # However, passing the app object instance directly prevents uvicorn from using multiple workers properly,
     # but we are single process usually.
     
+    profile = None
+    if args.profile_startup:
+        from app.startup_profile import enable_startup_profile
+        profile = enable_startup_profile(started_at=_STARTED_AT)
+    
     try:
-        from app.main import app
-        uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="info")
+        if profile is not None:
+            with profile.stage("import app.main"):
+                from app.main import app
+        else:
+            from app.main import app
     except ImportError as e:
         print(f"Failed to import app: {e}")
         sys.exit(1)
+    
+    config = uvicorn.Config(app, host=args.host, port=args.port, log_level="info")
+    GracefulServer(
+        config,
+        drain_timeout=args.drain_timeout,
+        profile_output=args.profile_output,
+        exit_after_startup=args.exit_after_startup
+    ).run()
+
+
+def run_gateway(args):
+    """ゲートウェイモード (モデルはロードせず、リクエストをバックエンドへ転送する)"""
+    backends = args.backends or os.getenv("WHISPER_GATEWAY_BACKENDS")
+    if not backends:
+        print("--gateway requires --backends (or WHISPER_GATEWAY_BACKENDS)")
+        sys.exit(1)
+    os.environ["WHISPER_GATEWAY_BACKENDS"] = backends
+    os.environ["GATEWAY_HEALTH_INTERVAL"] = str(args.health_interval)
+    
+    print(f"Starting Whisper Gateway on port {args.port}...")
+    print(f"Backends: {backends}")
+    
+    try:
+        from app.gateway import app
+    except ImportError as e:
+        print(f"Failed to import gateway (pip install httpx): {e}")
+        sys.exit(1)
+    
+    config = uvicorn.Config(app, host=args.host, port=args.port, log_level="info")
+    uvicorn.Server(config).run()
 
 if __name__ == "__main__":
     main()